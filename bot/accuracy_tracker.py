@@ -0,0 +1,105 @@
+import threading
+import time
+from typing import Dict, Optional
+
+
+#Rolling windows reported by default, with their span in seconds
+default_windows = {'1m': 60, '5m': 300, '1h': 3600}
+
+
+class RollingWindow:
+    """
+      Ring buffer of (good, total) counts over the last span seconds, split in a fixed number of buckets.
+      Buckets are recycled as time goes by, so updates are O(1) and memory does not grow with traffic.
+    """
+
+    def __init__(self, span: float, buckets: int=60):
+        self.span = span
+        self.buckets = buckets
+        self.width = span / buckets
+        self.ids = [-1] * buckets
+        self.good = [0] * buckets
+        self.total = [0] * buckets
+
+    def add(self, now: float, good: int, total: int):
+        index = int(now // self.width)
+        slot = index % self.buckets
+        if self.ids[slot] != index:
+            #The bucket holds counts from a previous lap of the ring
+            self.ids[slot] = index
+            self.good[slot] = 0
+            self.total[slot] = 0
+        self.good[slot] += good
+        self.total[slot] += total
+
+    def counts(self, now: float):
+        oldest = int(now // self.width) - self.buckets + 1
+        good = total = 0
+        for slot in range(self.buckets):
+            if self.ids[slot] >= oldest:
+                good += self.good[slot]
+                total += self.total[slot]
+        return good, total
+
+
+def ratio(good, total) -> Optional[float]:
+    return good / total if total else None
+
+
+class AccuracyTracker:
+    """
+      Accuracy of the confirmation prompts and of the detected entities, since start-up and
+      over rolling windows, updated in O(1) for each turn.
+    """
+
+    def __init__(self, windows: Dict[str, float]=None, buckets: int=60, clock=time.monotonic):
+        windows = default_windows if windows is None else windows
+        self.clock = clock
+        self.successes = 0
+        self.errors = 0
+        self.entities_correct = 0
+        self.entities_wrong = 0
+        self.requests = {name: RollingWindow(span, buckets) for name, span in windows.items()}
+        self.entities = {name: RollingWindow(span, buckets) for name, span in windows.items()}
+        self._lock = threading.Lock()
+
+    def record_request(self, success: bool):
+        now = self.clock()
+        with self._lock:
+            if success:
+                self.successes += 1
+            else:
+                self.errors += 1
+            for window in self.requests.values():
+                window.add(now, int(bool(success)), 1)
+
+    def record_entities(self, correct: int, wrong: int):
+        now = self.clock()
+        with self._lock:
+            self.entities_correct += correct
+            self.entities_wrong += wrong
+            for window in self.entities.values():
+                window.add(now, correct, correct + wrong)
+
+    def accuracy(self, window: str=None) -> Optional[float]:
+        #Share of confirmed predictions, since start-up if no window is given, None without requests
+        with self._lock:
+            if window is None:
+                return ratio(self.successes, self.successes + self.errors)
+            return ratio(*self.requests[window].counts(self.clock()))
+
+    def entity_accuracy(self, window: str=None) -> Optional[float]:
+        with self._lock:
+            if window is None:
+                return ratio(self.entities_correct, self.entities_correct + self.entities_wrong)
+            return ratio(*self.entities[window].counts(self.clock()))
+
+    def snapshot(self):
+        return {
+            'successes': self.successes,
+            'errors': self.errors,
+            'accuracy': self.accuracy(),
+            'entity_accuracy': self.entity_accuracy(),
+            'windows': {name: {'accuracy': self.accuracy(name), 'entity_accuracy': self.entity_accuracy(name)}
+                for name in self.requests},
+        }
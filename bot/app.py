@@ -1,6 +1,8 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
+import asyncio
+import os
 import sys
 import traceback
 from datetime import datetime
@@ -19,93 +21,144 @@ from botbuilder.core import (
 from botbuilder.core.integration import aiohttp_error_middleware
 from botbuilder.schema import Activity, ActivityTypes
 
-from config import DefaultConfig
-from dialogs import UserProfileDialog
+from data_models import UserProfile
+from dialogs import SlotFillingDialog
 from bots import DialogBot
+from storage import SqliteStorage, compact_models
 import insights
-import config
+import luis
 
-CONFIG = DefaultConfig()
+try:
+    from config import DefaultConfig
+
+except ImportError:
+    #The config file is not versioned, we load the settings from the environment
+    class DefaultConfig:
+        PORT = int(os.environ.get("PORT", 3978))
+        APP_ID = os.environ.get("MicrosoftAppId", "")
+        APP_PASSWORD = os.environ.get("MicrosoftAppPassword", "")
 
-# Create adapter.
-# See https://aka.ms/about-bot-adapter to learn more about how bots work.
-SETTINGS = BotFrameworkAdapterSettings(CONFIG.APP_ID, CONFIG.APP_PASSWORD)
-ADAPTER = BotFrameworkAdapter(SETTINGS)
+CONFIG = DefaultConfig()
 
 logger = insights.configure_logger()
 
 
-# Catch-all for errors.
-async def on_error(context: TurnContext, error: Exception):
-    # This check writes out errors to console log
-    # NOTE: In production environment, you should consider logging this to Azure
-    #       application insights.
-    print(f"\n [on_turn_error]: { error }", file=sys.stderr)
-    traceback.print_exc()
-
-    # Send a message to the user
-    await context.send_activity("The bot encountered an error or bug.")
-    await context.send_activity(
-        "To continue to run this bot, please fix the bot source code."
-    )
-
-    logger.fatal("Bot Crash")
-
-    # Send a trace activity if we're talking to the Bot Framework Emulator
-    if context.activity.channel_id == "emulator":
-        # Create a trace activity that contains the error object
-        trace_activity = Activity(
-            label="TurnError",
-            name="on_turn_error Trace",
-            timestamp=datetime.utcnow(),
-            type=ActivityTypes.trace,
-            value=f"{error}",
-            value_type="https://www.botframework.com/schemas/error",
+def create_storage():
+    # State is kept in memory unless a SQLite database path is given, which survives restarts
+    # and can be shared by several bot processes.
+    storage_path = os.environ.get("BOT_STORAGE_PATH")
+    if not storage_path:
+        return MemoryStorage()
+    # The state is stored as JSON, flattened in its compact form
+    compact_models.register(UserProfile)
+    return SqliteStorage(storage_path)
+
+
+async def warm_up(app):
+    # Telemetry is started before serving, so that a wrong exporter setting stops the app rather
+    # than every turn. The entity extraction backend is loaded in the background.
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, insights.init_telemetry)
+
+    def loaded(future):
+        if future.exception() is not None:
+            logger.error("Loading the entity extraction backend failed", exc_info=future.exception())
+    loop.run_in_executor(None, luis.warm_up).add_done_callback(loaded)
+
+
+def create_app(config=CONFIG) -> web.Application:
+    # Builds the adapter, states, bot and web application, once per worker process.
+
+    # Create adapter.
+    # See https://aka.ms/about-bot-adapter to learn more about how bots work.
+    settings = BotFrameworkAdapterSettings(config.APP_ID, config.APP_PASSWORD)
+    adapter = BotFrameworkAdapter(settings)
+
+    # Catch-all for errors.
+    async def on_error(context: TurnContext, error: Exception):
+        # This check writes out errors to console log
+        # NOTE: In production environment, you should consider logging this to Azure
+        #       application insights.
+        print(f"\n [on_turn_error]: { error }", file=sys.stderr)
+        traceback.print_exc()
+
+        # Send a message to the user
+        await context.send_activity("The bot encountered an error or bug.")
+        await context.send_activity(
+            "To continue to run this bot, please fix the bot source code."
         )
 
-        # Send a trace activity, which will be displayed in Bot Framework Emulator
-        await context.send_activity(trace_activity)
-
-    # Clear out state
-    await CONVERSATION_STATE.delete(context)
-
-
-# Set the error handler on the Adapter.
-# In this case, we want an unbound method, so MethodType is not needed.
-ADAPTER.on_turn_error = on_error
-
-# Create MemoryStorage, UserState and ConversationState
-MEMORY = MemoryStorage()
-CONVERSATION_STATE = ConversationState(MEMORY)
-USER_STATE = UserState(MEMORY)
-
-# create main dialog and bot
-DIALOG = UserProfileDialog(USER_STATE)
-BOT = DialogBot(CONVERSATION_STATE, USER_STATE, DIALOG)
-
-
-# Listen for incoming requests on /api/messages.
-async def messages(req: Request) -> Response:
-    # Main bot message handler.
-    if "application/json" in req.headers["Content-Type"]:
-        body = await req.json()
-    else:
-        return Response(status=HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
-
-    activity = Activity().deserialize(body)
-    auth_header = req.headers["Authorization"] if "Authorization" in req.headers else ""
-
-    response = await ADAPTER.process_activity(activity, auth_header, BOT.on_turn)
-    if response:
-        return json_response(data=response.body, status=response.status)
-    return Response(status=HTTPStatus.OK)
-
+        logger.fatal("Bot Crash")
+
+        # Send a trace activity if we're talking to the Bot Framework Emulator
+        if context.activity.channel_id == "emulator":
+            # Create a trace activity that contains the error object
+            trace_activity = Activity(
+                label="TurnError",
+                name="on_turn_error Trace",
+                timestamp=datetime.utcnow(),
+                type=ActivityTypes.trace,
+                value=f"{error}",
+                value_type="https://www.botframework.com/schemas/error",
+            )
+
+            # Send a trace activity, which will be displayed in Bot Framework Emulator
+            await context.send_activity(trace_activity)
+
+        # Clear out state
+        await conversation_state.delete(context)
+
+    # Set the error handler on the Adapter.
+    # In this case, we want an unbound method, so MethodType is not needed.
+    adapter.on_turn_error = on_error
+
+    # Create the storage, UserState and ConversationState
+    memory = create_storage()
+    conversation_state = ConversationState(memory)
+    user_state = UserState(memory)
+
+    # create main dialog and bot
+    dialog = SlotFillingDialog(user_state)
+    bot = DialogBot(conversation_state, user_state, dialog)
+
+    # Listen for incoming requests on /api/messages.
+    async def messages(req: Request) -> Response:
+        # Main bot message handler.
+        if "application/json" in req.headers["Content-Type"]:
+            body = await req.json()
+        else:
+            return Response(status=HTTPStatus.UNSUPPORTED_MEDIA_TYPE)
+
+        activity = Activity().deserialize(body)
+        auth_header = req.headers["Authorization"] if "Authorization" in req.headers else ""
+
+        response = await adapter.process_activity(activity, auth_header, bot.on_turn)
+        if response:
+            return json_response(data=response.body, status=response.status)
+        return Response(status=HTTPStatus.OK)
+
+    async def close_storage(app):
+        if isinstance(memory, SqliteStorage):
+            memory.close()
+
+    app = web.Application(middlewares=[aiohttp_error_middleware])
+    app.router.add_post("/api/messages", messages)
+    # Metrics in the Prometheus text format, when the exporter is enabled
+    if "prometheus" in insights.exporter_names:
+        app.router.add_get("/metrics", insights.handle_metrics)
+    app.on_startup.append(warm_up)
+    app.on_cleanup.append(luis.close_session)
+    app.on_cleanup.append(close_storage)
+    return app
+
+
+async def init_app() -> web.Application:
+    # Application factory for gunicorn (see gunicorn.conf.py), called in each worker process
+    return create_app()
 
-APP = web.Application(middlewares=[aiohttp_error_middleware])
-APP.router.add_post("/api/messages", messages)
 
 if __name__ == "__main__":
     try:
-        web.run_app(APP, host="localhost", port=CONFIG.PORT)
+        web.run_app(create_app(), host="localhost", port=CONFIG.PORT)
     except Exception as error:
         raise error
@@ -0,0 +1,250 @@
+"""
+  Deployment of the LUIS app through the authoring API, replacing the feed_utterances, train_app and
+  publish_app cells of Notebook.ipynb: the labelled examples of an utterance file are uploaded in batches
+  of 100 by concurrent requests, the version is trained, its training status polled with an exponential
+  backoff, and it is published to the prediction slot of the bot.
+
+  python authoring.py ../train_luis_utterances.json --concurrency 4 --rate 5
+
+  Any authoring endpoint can be used, such as a local stand-in:
+
+  python luis_standin.py --port 8181 --train-time 30
+  LUIS_AUTHORING_ENDPOINT=http://localhost:8181/ LUIS_APP_ID=flybot python authoring.py ../train_luis_utterances.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+
+import aiohttp
+
+import dataset
+from request_scheduler import RequestScheduler
+
+
+try :
+    #If config loads, load the authoring key from the file
+    import config
+    authoring_endpoint = config.authoring_endpoint
+    authoring_key = config.authoring_key
+    app_id = config.app_id
+
+except (ImportError, AttributeError):
+    authoring_endpoint = os.environ.get("LUIS_AUTHORING_ENDPOINT")
+    authoring_key = os.environ.get("LUIS_AUTHORING_KEY")
+    app_id = os.environ.get("LUIS_APP_ID")
+
+#Version created by the notebook
+app_version = os.environ.get("LUIS_APP_VERSION", "0.1")
+
+#Same slot as luis.slot, without importing the bot
+slot = os.environ.get("LUIS_SLOT", "staging")
+
+#The authoring API accepts 100 examples per batch, and 5 transactions per second with a free key
+batch_size = 100
+default_rate = 5
+
+#Requests are retried up to LUIS_AUTHORING_RETRIES times, after a random delay of up to
+#LUIS_AUTHORING_BACKOFF seconds doubling on every retry
+retries = int(os.environ.get("LUIS_AUTHORING_RETRIES", 5))
+retry_backoff = float(os.environ.get("LUIS_AUTHORING_BACKOFF", 0.5))
+
+#Training is complete once every model is trained, and has failed if one of them failed
+trained_statuses = ('Success', 'UpToDate')
+
+
+class AuthoringError(Exception):
+    """
+      Raised when a request to the authoring API failed after its retries, or when the training failed
+      or did not complete in time. reason is 'timeout', 'connection', 'status', 'invalid', 'training_failed'
+      or 'training_timeout', and status the HTTP status of an error response.
+    """
+
+    def __init__(self, message, reason, status=None, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.reason in ('timeout', 'connection') or self.status == 429 or (self.status or 0) >= 500
+
+
+def to_example(text, intent, labels):
+    #Example of the authoring API from a load_utterances tuple
+    return {'text': text, 'intentName': intent or 'None',
+        'entityLabels': [{'entityName': ent, 'startCharIndex': start, 'endCharIndex': end} for ent, start, end in labels]}
+
+
+class AuthoringClient:
+    """
+      Authoring API client for one version of an app, to be used as an async context manager. Requests
+      are retried on timeouts, connection errors, throttling and server errors, as set by the retries and
+      retry_backoff settings (or after the Retry-After delay of the API).
+    """
+
+    def __init__(self, endpoint, key, app_id, version: str="0.1", timeout: float=60.0):
+        self.base_url = f"{endpoint.rstrip('/')}/luis/authoring/v3.0-preview/apps/{app_id}"
+        self.version_url = f"{self.base_url}/versions/{version}"
+        self.key = key
+        self.version = version
+        self.retries = retries
+        self.backoff = retry_backoff
+        self.timeout = timeout
+        self.stats = {'requests': 0, 'retries': 0}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers={'Ocp-Apim-Subscription-Key': self.key or ''})
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def _send(self, method, url, body):
+        self.stats['requests'] += 1
+        try:
+            async with self.session.request(method, url, json=body) as response:
+                if response.status >= 300:
+                    retry_after = response.headers.get('Retry-After', '')
+                    message = (await response.text())[:200]
+                    raise AuthoringError(f"{method} {url} answered with status {response.status}: {message}",
+                        'status', status=response.status, retry_after=float(retry_after) if retry_after.isdigit() else None)
+                return await response.json(content_type=None)
+        except asyncio.TimeoutError as error:
+            raise AuthoringError(f"{method} {url} did not answer in time", 'timeout') from error
+        except aiohttp.ClientError as error:
+            raise AuthoringError(f"{method} {url} could not be reached: {error}", 'connection') from error
+        except ValueError as error:
+            raise AuthoringError(f"{method} {url} answered with invalid JSON", 'invalid') from error
+
+    async def request(self, method, url, body=None):
+        #Adding examples, training and publishing can be repeated, every request is retried
+        for attempt in range(self.retries + 1):
+            try:
+                return await self._send(method, url, body)
+            except AuthoringError as error:
+                if not error.retryable or attempt == self.retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                if error.retry_after is not None:
+                    delay = max(delay, error.retry_after)
+            self.stats['retries'] += 1
+            await asyncio.sleep(delay)
+
+    async def upload_examples(self, examples, concurrency: int=4, rate: float=default_rate):
+        """
+          Uploads the examples in batches, concurrency requests in flight and rate requests started per
+          second at most. Returns the number of batches and the (text, error message) of the examples
+          refused by the API, AuthoringError being raised if a batch could not be uploaded.
+        """
+        batches = [examples[i:i + batch_size] for i in range(0, len(examples), batch_size)]
+        scheduler = RequestScheduler(max_concurrency=concurrency, rate=rate, max_queue=len(batches), max_wait=None)
+
+        async def upload(index, batch):
+            return await scheduler.run(index, lambda: self.request('POST', f"{self.version_url}/examples", batch))
+
+        #Every batch is attempted, the upload is only given up once all of them completed
+        results = await asyncio.gather(*(upload(i, b) for i, b in enumerate(batches)), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        failed = [(example['text'], (result.get('error') or {}).get('message'))
+            for batch, batch_results in zip(batches, results)
+            for example, result in zip(batch, batch_results) if result.get('hasError')]
+        return {'batches': len(batches), 'failed': failed}
+
+    async def train(self, initial_delay: float=1.0, max_delay: float=10.0, factor: float=2.0, timeout: float=1800.0):
+        """
+          Trains the version and waits for every model to be trained, polling its status after initial_delay
+          seconds, then after delays multiplied by factor up to max_delay. Returns the number of models and
+          of status polls.
+        """
+        end = time.monotonic() + timeout
+        await self.request('POST', f"{self.version_url}/train")
+
+        delay = initial_delay
+        polls = 0
+        while True:
+            await asyncio.sleep(min(delay, max(0.0, end - time.monotonic())))
+            models = await self.request('GET', f"{self.version_url}/train")
+            polls += 1
+
+            failed = {m['modelId']: m['details'].get('failureReason') for m in models if m['details']['status'] == 'Fail'}
+            if failed:
+                raise AuthoringError(f"Training failed: {failed}", 'training_failed')
+            if models and all(m['details']['status'] in trained_statuses for m in models):
+                return {'models': len(models), 'polls': polls}
+            if time.monotonic() >= end:
+                raise AuthoringError(f"Training did not complete in {timeout} seconds", 'training_timeout')
+            delay = min(max_delay, delay * factor)
+
+    async def publish(self, slot: str="staging"):
+        #Returns the endpoint information of the published version
+        return await self.request('POST', f"{self.base_url}/publish",
+            {'versionId': self.version, 'isStaging': slot == 'staging'})
+
+
+async def deploy(examples, endpoint=None, key=None, app=None, version=None, slot=slot, concurrency=4,
+    rate=default_rate, publish=True, **training):
+    """
+      Uploads the examples, trains the version and publishes it to slot, with the endpoint, key, app id
+      and version of the module by default. training holds the polling options of AuthoringClient.train.
+    """
+    report = {'examples': len(examples)}
+    async with AuthoringClient(endpoint or authoring_endpoint, key or authoring_key, app or app_id,
+        version or app_version) as client:
+        start = time.perf_counter()
+        uploaded = await client.upload_examples(examples, concurrency, rate)
+        report['upload_s'] = time.perf_counter() - start
+        report['batches'] = uploaded['batches']
+        report['failed'] = uploaded['failed']
+
+        start = time.perf_counter()
+        report.update(await client.train(**training))
+        report['train_s'] = time.perf_counter() - start
+
+        if publish:
+            start = time.perf_counter()
+            published = await client.publish(slot)
+            report['publish_s'] = time.perf_counter() - start
+            report['endpoint_url'] = published.get('endpointUrl')
+
+        report.update(client.stats)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data", help="Utterance file, in the *_luis_utterances.json format")
+    parser.add_argument("--version", default=app_version, help="App version to train and publish")
+    parser.add_argument("--slot", default=slot, choices=["staging", "production"])
+    parser.add_argument("--concurrency", type=int, default=4, help="Example batches uploaded at once")
+    parser.add_argument("--rate", type=float, default=default_rate, help="Maximum requests started per second")
+    parser.add_argument("--poll-delay", type=float, default=1.0, help="Seconds before the first training status poll")
+    parser.add_argument("--max-poll-delay", type=float, default=10.0, help="Maximum seconds between two polls")
+    parser.add_argument("--training-timeout", type=float, default=1800.0)
+    parser.add_argument("--no-publish", action="store_true", help="Only upload the examples and train")
+    args = parser.parse_args(argv)
+
+    if not authoring_endpoint or not app_id:
+        parser.error("LUIS_AUTHORING_ENDPOINT and LUIS_APP_ID must be set")
+
+    examples = [to_example(*utterance) for utterance in dataset.iter_utterances(args.data)]
+    report = asyncio.run(deploy(examples, version=args.version, slot=args.slot, concurrency=args.concurrency,
+        rate=args.rate, publish=not args.no_publish, initial_delay=args.poll_delay, max_delay=args.max_poll_delay,
+        timeout=args.training_timeout))
+    print(json.dumps(report, indent=2))
+
+    #Refused examples are missing from the trained version
+    return 0 if not report['failed'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
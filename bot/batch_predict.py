@@ -0,0 +1,156 @@
+"""
+  Batch prediction of an utterance file through an extractor backend, by a pool of concurrent workers.
+
+  Predictions are appended to a JSON lines file as they complete, one {"index", "text", "prediction",
+  "latency_ms"} record per utterance, index being its position in the utterance file. The output is the
+  checkpoint: an interrupted run started again skips the utterances already predicted, and failed
+  utterances are not written so that the next run predicts them again.
+
+  python batch_predict.py ../train_luis_utterances.json --backend luis --concurrency 16 --rate 50 \
+      --output train_predictions.jsonl
+
+  The luis backends also go through the request scheduler of the luis module (LUIS_RATE_LIMIT...).
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+import dataset
+import extractors
+import luis
+from request_scheduler import RequestScheduler
+
+
+def read_checkpoint(path):
+    #Indexes already predicted. A last line cut by an interruption is removed, to append after it.
+    done = set()
+    if not os.path.exists(path):
+        return done
+
+    with open(path, 'rb+') as file:
+        complete = 0
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break
+            if not line.endswith(b"\n"):
+                break
+            done.add(record['index'])
+            complete += len(line)
+        file.truncate(complete)
+    return done
+
+
+class BatchPredictor:
+    """
+      Streams the utterances of a file to concurrency workers calling backend, rate requests per second
+      at most, and appends the predictions to the output file, flushed every checkpoint_every records.
+      The run stops early once max_errors utterances failed.
+    """
+
+    def __init__(self, backend, concurrency: int=8, rate: float=None, checkpoint_every: int=100,
+        max_errors: int=100):
+        self.backend = backend
+        self.concurrency = concurrency
+        #Identical texts in flight share a call
+        self.scheduler = RequestScheduler(max_concurrency=concurrency, rate=rate, max_queue=concurrency,
+            max_wait=None)
+        self.checkpoint_every = checkpoint_every
+        self.max_errors = max_errors
+        self.stats = {'predicted': 0, 'skipped': 0, 'failed': 0}
+        self.errors = Counter()
+
+    async def predict(self, index, text, output):
+        start = time.perf_counter()
+        try:
+            resp = await self.scheduler.run(text, lambda: self.backend(text))
+        except Exception as error:
+            self.stats['failed'] += 1
+            self.errors[getattr(error, 'reason', type(error).__name__)] += 1
+            return
+        latency = time.perf_counter() - start
+
+        output.write(json.dumps({'index': index, 'text': text, 'prediction': resp['prediction'],
+            'latency_ms': round(1000 * latency, 3)}) + "\n")
+        self.stats['predicted'] += 1
+        if self.stats['predicted'] % self.checkpoint_every == 0:
+            output.flush()
+
+    async def worker(self, queue, output):
+        while True:
+            item = await queue.get()
+            try:
+                if item is None:
+                    return
+                if self.stats['failed'] < self.max_errors:
+                    await self.predict(*item, output)
+            finally:
+                queue.task_done()
+
+    async def run(self, path, output_path, limit=None):
+        done = read_checkpoint(output_path)
+        #Bounded, so that the file is read as the workers progress
+        queue = asyncio.Queue(maxsize=2 * self.concurrency)
+
+        start = time.perf_counter()
+        with open(output_path, 'a', encoding='utf-8') as output:
+            workers = [asyncio.ensure_future(self.worker(queue, output)) for _ in range(self.concurrency)]
+            try:
+                for index, (text, _, _) in enumerate(dataset.iter_utterances(path)):
+                    if (limit is not None and index >= limit) or self.stats['failed'] >= self.max_errors:
+                        break
+                    if index in done:
+                        self.stats['skipped'] += 1
+                        continue
+                    await queue.put((index, text))
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in workers:
+                    task.cancel()
+        elapsed = time.perf_counter() - start
+
+        return {**self.stats, 'errors': dict(self.errors), 'elapsed_s': elapsed,
+            'utterances_per_s': self.stats['predicted'] / elapsed if elapsed else 0.0,
+            'complete': self.stats['failed'] == 0}
+
+
+async def run_batch(path, output_path, backend_name, concurrency, rate=None, limit=None, max_errors=100):
+    predictor = BatchPredictor(extractors.get_backend(backend_name), concurrency, rate, max_errors=max_errors)
+    try:
+        return await predictor.run(path, output_path, limit)
+    finally:
+        await luis.close_session()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data", help="Utterance file, in the *_luis_utterances.json format")
+    parser.add_argument("--output", required=True, help="JSON lines file of the predictions, resumed if it exists")
+    parser.add_argument("--backend", default="luis", choices=sorted(extractors.backends))
+    parser.add_argument("--concurrency", type=int, default=8, help="Predictions in flight")
+    parser.add_argument("--rate", type=float, default=None, help="Maximum predictions started per second")
+    parser.add_argument("--limit", type=int, default=None, help="Only predict the first N utterances")
+    parser.add_argument("--max-errors", type=int, default=100, help="Stop after this many failed utterances")
+    parser.add_argument("--restart", action="store_true", help="Discard the predictions of a previous run")
+    args = parser.parse_args(argv)
+
+    if args.restart and os.path.exists(args.output):
+        os.remove(args.output)
+
+    report = asyncio.run(run_batch(args.data, args.output, args.backend, args.concurrency, args.rate,
+        args.limit, args.max_errors))
+    print(json.dumps(report, indent=2))
+
+    #Failed utterances are predicted by the next run
+    return 0 if report['complete'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import numpy as np
+
+
+def latency_summary(latencies):
+    #Latencies are given in seconds and reported in milliseconds
+    if len(latencies) == 0:
+        return {'count': 0}
+    ms = np.asarray(latencies) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    return {'count': int(len(ms)), 'mean_ms': float(ms.mean()), 'p50_ms': float(p50),
+        'p95_ms': float(p95), 'p99_ms': float(p99), 'max_ms': float(ms.max())}
@@ -0,0 +1,123 @@
+"""
+  Replays the labelled test utterances against an extractor backend and reports span-level
+  precision, recall and F1 per entity, along with latency percentiles and throughput.
+
+  python -m benchmarks.accuracy --backend local --output accuracy.json --min-f1 0.75
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+import dataset
+import extractors
+import luis
+from benchmarks import latency_summary
+
+
+def score_spans(pairs):
+    #pairs is an iterable of (gold spans, predicted spans), spans being (entity, start, end)
+    counts = {ent: {'tp': 0, 'fp': 0, 'fn': 0} for ent in luis.relevant_entities}
+    for gold, predicted in pairs:
+        gold = {s for s in gold if s[0] in counts}
+        predicted = {s for s in predicted if s[0] in counts}
+        for ent, _, _ in gold & predicted:
+            counts[ent]['tp'] += 1
+        for ent, _, _ in predicted - gold:
+            counts[ent]['fp'] += 1
+        for ent, _, _ in gold - predicted:
+            counts[ent]['fn'] += 1
+
+    total = {k: sum(c[k] for c in counts.values()) for k in ('tp', 'fp', 'fn')}
+    scores = {ent: with_ratios(c) for ent, c in counts.items()}
+    scores['micro'] = with_ratios(total)
+    return scores
+
+
+def with_ratios(counts):
+    tp, fp, fn = counts['tp'], counts['fp'], counts['fn']
+    precision = tp / (tp + fp) if tp + fp else 0.0
+    recall = tp / (tp + fn) if tp + fn else 0.0
+    f1 = 2 * precision * recall / (precision + recall) if precision + recall else 0.0
+    return {**counts, 'precision': precision, 'recall': recall, 'f1': f1}
+
+
+async def replay(backend, utterances, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = [None] * len(utterances)
+    pairs = [None] * len(utterances)
+    errors = 0
+
+    async def run(i, text, spans):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                resp = await backend(text)
+            except Exception:
+                resp = {}
+            latencies[i] = time.perf_counter() - start
+        #Error and throttling responses carry no prediction
+        if 'prediction' not in resp:
+            errors += 1
+        pairs[i] = (set(spans), extractors.get_spans(resp))
+
+    start = time.perf_counter()
+    await asyncio.gather(*[run(i, text, spans) for i, (text, _, spans) in enumerate(utterances)])
+    elapsed = time.perf_counter() - start
+
+    return {'utterances': len(utterances), 'errors': errors, 'elapsed_s': elapsed,
+        'utterances_per_s': len(utterances) / elapsed if elapsed else 0.0,
+        'latency': latency_summary(latencies), 'scores': score_spans(pairs)}
+
+
+async def run_benchmark(backend_name, paths, concurrency=1, limit=None):
+    backend = extractors.get_backend(backend_name)
+    report = {'backend': backend_name, 'concurrency': concurrency, 'files': {}}
+    try:
+        #Warm-up call so that model loading or connection setup is not measured
+        await backend("warm up")
+        for path in paths:
+            utterances = dataset.load_utterances(path)[:limit]
+            report['files'][os.path.basename(path)] = await replay(backend, utterances, concurrency)
+    finally:
+        await luis.close_session()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", default="local", choices=sorted(extractors.backends))
+    parser.add_argument("--data", nargs="+", default=[dataset.test_path, dataset.test_red_path])
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--limit", type=int, default=None, help="Only replay the first N utterances of each file")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--min-f1", type=float, help="Exit with an error if a file's micro F1 is below this value")
+    parser.add_argument("--max-p99-ms", type=float, help="Exit with an error if a file's p99 latency is above this value")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.backend, args.data, args.concurrency, args.limit))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    #Regression gates
+    failures = []
+    for name, result in report['files'].items():
+        if args.min_f1 is not None and result['scores']['micro']['f1'] < args.min_f1:
+            failures.append(f"{name}: micro F1 {result['scores']['micro']['f1']:.3f} < {args.min_f1}")
+        if args.max_p99_ms is not None and result['latency'].get('p99_ms', 0) > args.max_p99_ms:
+            failures.append(f"{name}: p99 {result['latency']['p99_ms']:.2f} ms > {args.max_p99_ms}")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
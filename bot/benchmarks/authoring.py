@@ -0,0 +1,76 @@
+"""
+  Deployment benchmark: uploads the train utterances to a local stand-in of the authoring API, trains and
+  publishes the app, as the notebook did (serial batches, training status polled every 10 seconds) and
+  with the authoring module (concurrent batches, exponential backoff polling), and reports the duration of
+  each step.
+
+  The stand-in answers every request after --latency and trains a version in --train-time seconds, the
+  defaults being in the range of the LUIS authoring API.
+
+  python -m benchmarks.authoring --latency lognormal:800:0.3 --train-time 45 --concurrency 4 --rate 5
+"""
+import argparse
+import asyncio
+import json
+import sys
+
+from aiohttp import web
+
+import authoring
+import dataset
+import luis_standin
+
+
+#Settings of the feed_utterances and train_app cells of Notebook.ipynb
+notebook = {'concurrency': 1, 'rate': None, 'initial_delay': 10.0, 'max_delay': 10.0, 'factor': 1.0}
+
+
+async def run_benchmark(path, latency, train_time, concurrency, rate, limit=None):
+    examples = [authoring.to_example(*u) for u in dataset.load_utterances(path)[:limit]]
+    report = {'examples': len(examples), 'latency': latency, 'train_time_s': train_time}
+
+    runs = {'notebook': notebook, 'authoring': {'concurrency': concurrency, 'rate': rate}}
+    for name, options in runs.items():
+        #A new stand-in for every run, so that both train the same examples
+        runner = web.AppRunner(luis_standin.create_app(data=[], fallback="empty", latency=latency,
+            train_time=train_time))
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        try:
+            endpoint = "http://127.0.0.1:%d/" % runner.addresses[0][1]
+            result = await authoring.deploy(examples, endpoint, "key", "flybot", **options)
+        finally:
+            await runner.cleanup()
+        result['total_s'] = result['upload_s'] + result['train_s'] + result['publish_s']
+        report[name] = {key: value for key, value in result.items() if key not in ('failed', 'endpoint_url')}
+
+    report['speedup'] = report['notebook']['total_s'] / report['authoring']['total_s']
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data", default=dataset.train_path, help="Utterance file to upload")
+    parser.add_argument("--limit", type=int, default=None, help="Only upload the first N utterances")
+    parser.add_argument("--latency", default="lognormal:800:0.3", help="Latency of the authoring requests")
+    parser.add_argument("--train-time", type=float, default=45.0, help="Seconds taken by a training")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--rate", type=float, default=authoring.default_rate)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.data, args.latency, args.train_time, args.concurrency, args.rate,
+        args.limit))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+"""
+  Cold start benchmark: starts app.py in a fresh process and measures the time until it listens,
+  the time to the first response of a conversation and the first entity extraction, over several runs.
+
+  python -m benchmarks.cold_start --runs 5 --output cold_start.json --max-first-response-ms 4000
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+
+import aiohttp
+import numpy as np
+
+from benchmarks.load import LoadTest
+
+bot_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_listening(port, process, timeout):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"app.py exited with code {process.returncode}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.005)
+    raise TimeoutError(f"app.py was not listening after {timeout} s")
+
+
+async def measure_import(env):
+    #Import time of the app module alone, in a fresh interpreter
+    code = "import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)"
+    process = await asyncio.create_subprocess_exec(sys.executable, "-c", code, cwd=bot_dir, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    stdout, _ = await process.communicate()
+    return float(stdout.decode().strip().splitlines()[-1])
+
+
+async def cold_start(env, timeout):
+    port = free_port()
+    load_test = LoadTest(f"http://127.0.0.1:{port}/api/messages", scenario=None)
+    runner = await load_test.start_connector()
+
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, "app.py"], cwd=bot_dir, env={**env, 'PORT': str(port)},
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        await wait_listening(port, process, timeout)
+        listening = time.perf_counter() - start
+
+        async with aiohttp.ClientSession() as session:
+            conversation = str(uuid.uuid4())
+            turn_start = time.perf_counter()
+            step = await load_test.send(session, conversation, "user", "hi", "greeting")
+            first_response = time.perf_counter() - start
+            first_turn = time.perf_counter() - turn_start
+
+            #The first booking request loads the entity extraction backend
+            turn_start = time.perf_counter()
+            await load_test.send(session, conversation, "user", "i want to fly from paris to osaka", step)
+            first_extraction = time.perf_counter() - turn_start
+
+            #Same turns in a new conversation, once everything is warm
+            conversation = str(uuid.uuid4())
+            turn_start = time.perf_counter()
+            await load_test.send(session, conversation, "user", "hi", "greeting")
+            warm_turn = time.perf_counter() - turn_start
+            turn_start = time.perf_counter()
+            await load_test.send(session, conversation, "user", "i want to fly from paris to osaka", step)
+            warm_extraction = time.perf_counter() - turn_start
+    finally:
+        process.terminate()
+        process.wait()
+        await runner.cleanup()
+
+    if step != "request":
+        raise RuntimeError(f"Unexpected first reply step '{step}'")
+    return {'listening': listening, 'first_response': first_response, 'first_turn': first_turn,
+        'first_extraction': first_extraction, 'warm_turn': warm_turn, 'warm_extraction': warm_extraction}
+
+
+def summary(values):
+    ms = np.asarray(values) * 1000
+    return {'mean_ms': float(ms.mean()), 'min_ms': float(ms.min()), 'max_ms': float(ms.max())}
+
+
+async def run_benchmark(runs, timeout=60):
+    env = dict(os.environ)
+    results = {'import': [await measure_import(env) for _ in range(runs)]}
+    for _ in range(runs):
+        for name, value in (await cold_start(env, timeout)).items():
+            results.setdefault(name, []).append(value)
+    return {'runs': runs, 'entity_backend': env.get('ENTITY_BACKEND', 'luis'),
+        **{name: summary(values) for name, values in results.items()}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for app.py to listen")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--max-first-response-ms", type=float,
+        help="Exit with an error if the mean time to first response is above this value")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.runs, args.timeout))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    #Regression gate
+    if args.max_first_response_ms is not None and report['first_response']['mean_ms'] > args.max_first_response_ms:
+        print(f"first response {report['first_response']['mean_ms']:.0f} ms > {args.max_first_response_ms}",
+            file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
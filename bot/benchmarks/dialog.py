@@ -0,0 +1,158 @@
+"""
+  Dialog engine benchmark: runs the same scripted conversations through the UserProfileDialog waterfall
+  and the SlotFillingDialog, checks that the users get the same replies and reports the dialog steps run,
+  the serialized conversation state size, the size of the state of the dialog itself (below the pending
+  prompt, whose options are the same for both) and the latency of every turn.
+
+  Entity extraction is scripted, so that only the dialogs are measured.
+
+  python -m benchmarks.dialog --conversations 200
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+from collections import defaultdict
+
+import numpy as np
+from botbuilder.core import ConversationState, MemoryStorage, UserState
+from botbuilder.core.adapters import TestAdapter
+
+import extractors
+import insights
+import luis
+from benchmarks import latency_summary
+from bots import DialogBot
+from dialogs import SlotFillingDialog, UserProfileDialog
+from storage.sqlite_storage import serialize
+
+
+dialogs = {'waterfall': UserProfileDialog, 'slot_filling': SlotFillingDialog}
+
+#Booking requests and the entities predicted for them
+predictions = {
+    "fly from paris to osaka on may 1 and back on may 9 for 2000 dollars": {'or_city': "paris",
+        'dst_city': "osaka", 'str_date': "may 1", 'end_date': "may 9", 'budget': "2000 dollars"},
+    "from dublin to lima": {'or_city': "dublin", 'dst_city': "lima"},
+    "leaving june 3, back june 20, 900 euros max": {'str_date': "june 3", 'end_date': "june 20",
+        'budget': "900 euros"},
+    "june 3": {'str_date': "june 3"},
+    "hello there": {},
+}
+
+full_request = "fly from paris to osaka on may 1 and back on may 9 for 2000 dollars"
+
+#User turns of each conversation
+scenarios = {
+    'complete': ["hi", full_request, "yes", "yes", "5"],
+    'second_request': ["hi", "from dublin to lima", "yes", "leaving june 3, back june 20, 900 euros max", "yes",
+        "yes", "4"],
+    'manual': ["hi", "hello there", "hello there", "tokyo", "rome", "july 1", "july 9", "1500", "no", "3"],
+    'correction': ["hi", full_request, "no", "Multiple Fields", full_request, "yes", "yes", "5"],
+    'partial_manual': ["hi", "from dublin to lima", "no", "Destination City", "june 3", "yes", "lima", "june 20",
+        "800", "yes", "2"],
+}
+
+
+async def scripted_entities(query, timeout=None, use_cache=True):
+    spans = [(ent, query.index(value), query.index(value) + len(value), 1.0)
+        for ent, value in predictions.get(query, {}).items()]
+    return extractors.build_response(query, spans)
+
+
+def dialog_state(conversation_state):
+    #State of the dialog waiting for the prompt, at the bottom of the component dialog stack
+    stack = conversation_state['DialogState'].dialog_stack
+    if not stack:
+        return {}
+    return stack[0].state['dialogs'].dialog_stack[-1].state
+
+
+async def run_conversation(dialog_class, texts, steps):
+    storage = MemoryStorage()
+    user_state = UserState(storage)
+    bot = DialogBot(ConversationState(storage), user_state, dialog_class(user_state))
+    adapter = TestAdapter(bot.on_turn)
+
+    turns = []
+    for text in texts:
+        steps.clear()
+        start = time.perf_counter()
+        await adapter.send(text)
+        elapsed = time.perf_counter() - start
+
+        replies = []
+        while adapter.activity_buffer:
+            replies.append(adapter.activity_buffer.pop(0).text)
+        state = [value for key, value in storage.memory.items() if "/conversations/" in key][0]
+        turns.append({'replies': replies, 'steps': len(steps), 'state_bytes': len(serialize(state)),
+            'dialog_state_bytes': len(serialize(dialog_state(state))), 'latency': elapsed,
+            'items': dict(storage.memory)})
+    return turns
+
+
+async def run_benchmark(conversations):
+    #Step executions are counted through the step latency recording of the timed steps
+    steps = []
+    save_step_latency = insights.save_step_latency
+    get_entities = luis.get_entities
+    insights.save_step_latency = lambda name, seconds: steps.append(name)
+    luis.get_entities = scripted_entities
+
+    results = {name: defaultdict(list) for name in dialogs}
+    mismatches = []
+    try:
+        for scenario, texts in scenarios.items():
+            replies = {}
+            for name, dialog_class in dialogs.items():
+                for _ in range(conversations):
+                    turns = await run_conversation(dialog_class, texts, steps)
+                    for key in ('steps', 'state_bytes', 'dialog_state_bytes', 'latency'):
+                        results[name][key].extend(turn[key] for turn in turns)
+                replies[name] = [turn['replies'] for turn in turns]
+            if replies['waterfall'] != replies['slot_filling']:
+                mismatches.append(scenario)
+    finally:
+        insights.save_step_latency = save_step_latency
+        luis.get_entities = get_entities
+
+    report = {'conversations': conversations * len(scenarios), 'scenarios': list(scenarios),
+        'same_replies': not mismatches, 'mismatches': mismatches}
+    for name, values in results.items():
+        report[name] = {
+            'turns': len(values['steps']),
+            'steps_per_turn': float(np.mean(values['steps'])),
+            'steps_per_conversation': float(np.sum(values['steps'])) / (conversations * len(scenarios)),
+            'state_bytes_mean': float(np.mean(values['state_bytes'])),
+            'state_bytes_max': int(np.max(values['state_bytes'])),
+            'dialog_state_bytes_mean': float(np.mean(values['dialog_state_bytes'])),
+            'dialog_state_bytes_max': int(np.max(values['dialog_state_bytes'])),
+            'latency': latency_summary(values['latency']),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=200, help="Conversations per scenario and dialog")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.conversations))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    if not report['same_replies']:
+        print(f"Different replies in {', '.join(report['mismatches'])}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
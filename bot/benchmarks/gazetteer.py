@@ -0,0 +1,108 @@
+"""
+  Fast path benchmark: builds the gazetteer from the train utterances and replays the test utterances
+  through it, reporting its hit rate (share of utterances answered without a remote prediction), the
+  accuracy of its answers against the labels, and the cost of a lookup in microseconds.
+
+  The utterances it answers are also replayed negated ("i can't ...") and with a year ("... in 2017"),
+  variants which must all be left to the remote model.
+
+  python -m benchmarks.gazetteer --output gazetteer.json --min-accuracy 0.95 --max-adversarial 0
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import dataset
+import gazetteer
+from benchmarks.accuracy import score_spans
+
+
+def lookup_summary(durations):
+    us = np.asarray(durations) * 1e6
+    p50, p99 = np.percentile(us, [50, 99]) if len(us) else (0.0, 0.0)
+    return {'count': int(len(us)), 'mean_us': float(us.mean()) if len(us) else 0.0, 'p50_us': float(p50),
+        'p99_us': float(p99)}
+
+
+#Variants of an answered utterance that the fast path must leave to the remote model
+adversarial_variants = ["i can't {}", "i cant {}", "i cannot {}", "we don't {}", "it doesnt matter, {}",
+    "{} in 2017", "{} in 1999", "not {}"]
+
+
+def replay(model, utterances, repeat=5):
+    hits = []
+    durations = {'hit': [], 'miss': []}
+    for text, _, spans in utterances:
+        #Best of a few lookups, to leave out the noise of the machine
+        best = float('inf')
+        for _ in range(repeat):
+            start = time.perf_counter()
+            resp = model.predict(text)
+            best = min(best, time.perf_counter() - start)
+        durations['hit' if resp is not None else 'miss'].append(best)
+        if resp is not None:
+            predicted = {(ent, start, end) for ent, start, end, _ in model.predict_spans(gazetteer.prepare_text(text))}
+            hits.append((set(spans), predicted))
+
+    #Utterances of which every entity can be extracted by the fast path
+    eligible = sum(1 for _, _, spans in utterances if spans and all(s[0] in ('budget',) + gazetteer.city_entities for s in spans))
+    exact = sum(gold == predicted for gold, predicted in hits)
+    answered = [text for text, _, _ in utterances if model.predict(text) is not None]
+    adversarial = [variant.format(text) for text in answered for variant in adversarial_variants]
+    adversarial_answered = [text for text in adversarial if model.predict(text) is not None]
+    return {'utterances': len(utterances), 'hits': len(hits), 'hit_rate': len(hits) / len(utterances),
+        'eligible': eligible, 'eligible_hit_rate': len(hits) / eligible if eligible else 0.0,
+        'exact_accuracy': exact / len(hits) if hits else 0.0,
+        'scores': score_spans(hits)['micro'],
+        'adversarial': len(adversarial), 'adversarial_answered': len(adversarial_answered),
+        'adversarial_examples': adversarial_answered[:10],
+        'lookup': {name: lookup_summary(values) for name, values in durations.items()}}
+
+
+def run_benchmark(train_path, paths, repeat=5):
+    start = time.perf_counter()
+    model = gazetteer.Gazetteer.build(dataset.load_utterances(train_path))
+    report = {'build_s': time.perf_counter() - start, 'cities': len(model.cities), 'fillers': len(model.fillers),
+        'cues': len(model.cues), 'automaton_states': len(model.automaton), 'files': {}}
+    for path in paths:
+        report['files'][os.path.basename(path)] = replay(model, dataset.load_utterances(path), repeat)
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--train", default=dataset.train_path, help="Utterance file the gazetteer is built from")
+    parser.add_argument("--data", nargs="+", default=[dataset.test_path])
+    parser.add_argument("--repeat", type=int, default=5, help="Lookups of each utterance, the fastest is kept")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    parser.add_argument("--min-accuracy", type=float, help="Exit with an error if a file's exact accuracy is below this value")
+    parser.add_argument("--max-adversarial", type=int,
+        help="Exit with an error if more negated or dated variants than this are answered")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.train, args.data, args.repeat)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+
+    failures = []
+    for name, result in report['files'].items():
+        if args.min_accuracy is not None and result['exact_accuracy'] < args.min_accuracy:
+            failures.append(f"{name}: exact accuracy {result['exact_accuracy']:.3f} < {args.min_accuracy}")
+        if args.max_adversarial is not None and result['adversarial_answered'] > args.max_adversarial:
+            failures.append(f"{name}: {result['adversarial_answered']} negated or dated variants answered")
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
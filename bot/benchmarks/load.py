@@ -0,0 +1,279 @@
+"""
+  Drives synthetic conversations through the /api/messages endpoint of a running bot, following the
+  UserProfileDialog flow, and reports per-turn latency percentiles, throughput, error rates and memory.
+
+  The bot replies through the Bot Connector API of the activity serviceUrl, so this tool also hosts
+  a minimal connector endpoint collecting the replies of each conversation.
+
+  python -m benchmarks.load --conversations 1000 --concurrency 100 --arrival-rate 50 --pid <bot pid>
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime, timezone
+
+import aiohttp
+from aiohttp import web
+
+import dataset
+from benchmarks import latency_summary
+
+
+#Bot prompts, matched in order against the replies of a turn, and the step they belong to
+prompts = [
+    ("encountered an error", "error"),
+    ("Welcome to FlyBot", "request"),
+    ("Do you confirm the information above", "confirm"),
+    ("Please select wrongly detected information", "correction"),
+    ("Please provide me with the information below", "second_request"),
+    ("Please tell me with your destination city", "destination"),
+    ("Please tell me your departure city", "origin"),
+    ("Please tell me your desired departure date", "start_date"),
+    ("Please tell me your desired return date", "end_date"),
+    ("Please tell me your maximum budget", "budget"),
+    ("Do you want me to book a flight for you", "summary"),
+    ("rate this bot", "rating"),
+    ("Please provide us a rating", "rating"),
+    ("Feel free to send a message to this Bot", "done"),
+]
+
+
+def get_step(replies):
+    #The prompt waiting for an answer is the last recognized reply of the turn
+    for text in reversed(replies):
+        for pattern, step in prompts:
+            if pattern in text:
+                return step
+    return None
+
+
+class Scenario:
+    """
+      Answers for the synthetic users, drawn from the labelled test utterances.
+    """
+
+    def __init__(self, path: str=dataset.test_path, seed: int=0, confirm_rate: float=0.7):
+        utterances = dataset.load_utterances(path)
+        self.requests = [text for text, intent, spans in utterances if intent == 'BookFlight']
+        self.values = defaultdict(list)
+        for text, _, spans in utterances:
+            for ent, start, end in spans:
+                self.values[ent].append(text[start:end])
+        self.rng = random.Random(seed)
+        self.confirm_rate = confirm_rate
+
+    def answer(self, step):
+        rng = self.rng
+        if step in ("request", "second_request"):
+            return rng.choice(self.requests)
+        if step == "confirm":
+            return "yes" if rng.random() < self.confirm_rate else "no"
+        if step == "correction":
+            return "Multiple Fields" if rng.random() < 0.3 else "1"
+        if step == "destination":
+            return rng.choice(self.values['dst_city'])
+        if step == "origin":
+            return rng.choice(self.values['or_city'])
+        if step == "start_date":
+            return rng.choice(self.values['str_date'])
+        if step == "end_date":
+            return rng.choice(self.values['end_date'])
+        if step == "budget":
+            return rng.choice(self.values['budget'])
+        if step == "summary":
+            return "yes"
+        if step == "rating":
+            return str(rng.randint(1, 5))
+        return "hi"
+
+
+class LoadTest:
+
+    def __init__(self, url: str, scenario: Scenario, max_turns: int=40, timeout: float=30):
+        self.url = url
+        self.scenario = scenario
+        self.max_turns = max_turns
+        self.timeout = timeout
+        self.service_url = None
+        self.replies = defaultdict(list)
+        self.latencies = defaultdict(list)
+        self.outcomes = Counter()
+        self.http_errors = Counter()
+        self.turns = 0
+
+    async def on_activity(self, request: web.Request) -> web.Response:
+        #Bot Connector API: replies and new activities posted by the bot
+        activity = await request.json()
+        if activity.get('type') == 'message':
+            self.replies[request.match_info['conversation_id']].append(activity.get('text') or '')
+        return web.json_response({'id': str(uuid.uuid4())})
+
+    async def start_connector(self, port=0):
+        app = web.Application()
+        app.router.add_post("/v3/conversations/{conversation_id}/activities", self.on_activity)
+        app.router.add_post("/v3/conversations/{conversation_id}/activities/{activity_id}", self.on_activity)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        self.service_url = "http://127.0.0.1:%d" % runner.addresses[0][1]
+        return runner
+
+    async def send(self, session, conversation_id, user_id, text, step):
+        activity = {
+            'type': 'message',
+            'id': str(uuid.uuid4()),
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'channelId': 'loadtest',
+            'serviceUrl': self.service_url,
+            'from': {'id': user_id, 'name': 'load test user'},
+            'recipient': {'id': 'bot', 'name': 'FlyBot'},
+            'conversation': {'id': conversation_id},
+            'text': text,
+        }
+        start = time.perf_counter()
+        async with session.post(self.url, json=activity) as response:
+            await response.read()
+            status = response.status
+        self.latencies[step].append(time.perf_counter() - start)
+        self.turns += 1
+        if status >= 400:
+            self.http_errors[status] += 1
+            return "http_error"
+
+        replies = self.replies.pop(conversation_id, [])
+        return get_step(replies)
+
+    async def conversation(self, session):
+        conversation_id = str(uuid.uuid4())
+        user_id = str(uuid.uuid4())
+        step = "greeting"
+        text = "hi"
+        try:
+            for _ in range(self.max_turns):
+                step = await asyncio.wait_for(self.send(session, conversation_id, user_id, text, step), self.timeout)
+                if step is None:
+                    self.outcomes['no_prompt'] += 1
+                    return
+                if step in ("done", "error", "http_error"):
+                    self.outcomes['completed' if step == "done" else step] += 1
+                    return
+                text = self.scenario.answer(step)
+            self.outcomes['too_many_turns'] += 1
+        except asyncio.TimeoutError:
+            self.outcomes['timeout'] += 1
+        except aiohttp.ClientError:
+            self.outcomes['connection_error'] += 1
+
+    async def run(self, conversations, concurrency, arrival_rate=None, pid=None, connector_port=0):
+        runner = await self.start_connector(connector_port)
+        memory = MemorySampler(pid)
+        semaphore = asyncio.Semaphore(concurrency)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+
+        async def limited(session):
+            async with semaphore:
+                await self.conversation(session)
+
+        sampler = asyncio.ensure_future(memory.run())
+        start = time.perf_counter()
+        try:
+            async with aiohttp.ClientSession(connector=connector) as session:
+                tasks = []
+                for _ in range(conversations):
+                    tasks.append(asyncio.ensure_future(limited(session)))
+                    #Poisson arrivals at the requested rate of new conversations per second
+                    if arrival_rate:
+                        await asyncio.sleep(self.scenario.rng.expovariate(arrival_rate))
+                await asyncio.gather(*tasks)
+        finally:
+            elapsed = time.perf_counter() - start
+            sampler.cancel()
+            await runner.cleanup()
+
+        all_latencies = [l for step in self.latencies.values() for l in step]
+        return {
+            'conversations': conversations,
+            'concurrency': concurrency,
+            'arrival_rate': arrival_rate,
+            'elapsed_s': elapsed,
+            'turns': self.turns,
+            'turns_per_s': self.turns / elapsed if elapsed else 0.0,
+            'conversations_per_s': conversations / elapsed if elapsed else 0.0,
+            'outcomes': dict(self.outcomes),
+            'error_rate': 1 - self.outcomes['completed'] / conversations if conversations else 0.0,
+            'http_errors': {str(k): v for k, v in self.http_errors.items()},
+            'latency': latency_summary(all_latencies),
+            'latency_by_step': {step: latency_summary(l) for step, l in self.latencies.items()},
+            'memory': memory.summary(),
+        }
+
+
+class MemorySampler:
+    """
+      Samples the resident memory of the bot process, when its pid is known.
+    """
+
+    def __init__(self, pid: int=None, interval: float=0.5):
+        self.process = None
+        self.interval = interval
+        self.samples = []
+        if pid is not None:
+            import psutil
+            self.process = psutil.Process(pid)
+            self.sample()
+
+    def sample(self):
+        self.samples.append(self.process.memory_info().rss)
+
+    async def run(self):
+        if self.process is None:
+            return
+        while True:
+            await asyncio.sleep(self.interval)
+            self.sample()
+
+    def summary(self):
+        if self.process is None:
+            return None
+        self.sample()
+        mb = 1024 * 1024
+        return {'start_rss_mb': self.samples[0] / mb, 'end_rss_mb': self.samples[-1] / mb,
+            'peak_rss_mb': max(self.samples) / mb, 'growth_mb': (self.samples[-1] - self.samples[0]) / mb}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:3978/api/messages")
+    parser.add_argument("--conversations", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20, help="Maximum number of simultaneous conversations")
+    parser.add_argument("--arrival-rate", type=float, default=None,
+        help="New conversations per second (Poisson), all at once if not set")
+    parser.add_argument("--confirm-rate", type=float, default=0.7, help="Share of confirmation prompts answered yes")
+    parser.add_argument("--pid", type=int, default=None, help="Bot process id, to report memory growth")
+    parser.add_argument("--connector-port", type=int, default=0, help="Port of the local Bot Connector endpoint")
+    parser.add_argument("--timeout", type=float, default=30, help="Per turn timeout in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    scenario = Scenario(seed=args.seed, confirm_rate=args.confirm_rate)
+    load_test = LoadTest(args.url, scenario, timeout=args.timeout)
+    report = asyncio.run(load_test.run(args.conversations, args.concurrency, args.arrival_rate,
+        args.pid, args.connector_port))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,130 @@
+"""
+  Stored state benchmark: bytes per conversation and serialize, deserialize and change detection hash
+  times of the conversation and user states, at a given number of stored conversations.
+
+  The states are the ones stored after every turn of the scripted conversations of benchmarks.dialog,
+  for the UserProfileDialog waterfall and the SlotFillingDialog, with the Bot Framework models
+  flattened in full (jsonpickle default) or in their compact form (storage.compact_models).
+  Every configuration is also written to a SQLite state storage, for its file size.
+
+  python -m benchmarks.state --conversations 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from botbuilder.core.bot_state import CachedBotState
+
+import luis
+from data_models import UserProfile
+from benchmarks import dialog as dialog_benchmark
+from storage import SqliteStorage, compact_models
+from storage.sqlite_storage import deserialize, serialize
+
+
+formats = ("full", "compact")
+
+
+async def sample_states(dialog_class):
+    #(conversation state, user state) pairs, as stored after each turn
+    get_entities = luis.get_entities
+    luis.get_entities = dialog_benchmark.scripted_entities
+    try:
+        states = []
+        for texts in dialog_benchmark.scenarios.values():
+            turns = await dialog_benchmark.run_conversation(dialog_class, texts, [])
+            for turn in turns:
+                items = turn['items']
+                conversation = [value for key, value in items.items() if "/conversations/" in key][0]
+                user = [value for key, value in items.items() if "/users/" in key]
+                states.append((conversation, user[0] if user else None))
+        return states
+    finally:
+        luis.get_entities = get_entities
+
+
+def timed(function, items):
+    start = time.perf_counter()
+    results = [function(item) for item in items]
+    return results, time.perf_counter() - start
+
+
+async def write_sqlite(path, rows, batch_size=1000):
+    storage = SqliteStorage(path)
+    try:
+        start = time.perf_counter()
+        for offset in range(0, len(rows), batch_size):
+            await storage.write({key: {**item, 'e_tag': "*"} for key, item in rows[offset:offset + batch_size]})
+        return time.perf_counter() - start
+    finally:
+        storage.close()
+
+
+async def measure(states, conversations, directory):
+    #Conversations cycle through the sample states, both scopes are stored for each of them
+    rows = []
+    for i in range(conversations):
+        conversation, user = states[i % len(states)]
+        rows.append((f"benchmark/conversations/{i}", conversation))
+        if user is not None:
+            rows.append((f"benchmark/users/{i}", user))
+    items = [item for _, item in rows]
+
+    data, serialize_s = timed(serialize, items)
+    _, deserialize_s = timed(lambda text: deserialize(text, 1), data)
+    _, hash_s = timed(lambda item: CachedBotState().compute_hash(item), items)
+
+    path = os.path.join(directory, f"state_{len(os.listdir(directory))}.db")
+    write_s = await write_sqlite(path, rows)
+
+    n_bytes = sum(len(text.encode("utf-8")) for text in data)
+    return {
+        'bytes_per_conversation': n_bytes / conversations,
+        'serialize_us': serialize_s / len(items) * 1e6,
+        'deserialize_us': deserialize_s / len(items) * 1e6,
+        'hash_us': hash_s / len(items) * 1e6,
+        'sqlite_write_s': write_s,
+        'sqlite_bytes_per_conversation': os.path.getsize(path) / conversations,
+    }
+
+
+async def run_benchmark(conversations):
+    report = {'conversations': conversations}
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            for name, dialog_class in dialog_benchmark.dialogs.items():
+                for state_format in formats:
+                    if state_format == "full":
+                        compact_models.unregister()
+                    else:
+                        compact_models.register(UserProfile)
+                    states = await sample_states(dialog_class)
+                    report[f"{name}_{state_format}"] = await measure(states, conversations, directory)
+        finally:
+            compact_models.unregister()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=100000, help="Stored conversations")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.conversations))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
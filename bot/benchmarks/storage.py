@@ -0,0 +1,111 @@
+"""
+  Storage latency benchmark of the SQLite state storage against MemoryStorage, using
+  conversation states shaped like the ones saved in the middle of a UserProfileDialog.
+
+  python -m benchmarks.storage --conversations 2000 --concurrency 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+from botbuilder.core import MemoryStorage
+from botbuilder.dialogs import DialogInstance, DialogState
+
+from benchmarks import latency_summary
+from data_models import UserProfile
+from storage import SqliteStorage
+
+
+def sample_state(i):
+    values = {'budget': None, 'dst_city': "osaka", 'or_city': "dublin", 'str_date': "august 25", 'end_date': None,
+        'n_entities': 3, 'entities': {'or_city': "dublin", 'dst_city': "osaka", 'str_date': "august 25"},
+        'query': f"yes hi. dublin to osaka on august 25 ({i})"}
+    stack = [
+        DialogInstance("TextPrompt", {'options': {'prompt': {'text': "Please tell me your maximum budget"}},
+            'state': {}}),
+        DialogInstance("WaterfallDialog", {'options': None, 'values': values, 'instanceId': str(i), 'stepIndex': 10}),
+        DialogInstance("UserProfileDialog", {'dialogs': {'dialogStack': []}}),
+    ]
+    return {'DialogState': DialogState(stack)}
+
+
+def user_state():
+    return {'UserProfile': UserProfile(dst_city="osaka", or_city="dublin", str_date="august 25",
+        end_date="september 5", budget="3200")}
+
+
+async def measure(storage, conversations, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    timings = {'write': [], 'read': [], 'turn': []}
+
+    async def timed(kind, coroutine):
+        start = time.perf_counter()
+        result = await coroutine
+        timings[kind].append(time.perf_counter() - start)
+        return result
+
+    async def turn(i):
+        #A turn reads both scopes, then writes back the changed conversation state
+        async with semaphore:
+            start = time.perf_counter()
+            key = f"benchmark/conversations/{i}"
+            items = await timed('read', storage.read([key, f"benchmark/users/{i}"]))
+            state = items.get(key) or sample_state(i)
+            await timed('write', storage.write({key: state}))
+            timings['turn'].append(time.perf_counter() - start)
+
+    #First turns create the items, second turns update them with their e_tag
+    start = time.perf_counter()
+    await asyncio.gather(*[storage.write({f"benchmark/users/{i}": user_state()}) for i in range(conversations)])
+    for _ in range(2):
+        await asyncio.gather(*[turn(i) for i in range(conversations)])
+    elapsed = time.perf_counter() - start
+
+    return {'elapsed_s': elapsed, 'turns_per_s': 2 * conversations / elapsed,
+        **{kind: latency_summary(values) for kind, values in timings.items()}}
+
+
+async def run_benchmark(conversations, concurrency, path=None):
+    report = {'conversations': conversations, 'concurrency': concurrency}
+    report['memory'] = await measure(MemoryStorage(), conversations, concurrency)
+
+    directory = None
+    if path is None:
+        directory = tempfile.TemporaryDirectory()
+        path = os.path.join(directory.name, "state.db")
+    storage = SqliteStorage(path)
+    try:
+        report['sqlite'] = await measure(storage, conversations, concurrency)
+        report['sqlite']['file_size_kb'] = os.path.getsize(path) / 1024
+    finally:
+        storage.close()
+        if directory is not None:
+            directory.cleanup()
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--conversations", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50, help="Simultaneous turns")
+    parser.add_argument("--path", help="SQLite database file, a temporary one is used if not set")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = asyncio.run(run_benchmark(args.conversations, args.concurrency, args.path))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""
+  Micro-benchmark of the telemetry cost of a confirmed turn: the per-metric recording done before
+  insights.save_turn_metrics (a measurement map and tag map per metric, one recording per detected
+  entity and a read-back of every view), against the single batched recording.
+
+  python -m benchmarks.telemetry --turns 5000 --entities 4
+"""
+import argparse
+import json
+import sys
+import time
+from datetime import datetime
+
+from opencensus.tags import tag_map as tag_map_module
+
+import insights
+from benchmarks import latency_summary
+
+
+def legacy_turn(n_entities):
+    #Request data: success count, read-back of the metrics and overall accuracy
+    mmap = insights.stats_recorder.new_measurement_map()
+    mmap.measure_int_put(insights.success_measure, 1)
+    mmap.record(tag_map_module.TagMap())
+    metrics = list(mmap.measure_to_view_map.get_metrics(datetime.utcnow()))
+    errors, successes = 1, 1
+    if len(metrics) > 1:
+        errors = metrics[0].time_series[0].points[0].value.value
+        successes = metrics[1].time_series[0].points[0].value.value
+    mmap_acc = insights.stats_recorder.new_measurement_map()
+    mmap_acc.measure_int_put(insights.accuracy_measure, int(100*successes / (errors+successes)))
+    mmap_acc.record(tag_map_module.TagMap())
+
+    #Detected entities, one recording each
+    mmap_entities = insights.stats_recorder.new_measurement_map()
+    tmap_entities = tag_map_module.TagMap()
+    for _ in range(n_entities):
+        mmap_entities.measure_int_put(insights.detected_measure, 1)
+        mmap_entities.record(tmap_entities)
+
+    #Entity accuracy
+    mmap_acc_ent = insights.stats_recorder.new_measurement_map()
+    mmap_acc_ent.measure_int_put(insights.entity_accuracy_measure, 100)
+    mmap_acc_ent.record(tag_map_module.TagMap())
+
+
+def batched_turn(n_entities):
+    insights.save_turn_metrics(success=True, detected=n_entities, entity_errors=0)
+
+
+def measure(turn, turns, n_entities):
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(turns):
+        turn_start = time.perf_counter()
+        turn(n_entities)
+        latencies.append(time.perf_counter() - turn_start)
+    elapsed = time.perf_counter() - start
+    return {'elapsed_s': elapsed, 'turns_per_s': turns / elapsed if elapsed else 0.0,
+        'latency': latency_summary(latencies)}
+
+
+def run_benchmark(turns, n_entities):
+    report = {'turns': turns, 'entities': n_entities}
+    #Warm-up so that every view has aggregation data before measuring
+    legacy_turn(n_entities)
+    batched_turn(n_entities)
+    report['legacy'] = measure(legacy_turn, turns, n_entities)
+    report['batched'] = measure(batched_turn, turns, n_entities)
+    report['speedup'] = report['legacy']['latency']['mean_ms'] / report['batched']['latency']['mean_ms']
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--turns", type=int, default=5000)
+    parser.add_argument("--entities", type=int, default=4, help="Detected entities per turn")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.turns, args.entities)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+"""
+  Training data generation benchmark: labels the user turns of a synthetic Frames-style corpus with the
+  notebook code (pandas json_normalize and iterrows, requires pandas) and with training_data, checks that
+  both give the same utterances and reports their durations, then times the whole generation of the
+  utterance files with 1 and several worker processes.
+
+  The dialogues are built from the labelled train utterances, with wizard turns, negated acts, flexible
+  (-1) values, dollar amounts and unrated or failed dialogues.
+
+  python -m benchmarks.training_data --dialogues 20000 --workers 4
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+
+import dataset
+import training_data
+
+
+def synthetic_dialogue(rng, utterances, turns=6):
+    dialogue_turns = []
+    for _ in range(turns):
+        text, _, spans = rng.choice(utterances)
+        args = [{'key': 'intent', 'val': 'book'}]
+        for ent, start, end in spans:
+            #-1 marks a flexible value, which is not labelled
+            args.append({'key': ent, 'val': "-1" if rng.random() < 0.05 else text[start:end].replace("€", "$")})
+        acts = [{'name': 'inform', 'args': args}]
+        if rng.random() < 0.1:
+            acts.append({'name': 'negate', 'args': [{'key': 'dst_city', 'val': "paris"}]})
+        if rng.random() < 0.1:
+            acts.append({'name': 'thankyou', 'args': []})
+        dialogue_turns.append({'text': text.replace("€", "$").capitalize(), 'labels': {'acts': acts,
+            'acts_without_refs': acts, 'active_frame': 1, 'frames': []}, 'author': 'user', 'timestamp': 0.0})
+        dialogue_turns.append({'text': "Sure, anything else?", 'labels': {'acts': [], 'acts_without_refs': [],
+            'active_frame': 1, 'frames': []}, 'author': 'wizard', 'timestamp': 0.0, 'db': {'result': [], 'search': []}})
+    return {'user_id': "U", 'wizard_id': "W", 'id': str(rng.getrandbits(64)), 'turns': dialogue_turns,
+        'labels': {'userSurveyRating': rng.choice([1.0, 3.0, 4.0, 5.0, 5.0]),
+            'wizardSurveyTaskSuccessful': rng.random() < 0.94}}
+
+
+def write_corpus(path, dialogues, seed=0):
+    rng = random.Random(seed)
+    utterances = dataset.load_utterances(dataset.train_path)
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump([synthetic_dialogue(rng, utterances) for _ in range(dialogues)], file)
+
+
+def notebook_utterances(turns):
+    #generate_luis_utterances of Notebook.ipynb, unchanged apart from its prints being silenced
+    import numpy as np
+    import pandas as pd
+
+    relevant_entities = training_data.relevant_entities
+    df = pd.DataFrame(turns, columns=['text', 'labels'])
+
+    utterances = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index, row in df.iterrows():
+            t = row['text'].replace("$","€").lower()
+            entities = []
+            for i in range(len(row['labels'])):
+                if not len(row['labels'][i]['args'])==0:
+                    if not row['labels'][i]['name'] == 'negate':
+                        x = pd.json_normalize(row['labels'][i]['args'])
+                        for ix, r in x.iterrows():
+                            if np.isin(r['key'], relevant_entities):
+                                if (r['val'] is not None) & (r['val'] != "-1"):
+                                    m = next((x for x in re.finditer(r'%s'%(r['val'].replace("$","€").lower()), t)),None)
+                                    if m:
+                                        span = m.span()
+                                        entities.append({'entityName': r['key'], 'startCharIndex': span[0], 'endCharIndex': span[1]})
+                                    else:
+                                        print('No valid match for text : ')
+                                        print(t)
+
+            if len(entities)==0:
+                utterances.append({'intentName': 'None', 'text': t, 'entityLabels':[]})
+            else:
+                utterances.append({'intentName': 'BookFlight', 'text': t, 'entityLabels': entities})
+    return utterances
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(dialogues, workers, reference_turns=5000):
+    report = {'dialogues': dialogues, 'workers': workers}
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = os.path.join(directory, "frames.json")
+        write_corpus(corpus, dialogues)
+        report['corpus_bytes'] = os.path.getsize(corpus)
+
+        turns = list(training_data.user_turns(training_data.select_dialogues(dataset.iter_records(corpus))))
+        report['user_turns'] = len(turns)
+
+        #Labelling only, on the first turns as the notebook code is slow
+        sample = turns[:reference_turns]
+        expected, notebook_s = timed(notebook_utterances, sample)
+        (labelled, _), port_s = timed(training_data.label_all, sample)
+        report['labelling'] = {'turns': len(sample), 'notebook_s': notebook_s, 'training_data_s': port_s,
+            'speedup': notebook_s / port_s if port_s else None,
+            'same_utterances': training_data.to_records(labelled) == expected}
+
+        #Whole generation, identical files whatever the number of workers
+        outputs = {}
+        for n in sorted({1, workers}):
+            output_dir = os.path.join(directory, f"workers_{n}")
+            os.makedirs(output_dir)
+            training_data.value_pattern.cache_clear()
+            counts, elapsed = timed(training_data.generate, corpus, output_dir, n)
+            report[f"generate_{n}_workers_s"] = elapsed
+            outputs[n] = {name: open(os.path.join(output_dir, name), 'rb').read() for name in sorted(os.listdir(output_dir))}
+        report['files'] = counts
+        report['same_files'] = all(files == outputs[1] for files in outputs.values())
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dialogues", type=int, default=20000, help="Dialogues of the synthetic corpus")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--reference-turns", type=int, default=5000, help="Turns labelled by the notebook code")
+    parser.add_argument("--output", help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args(argv)
+
+    report = run_benchmark(args.dialogues, args.workers, args.reference_turns)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output)
+    else:
+        print(output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,39 @@
 import pytest
+import json
+import asyncio
+import contextlib
 import insights
 import logging
+import time
 import luis
-import pandas as pd
-import numpy as np
+import dataset
+import local_model
+import extractors
+import batch_predict
+import authoring
+import training_data
+import luis_standin
+import gazetteer
+from aiohttp import web
+from storage import SqliteStorage, compact_models
+from storage.sqlite_storage import serialize, deserialize
+from botbuilder.core import MessageFactory
+from data_models import UserProfile, BookingValues
+from bots import DialogBot, SAVE_TIMINGS_KEY
+from dialogs import UserProfileDialog, SlotFillingDialog
+from luis import unavailable_text
+from botbuilder.core import ConversationState, MemoryStorage, UserState
+from botbuilder.core.adapters import TestAdapter
+from benchmarks.accuracy import score_spans
+from benchmarks import load
+from benchmarks import dialog as dialog_benchmark
+from prediction_cache import PredictionCache
+from request_scheduler import RequestScheduler
+from circuit_breaker import CircuitBreaker
+from log_queue import LogQueue
+from latency_summary import LatencySummaries, quantile
+from opencensus.metrics.export.metric_descriptor import MetricDescriptorType
+from accuracy_tracker import AccuracyTracker
 import os
 from opencensus.ext.azure.log_exporter import AzureLogHandler
 
@@ -39,17 +69,746 @@ def test_wrong_key():
 	with pytest.raises(ValueError):
 		configure_logger(wrong_instrument_key)
 
-def test_luis_query():
-	resp = luis.get_entities("I want to fly from Paris to Tokyo with a max budget of 123$")
+async def query_luis(query):
+	try:
+		return await luis.get_entities(query)
+	finally:
+		await luis.close_session()
 
-	entity_resp = pd.DataFrame.from_dict(resp['prediction'])[['entities']]
+def test_luis_query(monkeypatch):
+	#The gazetteer would answer this query without the prediction endpoint
+	monkeypatch.setattr(luis, 'fast_path', False)
+	resp = asyncio.run(query_luis("I want to fly from Paris to Tokyo with a max budget of 123$"))
 
-	entity_resp = entity_resp.loc[np.isin(entity_resp.index, relevant_entities)]
-	entity_resp['entities'] = entity_resp['entities'].apply(luis.get_first)
+	entity_resp = luis.extract_entities(resp)
 
-	assert entity_resp.to_dict()['entities']['or_city'] == "Paris"
-	assert entity_resp.to_dict()['entities']['dst_city'] == "Tokyo"
-	assert entity_resp.to_dict()['entities']['budget'] == "123$"
+	assert entity_resp['or_city'] == "Paris"
+	assert entity_resp['dst_city'] == "Tokyo"
+	assert entity_resp['budget'] == "123$"
 
 
-    
\ No newline at end of file
+    
+def test_prediction_cache():
+	now = [0]
+	cache = PredictionCache(maxsize=2, ttl=10, clock=lambda: now[0])
+
+	cache.put("Dublin to Osaka", {'query': "Dublin to Osaka"}, scope=('app', 'staging'))
+	assert cache.get("Dublin to Osaka", scope=('app', 'staging')) is not None
+	#The entity offsets of a response do not hold for other spellings of the utterance
+	assert cache.get("dublin  to osaka", scope=('app', 'staging')) is None
+
+	#Least recently used entries are evicted first
+	cache.put("a", {}, scope=('app', 'staging'))
+	cache.put("b", {}, scope=('app', 'staging'))
+	assert cache.get("Dublin to Osaka", scope=('app', 'staging')) is None
+
+	#Entries expire after the TTL
+	now[0] = 11
+	assert cache.get("b", scope=('app', 'staging')) is None
+
+	#Changing the slot clears the cache
+	cache.put("c", {}, scope=('app', 'staging'))
+	assert cache.get("c", scope=('app', 'production')) is None
+	assert cache.hits == 1
+
+def test_prediction_cache_copies(monkeypatch):
+	#Changing a returned prediction leaves the cached one as it was
+	monkeypatch.setattr(luis, 'cache', PredictionCache())
+	luis.cache.put("dublin to osaka", {'query': "dublin to osaka", 'prediction': {}}, scope=(luis.app_id, luis.slot))
+	first = asyncio.run(luis.get_prediction("dublin to osaka"))
+	first['prediction'] = None
+	assert asyncio.run(luis.get_prediction("dublin to osaka"))['prediction'] == {}
+
+async def schedule_requests(scheduler, keys, duration=0.02):
+	calls = []
+	running = [0, 0]
+
+	async def call(key):
+		calls.append(key)
+		running[0] += 1
+		running[1] = max(running)
+		await asyncio.sleep(duration)
+		running[0] -= 1
+		return key
+
+	start = time.perf_counter()
+	results = await asyncio.gather(*[scheduler.run(key, lambda key=key: call(key)) for key in keys],
+		return_exceptions=True)
+	return results, calls, running[1], time.perf_counter() - start
+
+def test_request_scheduler():
+	observed = []
+	scheduler = RequestScheduler(max_concurrency=2, observer=lambda *args: observed.append(args))
+	results, calls, max_running, _ = asyncio.run(schedule_requests(scheduler, ["a", "a", "b", "c", "d", "a"]))
+
+	#Identical requests in flight share a call, at most 2 calls at once
+	assert results == ["a", "a", "b", "c", "d", "a"]
+	assert sorted(calls) == ["a", "b", "c", "d"] and max_running == 2
+	assert scheduler.stats == {'sent': 4, 'coalesced': 2, 'rejected': 0, 'timed_out': 0}
+	assert [outcome for outcome, _, _ in observed].count('sent') == 4
+
+	#Bounded queue and wait
+	scheduler = RequestScheduler(max_concurrency=1, max_queue=2, max_wait=0.05)
+	results, calls, _, _ = asyncio.run(schedule_requests(scheduler, ["a", "b", "c"], duration=0.2))
+	assert results[0] == "a" and calls == ["a"]
+	assert isinstance(results[1], asyncio.TimeoutError) and isinstance(results[2], asyncio.QueueFull)
+
+	#Token bucket, 20 requests per second without burst
+	scheduler = RequestScheduler(max_concurrency=10, rate=20, burst=1)
+	results, _, _, elapsed = asyncio.run(schedule_requests(scheduler, ["a", "b", "c"], duration=0))
+	assert results == ["a", "b", "c"] and elapsed >= 0.09
+
+def test_extract_entities():
+	resp = {'query': "paris to tokyo", 'prediction': {'topIntent': 'BookFlight',
+		'entities': {'or_city': ["paris"], 'dst_city': ["tokyo", "osaka"], 'other': ["x"], '$instance': {}}}}
+
+	assert luis.extract_entities(resp) == {'or_city': "paris", 'dst_city': "tokyo"}
+
+def test_local_model():
+	utterances = dataset.load_utterances(dataset.train_path)[:500]
+	model = local_model.EntityModel().train(utterances, epochs=3)
+
+	text, _, spans = next(u for u in utterances if len(u[2]) > 1)
+	resp = model.predict(text)
+	instances = resp['prediction']['entities']['$instance']
+	predicted = {(ent, i['startIndex'], i['startIndex'] + i['length']) for ent, v in instances.items() for i in v}
+
+	assert resp['query'] == text
+	assert predicted == set(spans)
+	assert model.predict("")['prediction']['topIntent'] == 'None'
+
+def test_local_model_load(monkeypatch, tmp_path):
+	#Without a model file, concurrent first turns train a single model, off the event loop and without saving it
+	trained = []
+	def train(self, utterances, **options):
+		time.sleep(0.1)
+		trained.append(self)
+		return self
+	monkeypatch.setattr(local_model, 'model_path', str(tmp_path / "missing.npz"))
+	monkeypatch.setattr(local_model, '_model', None)
+	monkeypatch.setattr(local_model.EntityModel, 'train', train)
+	monkeypatch.setattr(local_model.EntityModel, 'predict', lambda self, query: {'query': query})
+
+	async def turns():
+		return await asyncio.gather(*(local_model.get_entities(f"query {i}") for i in range(4)))
+	responses = asyncio.run(turns())
+
+	assert len(trained) == 1
+	assert [r['query'] for r in responses] == [f"query {i}" for i in range(4)]
+	assert not os.listdir(tmp_path)
+
+def test_score_spans():
+	resp = {'query': "dublin to osaka", 'prediction': {'entities': {'or_city': ["dublin"], 'dst_city': ["to osaka"]}}}
+	predicted = extractors.get_spans(resp)
+	assert predicted == {('or_city', 0, 6), ('dst_city', 7, 15)}
+
+	scores = score_spans([({('or_city', 0, 6), ('dst_city', 10, 15)}, predicted)])
+	assert scores['or_city']['f1'] == 1
+	assert scores['dst_city']['fp'] == 1 and scores['dst_city']['fn'] == 1
+	assert scores['micro']['precision'] == 0.5
+
+@contextlib.asynccontextmanager
+async def running_standin(data=(), **options):
+	#LUIS stand-in served on a free local port, yields its endpoint
+	runner = web.AppRunner(luis_standin.create_app(data=list(data), fallback="empty", **options))
+	await runner.setup()
+	site = web.TCPSite(runner, "127.0.0.1", 0)
+	await site.start()
+	try:
+		yield "http://127.0.0.1:%d/" % runner.addresses[0][1]
+	finally:
+		await runner.cleanup()
+
+async def query_standin(queries, **options):
+	async with running_standin([dataset.test_red_path], **options) as standin_endpoint:
+		endpoint = luis.pred_endpoint
+		luis.pred_endpoint = standin_endpoint
+		try:
+			results = []
+			for q in queries:
+				try:
+					results.append(await luis.get_prediction(q, use_cache=False))
+				except luis.LuisUnavailable as error:
+					results.append(error)
+			return results
+		finally:
+			luis.pred_endpoint = endpoint
+			await luis.close_session()
+
+def test_luis_standin(monkeypatch):
+	text, _, spans = dataset.load_utterances(dataset.test_red_path)[2]
+	labelled, unknown = asyncio.run(query_standin([text.upper(), "hello there"]))
+
+	assert extractors.get_spans(labelled) == set(spans)
+	assert labelled['query'] == text.upper()
+	assert unknown['prediction']['entities'] == {}
+
+	monkeypatch.setattr(luis, 'breaker', CircuitBreaker())
+	monkeypatch.setattr(luis, 'retries', 0)
+	throttled, = asyncio.run(query_standin(["hello"], throttle_rate=1))
+	assert throttled.status == 429 and throttled.retry_after == 1
+
+def test_circuit_breaker():
+	now = [0.0]
+	states = []
+	breaker = CircuitBreaker(window=4, min_calls=4, slow_call=1.0, reset_timeout=10, observer=states.append,
+		clock=lambda: now[0])
+
+	#Opens once half of the last 4 calls failed
+	for success in [True, False, True]:
+		breaker.record(success, 0.1)
+	assert breaker.allow()
+	breaker.record(False, 0.1)
+	assert states == ["open"] and breaker.is_open() and not breaker.allow()
+
+	#A single trial call after the reset timeout, a slow one opens the breaker again
+	now[0] = 10.0
+	assert breaker.allow() and not breaker.allow() and not breaker.is_open()
+	breaker.record(True, 1.5)
+	now[0] = 20.0
+	assert breaker.allow()
+	breaker.record(True, 0.1)
+	assert states == ["open", "half_open", "open", "half_open", "closed"]
+
+	#Slow calls alone open it as well
+	for _ in range(4):
+		breaker.record(True, 1.5)
+	assert breaker.state == "open"
+
+def test_luis_resilience(monkeypatch):
+	def errors(reason):
+		data = insights.view_manager.get_view(insights.luis_errors_view.name).tag_value_aggregation_data_map.get((reason,))
+		return 0 if data is None else data.count_data
+
+	insights.init_telemetry()
+	monkeypatch.setattr(luis, 'breaker', CircuitBreaker(window=4, min_calls=4, reset_timeout=60))
+	monkeypatch.setattr(luis, 'retry_backoff', 0.01)
+
+	#Server errors are retried twice before giving up
+	status_errors = errors('status')
+	failed, = asyncio.run(query_standin(["hello"], error_rate=1))
+	assert failed.status == 500 and errors('status') == status_errors + 3
+	assert luis.breaker.state == "closed"
+
+	#The fourth failure opens the breaker, the retry is refused without a request
+	failed, = asyncio.run(query_standin(["hello"], error_rate=1))
+	assert failed.reason == 'short_circuited' and errors('status') == status_errors + 4
+	assert luis.breaker.is_open()
+
+	#Slow answers are given up at the deadline, which leaves no time for a retry
+	monkeypatch.setattr(luis, 'breaker', CircuitBreaker())
+	monkeypatch.setattr(luis, 'deadline', 0.2)
+	timeouts = errors('timeout')
+	failed, = asyncio.run(query_standin(["hello"], latency="fixed:1000"))
+	assert failed.reason == 'timeout' and errors('timeout') == timeouts + 1
+
+def test_corpus_cache(tmp_path):
+	records = [{'intentName': "BookFlight", 'text': "paris → tōkyō for 900€", 'entityLabels': [
+		{'entityName': "or_city", 'startCharIndex': 0, 'endCharIndex': 5},
+		{'entityName': "dst_city", 'startCharIndex': 8, 'endCharIndex': 13}]},
+		{'intent': "None", 'text': "hello", 'entities': []},
+		{'text': "to rome", 'entities': [{'entity': "dst_city", 'startPos': 3, 'endPos': 7}]}]
+	path = tmp_path / "utterances.json"
+	path.write_text(json.dumps(records), encoding='utf-8')
+	expected = [("paris → tōkyō for 900€", "BookFlight", [("or_city", 0, 5), ("dst_city", 8, 13)]),
+		("hello", "None", []), ("to rome", None, [("dst_city", 3, 7)])]
+
+	assert list(dataset.iter_records(path, chunk_size=5)) == records
+	corpus = dataset.open_corpus(path, tmp_path / "cache")
+	assert corpus.records() == expected and corpus[1:] == expected[1:] and corpus[0] == expected[0]
+	assert corpus.entities == ["or_city", "dst_city"] and corpus.span_starts.tolist() == [0, 8, 3]
+
+	#Rebuilt once the file changed
+	path.write_text(json.dumps(records[1:]), encoding='utf-8')
+	os.utime(path, ns=(0, 0))
+	assert list(dataset.open_corpus(path, tmp_path / "cache")) == expected[1:]
+
+def frames_dialogue(rating, success, *turns):
+	return {'id': "d", 'labels': {'userSurveyRating': rating, 'wizardSurveyTaskSuccessful': success},
+		'turns': [{'author': author, 'text': text, 'labels': {'acts_without_refs': acts}} for author, text, acts in turns]}
+
+def test_training_data(tmp_path, monkeypatch):
+	inform = lambda *args: {'name': 'inform', 'args': [{'key': k, 'val': v} for k, v in args]}
+	dialogues = [
+		frames_dialogue(5.0, True,
+			("user", "From Paris to Lima, 1.5k$", [inform(('or_city', "paris"), ('dst_city', "lima"), ('budget', "1.5k$"))]),
+			("wizard", "Sure", [inform(('dst_city', "lima"))]),
+			("user", "Not Rome, flexible dates", [{'name': 'negate', 'args': [{'key': 'dst_city', 'val': "rome"}]},
+				inform(('str_date', "-1"), ('end_date', None), ('intent', "book"))]),
+			("user", "from paris to lima, 1.5k$", [inform(('or_city', "paris"))])),
+		frames_dialogue(2.0, True, ("user", "to Oslo", [inform(('dst_city', "oslo"))])),
+		#Second selected dialogue, at position 1 which is not a selected index: dropped by the notebook
+		frames_dialogue(4.0, True, ("user", "to Rome", [inform(('dst_city', "rome"))])),
+		frames_dialogue(4.0, True, ("user", "to Kyiv/Kiev", [inform(('dst_city', "kyiv/kiev"))])),
+	]
+	kept = list(training_data.select_dialogues(dialogues))
+	assert [d['turns'][0]['text'] for d in kept] == ["From Paris to Lima, 1.5k$", "to Kyiv/Kiev"]
+	assert len(list(training_data.select_dialogues(dialogues, positional=False))) == 3
+
+	#Values are searched as regular expressions in the normalized text, negated and flexible ones are ignored
+	utterances, unmatched = training_data.label_all(list(training_data.user_turns(kept)), workers=2, chunk_size=1)
+	assert utterances[0] == ("from paris to lima, 1.5k€", [('or_city', 5, 10), ('dst_city', 14, 18), ('budget', 20, 25)])
+	assert utterances[1] == ("not rome, flexible dates", []) and unmatched == 0
+	assert training_data.deduplicate(utterances) == [utterances[0], utterances[1], utterances[3]]
+
+	#Written as pandas did, with escaped slashes and non ASCII characters
+	path = tmp_path / "frames.json"
+	path.write_text(json.dumps(dialogues), encoding='utf-8')
+	counts = training_data.generate(path, tmp_path)
+	assert counts['user_turns'] == 4 and counts['train_luis_utterances.json'] == 3
+	train, test = [(tmp_path / name).read_text(encoding='utf-8') for name in ("train_luis_utterances.json",
+		"test_luis_utterances.json")]
+	assert train.startswith('[{"intentName":"BookFlight","text":"to kyiv\\/kiev","entityLabels":[{"entityName":"dst_city",')
+	assert '"text":"from paris to lima, 1.5k\\u20ac"' in test
+	#Read without a cache, as the file is outside of the data directory
+	monkeypatch.setattr(dataset, 'cache_dir', str(tmp_path / "cache"))
+	assert dataset.load_utterances(tmp_path / "test_luis_utterances_red.json") == [
+		("from paris to lima, 1.5k€", "BookFlight", [('or_city', 5, 10), ('dst_city', 14, 18), ('budget', 20, 25)])]
+	assert not (tmp_path / "cache").exists()
+
+def test_batch_predict(tmp_path, monkeypatch):
+	texts = [text for text, _, _ in dataset.load_utterances(dataset.test_red_path)[:6]]
+	calls = []
+
+	async def flaky(query):
+		calls.append(query)
+		if query == texts[2] and calls.count(query) == 1:
+			raise luis.LuisUnavailable("LUIS did not answer in time", 'timeout')
+		return extractors.build_response(query, [])
+
+	monkeypatch.setitem(extractors.backends, 'flaky', flaky)
+	output = tmp_path / "predictions.jsonl"
+
+	#Failed utterances are not checkpointed
+	report = asyncio.run(batch_predict.run_batch(dataset.test_red_path, str(output), 'flaky', 3, limit=6))
+	assert report['predicted'] == 5 and report['errors'] == {'timeout': 1} and not report['complete']
+
+	#A line cut by an interruption is dropped, the next run only predicts what is missing
+	with open(output, 'a') as file:
+		file.write('{"index": 5, "te')
+	report = asyncio.run(batch_predict.run_batch(dataset.test_red_path, str(output), 'flaky', 3, limit=6))
+	assert report['predicted'] == 1 and report['skipped'] == 5 and report['complete']
+	assert len(calls) == 7
+
+	with open(output) as file:
+		records = sorted((json.loads(line) for line in file), key=lambda record: record['index'])
+	assert [record['text'] for record in records] == texts
+
+async def deploy_standin(examples, **options):
+	async with running_standin(**options) as endpoint:
+		try:
+			report = await authoring.deploy(examples, endpoint, "key", "flybot", concurrency=3, rate=None,
+				initial_delay=0.05, max_delay=0.2)
+
+			#The published examples are answered by the prediction endpoint
+			luis.pred_endpoint = endpoint
+			text, _, spans = dataset.load_utterances(dataset.test_red_path)[7]
+			prediction = await luis.get_prediction(text, use_cache=False)
+			return report, extractors.get_spans(prediction) == set(spans)
+		finally:
+			await luis.close_session()
+
+def test_authoring(monkeypatch):
+	monkeypatch.setattr(luis, 'pred_endpoint', luis.pred_endpoint)
+	monkeypatch.setattr(luis, 'breaker', CircuitBreaker())
+	monkeypatch.setattr(luis, 'retries', 6)
+	monkeypatch.setattr(luis, 'retry_backoff', 0.01)
+	monkeypatch.setattr(authoring, 'retry_backoff', 0.01)
+	examples = [authoring.to_example(*u) for u in dataset.load_utterances(dataset.test_red_path)[:250]]
+	examples.append(authoring.to_example("too short", 'BookFlight', [('dst_city', 4, 20)]))
+
+	#Server errors are retried, refused examples reported
+	report, published = asyncio.run(deploy_standin(examples, train_time=0.3, error_rate=0.5))
+	assert report['batches'] == 3 and report['retries'] > 0
+	assert [text for text, _ in report['failed']] == ["too short"]
+	assert report['polls'] >= 2 and published
+
+	#Publishing an untrained version is refused without retries
+	async def publish_untrained():
+		async with running_standin() as endpoint:
+			async with authoring.AuthoringClient(endpoint, "key", "flybot") as client:
+				await client.publish()
+
+	with pytest.raises(authoring.AuthoringError) as error:
+		asyncio.run(publish_untrained())
+	assert error.value.status == 400 and not error.value.retryable
+
+def test_gazetteer(monkeypatch):
+	#Overlapping occurrences are all found
+	assert gazetteer.AhoCorasick(["he", "she", "his", "hers"]).find("ushers") == [(1, 4), (2, 4), (2, 6)]
+
+	model = gazetteer.get_gazetteer()
+	spans = model.predict_spans(gazetteer.prepare_text("Mexico City to Osaka, $3,200 max"))
+	assert [s[:3] for s in spans] == [('or_city', 0, 11), ('dst_city', 15, 20), ('budget', 22, 28)]
+
+	#Dates, negations, unknown or unexplained cities are left to LUIS
+	for query in ["dublin to osaka on august 12", "not to osaka", "to antonioo", "osaka", "hello"]:
+		assert model.predict(query) is None
+
+	#Years are not budgets, and negated requests are not answered
+	for query in ["dublin to osaka in 2017", "from paris to rome in 2018", "from paris to rome for 2018",
+		"i cant fly to rome", "i cannot go from dublin to osaka", "it doesnt matter, to rome", "i can't fly to rome"]:
+		assert model.predict(query) is None
+
+	#Amounts without a currency are only budgets next to a budget word
+	assert model.predict("dublin to osaka 3200") is None
+	assert [s[:3] for s in model.predict_spans("to osaka, budget is 3200")] == [('dst_city', 3, 8), ('budget', 20, 24)]
+
+	async def remote(query, timeout=None, use_cache=True):
+		calls.append(query)
+		return extractors.build_response(query, [])
+
+	calls = []
+	monkeypatch.setattr(luis, 'backend', 'luis')
+	monkeypatch.setattr(luis, 'fast_path', True)
+	monkeypatch.setattr(luis, 'get_prediction', remote)
+	resp = asyncio.run(luis.get_entities("from dublin to osaka"))
+	asyncio.run(luis.get_entities("from dublin to osaka tomorrow"))
+	assert luis.extract_entities(resp) == {'or_city': "dublin", 'dst_city': "osaka"}
+	assert calls == ["from dublin to osaka tomorrow"]
+
+def test_load_step_detection():
+	replies = ["Here is the retrieved information: \r\nDestination City : osaka \r\n", "Do you confirm the information above?"]
+
+	assert load.get_step(replies) == "confirm"
+	assert load.get_step(["Unable to retrieve all necessary information.", "Please tell me your departure city"]) == "origin"
+	assert load.get_step(["Thank you!"]) is None
+
+async def sqlite_roundtrip(path):
+	storage = SqliteStorage(path)
+	try:
+		state = {'UserProfile': UserProfile(dst_city="osaka", budget="3200")}
+		await storage.write({'conversation': state})
+		stored = (await storage.read(['conversation', 'missing']))
+
+		#A second writer holding an outdated e_tag is rejected
+		outdated = {'UserProfile': UserProfile(), 'e_tag': stored['conversation']['e_tag']}
+		await storage.write({'conversation': stored['conversation']})
+		with pytest.raises(KeyError):
+			await storage.write({'conversation': outdated})
+
+		await storage.delete(['conversation'])
+		deleted = await storage.read(['conversation'])
+
+		#An item read before its deletion is written again, despite its e_tag
+		await storage.write({'conversation': dict(stored['conversation'])})
+		assert (await storage.read(['conversation']))['conversation']['e_tag'] == "1"
+		return stored, deleted
+	finally:
+		storage.close()
+
+def test_sqlite_storage(tmp_path):
+	stored, deleted = asyncio.run(sqlite_roundtrip(str(tmp_path / "state.db")))
+
+	assert list(stored) == ['conversation']
+	#Written without an e_tag, then with the one it was read with
+	assert stored['conversation']['e_tag'] == "2"
+	assert stored['conversation']['UserProfile'].dst_city == "osaka"
+	assert deleted == {}
+
+def test_compact_state():
+	#Registered by the app along with the SQLite storage
+	compact_models.register(UserProfile)
+	try:
+		values = BookingValues()
+		values.dst_city, values.step, values.predicted = "osaka", "slot_step", ['dst_city']
+		state = {'UserProfile': UserProfile(dst_city="osaka", budget="3200"), 'values': values,
+			'prompt': MessageFactory.text("Please tell me your departure city")}
+		data = serialize(state)
+		restored = deserialize(data, 1)
+
+		#Fixed fields stored as lists of values, activities without their unset attributes
+		assert not hasattr(restored['UserProfile'], '__dict__')
+		assert '"py/state":["osaka",null,null,null,"3200"]' in data
+		assert 'attachments' not in data and len(data) < 600
+		assert restored['UserProfile'].budget == "3200" and restored['values'].predicted == ['dst_city']
+		assert restored['values'].step == "slot_step" and restored['values'].or_city is None
+		assert restored['prompt'].text == "Please tell me your departure city"
+		assert restored['prompt'].type == "message" and restored['prompt'].attachments is None
+
+		#Profiles stored before the fields were fixed
+		legacy = deserialize('{"UserProfile":{"py/object":"data_models.user_profile.UserProfile","n_entities":null,'
+			'"dst_city":"lima","or_city":null,"str_date":null,"end_date":null,"budget":null}}', 1)
+		assert legacy['UserProfile'].dst_city == "lima"
+	finally:
+		compact_models.unregister()
+
+class CountingStorage(MemoryStorage):
+	def __init__(self):
+		super().__init__()
+		self.writes = []
+
+	async def write(self, changes):
+		self.writes.append(list(changes))
+		await super().write(changes)
+
+async def run_dialog_turns(texts):
+	storage = CountingStorage()
+	user_state = UserState(storage)
+	bot = DialogBot(ConversationState(storage), user_state, UserProfileDialog(user_state))
+	timings = []
+
+	async def logic(context):
+		await bot.on_turn(context)
+		timings.append(context.turn_state[SAVE_TIMINGS_KEY])
+
+	adapter = TestAdapter(logic)
+	for text in texts:
+		await adapter.send(text)
+	return storage, timings
+
+def test_dialog_bot_saves_changed_state_only():
+	storage, timings = asyncio.run(run_dialog_turns(["hi"]))
+
+	#Only the dialog stack changed, the user state was never loaded
+	assert len(storage.writes) == 1 and storage.writes[0][0].endswith("/conversations/Convo1")
+	assert list(timings[0]) == ["conversation"]
+
+def test_slot_filling_dialog(monkeypatch):
+	steps = []
+	monkeypatch.setattr(luis, 'get_entities', dialog_benchmark.scripted_entities)
+	monkeypatch.setattr(insights, 'save_step_latency', lambda name, seconds: steps.append(name))
+
+	for texts in dialog_benchmark.scenarios.values():
+		waterfall = asyncio.run(dialog_benchmark.run_conversation(UserProfileDialog, texts, steps))
+		slot_filling = asyncio.run(dialog_benchmark.run_conversation(SlotFillingDialog, texts, steps))
+
+		#Same replies, with fewer steps and a smaller dialog state
+		assert [turn['replies'] for turn in slot_filling] == [turn['replies'] for turn in waterfall]
+		assert sum(turn['steps'] for turn in slot_filling) < sum(turn['steps'] for turn in waterfall)
+		assert (sum(turn['dialog_state_bytes'] for turn in slot_filling)
+			< sum(turn['dialog_state_bytes'] for turn in waterfall))
+
+def test_dialog_fallback(monkeypatch):
+	async def unavailable(query, timeout=None, use_cache=True):
+		raise luis.LuisUnavailable("LUIS did not answer in time", 'timeout')
+
+	manual = ["tokyo", "rome", "july 1", "july 9", "1500", "no", "3"]
+	monkeypatch.setattr(luis, 'get_entities', unavailable)
+	monkeypatch.setattr(luis, 'breaker', CircuitBreaker())
+	failed = {dialog: asyncio.run(dialog_benchmark.run_conversation(dialog, ["hi", "from dublin to lima"] + manual, []))
+		for dialog in (UserProfileDialog, SlotFillingDialog)}
+
+	#A failed prediction switches to the manual slot prompts
+	replies = [turn['replies'] for turn in failed[SlotFillingDialog]]
+	assert replies == [turn['replies'] for turn in failed[UserProfileDialog]]
+	assert replies[1] == [unavailable_text, "Please tell me with your destination city"]
+
+	#While the breaker is open, no booking request is asked for at all
+	monkeypatch.setattr(luis, 'breaker', CircuitBreaker(window=1, min_calls=1))
+	luis.breaker.record(False)
+	opened = {dialog: asyncio.run(dialog_benchmark.run_conversation(dialog, ["hi"] + manual, []))
+		for dialog in (UserProfileDialog, SlotFillingDialog)}
+
+	replies = [turn['replies'] for turn in opened[SlotFillingDialog]]
+	assert replies == [turn['replies'] for turn in opened[UserProfileDialog]]
+	assert replies[0] == ["Welcome to FlyBot!", unavailable_text, "Please tell me with your destination city"]
+	assert replies[1:] == [turn['replies'] for turn in failed[SlotFillingDialog]][2:]
+
+def test_save_turn_metrics():
+	errors = insights.get_count(insights.errors_view)
+	successes = insights.get_count(insights.success_view)
+	detected = insights.get_count(insights.detection_view)
+
+	insights.save_turn_metrics(success=True, detected=3, entity_errors=1)
+
+	#The detected entities are recorded as one summed measurement
+	assert insights.get_count(insights.detection_view) == detected + 3
+	assert insights.get_count(insights.success_view) == successes + 1
+	assert insights.get_count(insights.errors_view) == errors
+
+	accuracy = insights.view_manager.get_view("total_accuracy").tag_value_aggregation_data_map[()]
+	assert accuracy.value == int(100*insights.tracker.accuracy())
+	assert (insights.tracker.errors, insights.tracker.successes) == (errors, successes+1)
+	entity_accuracy = insights.view_manager.get_view("entity_accuracy").tag_value_aggregation_data_map[()]
+	assert entity_accuracy.value == 75
+
+class SlowHandler(logging.Handler):
+	def __init__(self):
+		super().__init__()
+		self.messages = []
+
+	def emit(self, record):
+		time.sleep(0.01)
+		self.messages.append(record.getMessage())
+
+def test_log_queue():
+	handler = SlowHandler()
+	queue = LogQueue([handler], capacity=5, batch_size=2, flush_interval=0.01)
+	logger = logging.getLogger("log_queue_test")
+	logger.propagate = False
+	logger.addHandler(queue)
+
+	#Nothing is handled until the listener starts, the oldest records are dropped
+	start = time.perf_counter()
+	for i in range(8):
+		logger.warning("record %d", i)
+	assert time.perf_counter() - start < 0.01
+	assert queue.stats['dropped'] == 3 and queue.pending() == 5
+
+	queue.start()
+	queue.stop()
+	logger.removeHandler(queue)
+	assert handler.messages == ["record %d" % i for i in range(3, 8)]
+	assert queue.stats['handled'] == 5
+
+	sampled = LogQueue([handler], capacity=10, overflow="sample", sample_rate=0.0)
+	for i in range(20):
+		sampled.handle(logging.makeLogRecord({'msg': "sampled"}))
+	assert sampled.pending() == 5 and sampled.stats['sampled_out'] == 15
+
+	#The handler lock is kept (logging.Handler.handle takes it from Python 3.13), filters still apply
+	assert sampled.lock is not None
+	sampled.addFilter(lambda record: record.getMessage() != "filtered")
+	assert not sampled.handle(logging.makeLogRecord({'msg': "filtered"}))
+	assert sampled.pending() == 5
+
+def test_accuracy_tracker():
+	now = [0.0]
+	tracker = AccuracyTracker(windows={'1m': 60, '1h': 3600}, clock=lambda: now[0])
+	assert tracker.accuracy() is None and tracker.accuracy('1m') is None
+
+	tracker.record_request(False)
+	tracker.record_entities(0, 1)
+	now[0] = 120.0
+	for success in (True, True, True, False):
+		tracker.record_request(success)
+	tracker.record_entities(3, 1)
+
+	#The first failure has left the last minute but not the last hour
+	assert tracker.accuracy() == 3 / 5 and tracker.accuracy('1h') == 3 / 5
+	assert tracker.accuracy('1m') == 3 / 4
+	assert tracker.entity_accuracy('1m') == 3 / 4 and tracker.entity_accuracy() == 3 / 5
+
+	#Buckets are recycled once the window has passed
+	now[0] = 4000.0
+	assert tracker.accuracy('1m') is None and tracker.accuracy('1h') is None
+	tracker.record_request(True)
+	assert tracker.accuracy('1h') == 1.0 and tracker.accuracy() == 4 / 6
+
+def test_prometheus_metrics(monkeypatch):
+	#The exporter renders the recordings made once it is registered, the rolling accuracies are not throttled
+	insights.init_telemetry()
+	exporter = insights.register_exporters(["prometheus"])['prometheus']
+	monkeypatch.setattr(insights, 'last_accuracy_publish', None)
+	exporter.render()
+	insights.save_turn_metrics(success=True, detected=2, entity_errors=0, dialog=True)
+	text = exporter.render()
+
+	dialogs = insights.get_count(insights.dialog_view)
+	assert f"flybot_number_dialogs_total {dialogs}\n" in text
+	assert "# TYPE flybot_total_accuracy gauge\n" in text
+	assert 'flybot_rolling_accuracy{window="1m"}' in text
+	assert "process_resident_memory_bytes" in text
+	#Unchanged views are served from the cached text
+	views = text.split("# HELP process_")[0]
+	assert exporter.render().startswith(views)
+
+def test_accuracy_publish(monkeypatch):
+	#A turn throttled after a publication is published at the end of the interval, the gauge does not freeze
+	def rolling_accuracy():
+		return insights.view_manager.get_view(insights.rolling_accuracy_view.name).tag_value_aggregation_data_map[('1m',)].value
+
+	monkeypatch.setattr(insights, 'tracker', AccuracyTracker())
+	monkeypatch.setattr(insights, 'accuracy_publish_interval', 0.2)
+	monkeypatch.setattr(insights, 'last_accuracy_publish', None)
+	insights.save_turn_metrics(success=True)
+	assert rolling_accuracy() == 100
+	insights.save_turn_metrics(success=False)
+	assert rolling_accuracy() == 100
+
+	time.sleep(0.4)
+	assert rolling_accuracy() == 50
+	assert insights.accuracy_publish_timer is None
+
+def test_latency_histograms():
+	def count(view, *tag_values):
+		data = insights.view_manager.get_view(view.name).tag_value_aggregation_data_map.get(tag_values)
+		return 0 if data is None else data.count_data
+
+	turns = count(insights.turn_latency_view)
+	steps = count(insights.step_latency_view, "initial_step")
+	saves = count(insights.save_latency_view, "conversation")
+
+	asyncio.run(run_dialog_turns(["hi"]))
+
+	assert count(insights.turn_latency_view) == turns + 1
+	assert count(insights.step_latency_view, "initial_step") == steps + 1
+	assert count(insights.save_latency_view, "conversation") == saves + 1
+
+	text = insights.register_exporters(["prometheus"])['prometheus'].render()
+	assert 'flybot_dialog_step_latency_bucket{step="initial_step",le="+Inf"}' in text
+
+def test_latency_summaries():
+	#Gauges of the recordings since the previous reading, for the exporters which drop distributions
+	insights.init_telemetry()
+	summaries = LatencySummaries(insights.view_manager, [insights.save_latency_view])
+	summaries.get_metrics()
+	for seconds in (0.002, 0.02, 0.02, 0.2):
+		insights.save_latency(insights.save_latency_measure, seconds, insights.get_tag_map(insights.scope_key, "summary"))
+
+	metrics = {m.descriptor.name: m for m in summaries.get_metrics()}
+	assert metrics['state_save_latency_mean'].descriptor.type == MetricDescriptorType.GAUGE_DOUBLE
+	gauges = {name: next(ts.points[0].value.value for ts in m.time_series if ts.label_values[0].value == "summary")
+		for name, m in metrics.items()}
+	assert gauges['state_save_latency_mean'] == pytest.approx(60.5)
+	assert 10 < gauges['state_save_latency_p50'] <= 25 and 100 < gauges['state_save_latency_p99'] <= 250
+	assert summaries.get_metrics() == []
+
+	assert quantile([10.0, 20.0], [0, 4, 0], 0.5) == 15.0
+	assert quantile([10.0, 20.0], [0, 0, 2], 0.99) == 20.0
+
+def test_create_app(tmp_path, monkeypatch):
+	import app
+
+	#Each worker builds its own application, on the shared SQLite state when configured
+	monkeypatch.setenv("BOT_STORAGE_PATH", str(tmp_path / "state.db"))
+	storage = app.create_storage()
+	assert isinstance(storage, SqliteStorage)
+	storage.close()
+
+	monkeypatch.delenv("BOT_STORAGE_PATH")
+	monkeypatch.setattr(insights, 'exporter_names', ["azure"])
+	application = asyncio.run(app.init_app())
+	assert application is not asyncio.run(app.init_app())
+	routes = lambda application: {resource.canonical for resource in application.router.resources()}
+	assert "/api/messages" in routes(application) and "/metrics" not in routes(application)
+
+	#The unauthenticated metrics endpoint is only served with the prometheus exporter
+	monkeypatch.setattr(insights, 'exporter_names', ["azure", "prometheus"])
+	assert "/metrics" in routes(app.create_app())
+
+def test_telemetry_errors(monkeypatch, caplog):
+	#Without a connection string the azure exporter is left out rather than failing every recording
+	monkeypatch.setattr(insights, 'insights_string', None)
+	monkeypatch.setattr(insights, 'exporters', {})
+	with caplog.at_level(logging.WARNING, logger="insights"):
+		assert insights.register_exporters(["azure"]) == {}
+	assert "azure telemetry exporter is disabled" in caplog.text
+	assert insights.azure_log_handlers() == []
+
+	#A failing recording is logged and does not break the turn
+	def broken():
+		raise ValueError("exporter down")
+	monkeypatch.setattr(insights, 'new_measurement_map', broken)
+	insights.save_turn_metrics(dialog=True)
+	insights.save_step_latency("initial_step", 0.01)
+	assert "Recording save_turn_metrics failed" in caplog.text
+
+def test_lazy_telemetry():
+	logger = insights.configure_logger()
+	assert insights.configure_logger() is logger
+	assert [type(handler) for handler in logger.handlers] == [LogQueue]
+
+	insights.init_telemetry()
+	exporters = dict(insights.exporters)
+	insights.init_telemetry()
+	assert insights.exporters == exporters
+	assert len(insights.view_manager.measure_to_view_map.exporters) == len(exporters)
+
+	#Handlers given as a function are created by the listener thread
+	handler = SlowHandler()
+	queue = LogQueue(lambda: [handler], flush_interval=0.01).start()
+	queue.handle(logging.makeLogRecord({'msg': "created lazily", 'levelno': logging.INFO}))
+	queue.stop()
+	assert handler.messages == ["created lazily"]
@@ -1,6 +1,6 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-from .dialog_bot import DialogBot
+from .dialog_bot import DialogBot, SAVE_TIMINGS_KEY
 
-__all__ = ["DialogBot"]
+__all__ = ["DialogBot", "SAVE_TIMINGS_KEY"]
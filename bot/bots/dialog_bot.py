@@ -1,9 +1,17 @@
 # Copyright (c) Microsoft Corporation. All rights reserved.
 # Licensed under the MIT License.
 
-from botbuilder.core import ActivityHandler, ConversationState, TurnContext, UserState
+import asyncio
+import time
+
+from botbuilder.core import ActivityHandler, BotState, ConversationState, TurnContext, UserState
 from botbuilder.dialogs import Dialog
 from helpers.dialog_helper import DialogHelper
+import insights
+
+
+# Key of the per-turn state save timings (in seconds, per state scope) in turn_state
+SAVE_TIMINGS_KEY = "DialogBot.save_timings"
 
 
 class DialogBot(ActivityHandler):
@@ -37,11 +45,30 @@ class DialogBot(ActivityHandler):
         self.dialog = dialog
 
     async def on_turn(self, turn_context: TurnContext):
+        start = time.perf_counter()
         await super().on_turn(turn_context)
 
         # Save any state changes that might have ocurred during the turn.
-        await self.conversation_state.save_changes(turn_context)
-        await self.user_state.save_changes(turn_context)
+        # Unchanged scopes are skipped and the others are saved concurrently.
+        timings = {}
+        await asyncio.gather(
+            self._save_if_changed("conversation", self.conversation_state, turn_context, timings),
+            self._save_if_changed("user", self.user_state, turn_context, timings),
+        )
+        turn_context.turn_state[SAVE_TIMINGS_KEY] = timings
+        insights.save_turn_latency(time.perf_counter() - start, timings)
+
+    @staticmethod
+    async def _save_if_changed(scope: str, state: BotState, turn_context: TurnContext, timings: dict):
+        # State that was not loaded during the turn has no cached value and cannot have changed
+        cached_state = state.get_cached_state(turn_context)
+        if cached_state is None or not cached_state.is_changed:
+            return
+
+        start = time.perf_counter()
+        # The change check is already done, force avoids hashing the state a second time
+        await state.save_changes(turn_context, force=True)
+        timings[scope] = time.perf_counter() - start
 
     async def on_message_activity(self, turn_context: TurnContext):
         await DialogHelper.run_dialog(
@@ -0,0 +1,89 @@
+import time
+from collections import deque
+
+
+class CircuitBreaker:
+    """
+      Circuit breaker over the outcomes of the last window calls. It opens once at least min_calls were
+      recorded and either the share of failed calls reaches failure_rate, or the share of calls slower
+      than slow_call seconds reaches slow_rate.
+
+      While open, calls are refused for reset_timeout seconds. A single trial call is then let through
+      (half open): it closes the breaker if it succeeds in time, and opens it again otherwise.
+
+      observer, if given, is called with the new state on every state change.
+    """
+
+    states = ("closed", "half_open", "open")
+
+    def __init__(self, window: int=20, min_calls: int=10, failure_rate: float=0.5, slow_call: float=2.0,
+        slow_rate: float=0.5, reset_timeout: float=30.0, observer=None, clock=time.monotonic):
+        if min_calls > window:
+            raise ValueError("The minimum number of calls cannot exceed the window")
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call = slow_call
+        self.slow_rate = slow_rate
+        self.reset_timeout = reset_timeout
+        self.observer = observer
+        self.clock = clock
+
+        #(failed, slow) outcomes of the last calls while closed
+        self.calls = deque(maxlen=window)
+        self.state = "closed"
+        self.opened_at = None
+        self.trial_at = None
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            if self.observer is not None:
+                self.observer(state)
+
+    def _open(self):
+        self.opened_at = self.clock()
+        self.trial_at = None
+        self._set_state("open")
+
+    def is_open(self) -> bool:
+        #Open and not yet due for a trial call
+        return self.state == "open" and self.clock() - self.opened_at < self.reset_timeout
+
+    def allow(self) -> bool:
+        """
+          Returns whether a call may be made now. A call allowed while half open is the trial call, and
+          its outcome must be recorded.
+        """
+        if self.state == "closed":
+            return True
+        if self.is_open():
+            return False
+
+        #A trial call that never reported is given up after reset_timeout
+        now = self.clock()
+        if self.trial_at is not None and now - self.trial_at < self.reset_timeout:
+            return False
+        self.trial_at = now
+        self._set_state("half_open")
+        return True
+
+    def record(self, success: bool, latency: float=0.0):
+        slow = latency >= self.slow_call
+        if self.state == "half_open":
+            if success and not slow:
+                self.calls.clear()
+                self.trial_at = None
+                self._set_state("closed")
+            else:
+                self._open()
+            return
+        if self.state == "open":
+            #Late outcome of a call made before the breaker opened
+            return
+
+        self.calls.append((not success, slow))
+        if len(self.calls) >= self.min_calls:
+            failures = sum(failed for failed, _ in self.calls) / len(self.calls)
+            slow_calls = sum(slow for _, slow in self.calls) / len(self.calls)
+            if failures >= self.failure_rate or slow_calls >= self.slow_rate:
+                self._open()
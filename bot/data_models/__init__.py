@@ -2,5 +2,6 @@
 # Licensed under the MIT License.
 
 from .user_profile import UserProfile
+from .booking_values import BookingValues
 
-__all__ = ["UserProfile"]
+__all__ = ["UserProfile", "BookingValues"]
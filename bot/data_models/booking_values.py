@@ -0,0 +1,24 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from .user_profile import UserProfile
+
+
+class BookingValues(UserProfile):
+    """
+      Dialog state of the SlotFillingDialog: the booking slots of the profile, the number of booking
+      requests made, the step waiting for the answer of the current prompt and, until it is confirmed,
+      the query and the names of the slots filled by the last prediction (their values are the slot ones).
+    """
+
+    __slots__ = ('requests', 'step', 'query', 'predicted')
+
+    fields = UserProfile.fields + __slots__
+
+    def __init__(self):
+        super(BookingValues, self).__init__()
+
+        self.requests = 0
+        self.step = None
+        self.query = None
+        self.predicted = None
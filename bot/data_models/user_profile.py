@@ -6,15 +6,31 @@ from botbuilder.schema import Attachment
 
 class UserProfile:
     """
-      This is our application state. Just a regular serializable Python class.
+      This is our application state. A fixed set of fields without instance dict, serialized
+      (and hashed by the bot state on every turn) as the list of its values.
     """
 
-    def __init__(self, n_entities: int=None, dst_city: str=None, or_city: str=None, budget: int=None,
-     str_date: str=None, end_date: str=None):
+    __slots__ = ('dst_city', 'or_city', 'str_date', 'end_date', 'budget')
+
+    def __init__(self, dst_city: str=None, or_city: str=None, budget: int=None, str_date: str=None,
+     end_date: str=None):
 
-        self.n_entities = n_entities
         self.dst_city = dst_city
         self.or_city = or_city
         self.str_date = str_date
         self.end_date = end_date
         self.budget = budget
+
+    #Serialized fields, subclasses add their own slots
+    fields = __slots__
+
+    def __getstate__(self):
+        return [getattr(self, field) for field in self.fields]
+
+    def __setstate__(self, state):
+        if isinstance(state, dict):
+            #Profiles stored before the fields were fixed, as attribute dicts with a since removed counter
+            state.pop('n_entities', None)
+            state = [state.get(field) for field in self.fields]
+        for field, value in zip(self.fields, state):
+            setattr(self, field, value)
@@ -0,0 +1,222 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from array import array
+
+import numpy as np
+
+
+#Utterance files generated by the training notebook live at the root of the repository
+data_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+#Columnar caches of the utterance files of data_dir, rebuilt when their file changes (other files, such as
+#the ones generated elsewhere, are read directly)
+cache_dir = os.environ.get("DATASET_CACHE_DIR", os.path.join(data_dir, ".dataset_cache"))
+cache_version = 1
+
+train_path = os.path.join(data_dir, "train_luis_utterances.json")
+test_path = os.path.join(data_dir, "test_luis_utterances.json")
+test_red_path = os.path.join(data_dir, "test_luis_utterances_red.json")
+
+
+def get_labels(record):
+    #The REST API format uses entityLabels, the luis.ai website format uses entities
+    if 'entityLabels' in record:
+        return [(e['entityName'], e['startCharIndex'], e['endCharIndex']) for e in record['entityLabels']]
+    return [(e['entity'], e['startPos'], e['endPos']) for e in record.get('entities', [])]
+
+
+def get_intent(record):
+    return record.get('intentName', record.get('intent'))
+
+
+def iter_records(path, chunk_size=1 << 16):
+    #Streams the records of a JSON array (or of JSON lines), holding one chunk and one record at most
+    decoder = json.JSONDecoder()
+    with open(path, encoding='utf-8') as file:
+        buffer = ""
+        position = 0
+        while True:
+            #Skipping the array brackets and the separators between records
+            while position < len(buffer) and buffer[position] in " \t\r\n,[]":
+                position += 1
+            if position < len(buffer):
+                try:
+                    record, end = decoder.raw_decode(buffer, position)
+                except ValueError:
+                    #The record continues in the next chunk
+                    pass
+                else:
+                    position = end
+                    yield record
+                    continue
+
+            chunk = file.read(chunk_size)
+            if not chunk:
+                if position < len(buffer):
+                    raise ValueError(f"Truncated record at the end of {path}")
+                return
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def iter_utterances(path):
+    #Same tuples as load_utterances, streamed
+    for r in iter_records(path):
+        yield r['text'], get_intent(r), get_labels(r)
+
+
+class Corpus:
+    """
+      Utterance file in columns of memory mapped arrays: the UTF-8 texts end to end with their byte and
+      character offsets, the intent codes, and the entity codes, start and end of the spans of each
+      utterance, from span_offsets[i] to span_offsets[i + 1]. Indexing gives load_utterances tuples.
+    """
+
+    columns = ('text_offsets', 'char_offsets', 'intent_codes', 'span_offsets', 'span_entities',
+        'span_starts', 'span_ends')
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, "meta.json"), encoding='utf-8') as file:
+            self.meta = json.load(file)
+        self.intents = self.meta['intents']
+        self.entities = self.meta['entities']
+
+        #Read only maps, the pages are only read when used
+        self.text_bytes = np.memmap(os.path.join(directory, "text.bin"), dtype=np.uint8, mode='r') \
+            if self.meta['text_bytes'] else np.zeros(0, dtype=np.uint8)
+        for column in self.columns:
+            setattr(self, column, np.load(os.path.join(directory, column + ".npy"), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.intent_codes)
+
+    def text(self, i):
+        return bytes(self.text_bytes[self.text_offsets[i]:self.text_offsets[i + 1]]).decode('utf-8')
+
+    def labels(self, i):
+        start, end = self.span_offsets[i], self.span_offsets[i + 1]
+        return [(self.entities[e], int(s), int(t)) for e, s, t in
+            zip(self.span_entities[start:end], self.span_starts[start:end], self.span_ends[start:end])]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step == 1:
+                return self.records(start, stop)
+            return [self[j] for j in range(start, stop, step)]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        intent = self.intent_codes[i]
+        return self.text(i), self.intents[intent] if intent >= 0 else None, self.labels(i)
+
+    def __iter__(self):
+        return iter(self.records())
+
+    def records(self, start=0, stop=None):
+        #Decodes a range of utterances at once, much faster than indexing them one by one
+        stop = len(self) if stop is None else stop
+        if start >= stop:
+            return []
+        offsets = self.char_offsets[start:stop + 1].tolist()
+        base = self.text_offsets[start]
+        texts = bytes(self.text_bytes[base:self.text_offsets[stop]]).decode('utf-8')
+        first = offsets[0]
+
+        spans = self.span_offsets[start:stop + 1].tolist()
+        span_range = slice(spans[0], spans[-1])
+        entities = [self.entities[e] for e in self.span_entities[span_range].tolist()]
+        labels = list(zip(entities, self.span_starts[span_range].tolist(), self.span_ends[span_range].tolist()))
+        intents = [self.intents[c] if c >= 0 else None for c in self.intent_codes[start:stop].tolist()]
+
+        return [(texts[offsets[i] - first:offsets[i + 1] - first], intents[i],
+            labels[spans[i] - spans[0]:spans[i + 1] - spans[0]]) for i in range(stop - start)]
+
+
+def source_stamp(path):
+    stat = os.stat(path)
+    return {'version': cache_version, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def build_cache(path, directory):
+    #Streams the utterances into the columns, in a temporary directory renamed once complete
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    building = tempfile.mkdtemp(dir=parent, prefix=".building-")
+    try:
+        stamp = source_stamp(path)
+        columns = {'text_offsets': array('q', [0]), 'char_offsets': array('q', [0]), 'intent_codes': array('h'),
+            'span_offsets': array('q', [0]), 'span_entities': array('h'), 'span_starts': array('i'),
+            'span_ends': array('i')}
+        intents = {}
+        entities = {}
+
+        with open(os.path.join(building, "text.bin"), 'wb') as text_file:
+            for text, intent, labels in iter_utterances(path):
+                encoded = text.encode('utf-8')
+                text_file.write(encoded)
+                columns['text_offsets'].append(columns['text_offsets'][-1] + len(encoded))
+                columns['char_offsets'].append(columns['char_offsets'][-1] + len(text))
+                columns['intent_codes'].append(-1 if intent is None else intents.setdefault(intent, len(intents)))
+                for entity, start, end in labels:
+                    columns['span_entities'].append(entities.setdefault(entity, len(entities)))
+                    columns['span_starts'].append(start)
+                    columns['span_ends'].append(end)
+                columns['span_offsets'].append(len(columns['span_starts']))
+
+        for column, values in columns.items():
+            np.save(os.path.join(building, column + ".npy"), np.frombuffer(values, dtype=values.typecode))
+        with open(os.path.join(building, "meta.json"), 'w', encoding='utf-8') as file:
+            json.dump({**stamp, 'intents': list(intents), 'entities': list(entities),
+                'text_bytes': columns['text_offsets'][-1]}, file)
+
+        #An outdated cache is replaced, a cache just built by another process is kept
+        if os.path.exists(directory):
+            shutil.rmtree(directory, ignore_errors=True)
+        try:
+            os.rename(building, directory)
+        except OSError:
+            if not os.path.exists(directory):
+                raise
+    finally:
+        shutil.rmtree(building, ignore_errors=True)
+
+
+def open_corpus(path, directory=None):
+    """
+      Opens the columnar cache of an utterance file, built from the file on first use or when the file
+      changed. directory defaults to a directory named after the file and its path in cache_dir.
+    """
+    if directory is None:
+        path_hash = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+        directory = os.path.join(cache_dir, f"{os.path.basename(path)}-{path_hash}")
+
+    try:
+        corpus = Corpus(directory)
+        if all(corpus.meta.get(key) == value for key, value in source_stamp(path).items()):
+            return corpus
+    except (OSError, ValueError, KeyError):
+        pass
+
+    build_cache(path, directory)
+    return Corpus(directory)
+
+
+def is_cached(path):
+    root = os.path.abspath(data_dir)
+    return os.path.commonpath([root, os.path.abspath(path)]) == root
+
+
+def load_utterances(path):
+    #Returns (text, intent, [(entity, start, end)]) tuples, end being exclusive, from the columnar cache
+    if not is_cached(path):
+        return list(iter_utterances(path))
+    try:
+        return open_corpus(path).records()
+    except PermissionError:
+        #Read only cache directory
+        return list(iter_utterances(path))
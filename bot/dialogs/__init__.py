@@ -2,5 +2,6 @@
 # Licensed under the MIT License.
 
 from .user_profile_dialog import UserProfileDialog
+from .slot_filling_dialog import SlotFillingDialog
 
-__all__ = ["UserProfileDialog"]
+__all__ = ["UserProfileDialog", "SlotFillingDialog"]
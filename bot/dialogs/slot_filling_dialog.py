@@ -0,0 +1,294 @@
+# Copyright (c) Microsoft Corporation. All rights reserved.
+# Licensed under the MIT License.
+
+from collections import namedtuple
+
+from botbuilder.dialogs import (
+    ComponentDialog,
+    Dialog,
+    DialogContext,
+    DialogReason,
+    DialogTurnResult,
+)
+from botbuilder.dialogs.prompts import (
+    TextPrompt,
+    ChoicePrompt,
+    ConfirmPrompt,
+    PromptOptions,
+)
+from botbuilder.dialogs.choices import Choice
+from botbuilder.core import MessageFactory, StatePropertyAccessor, UserState
+
+from data_models import BookingValues, UserProfile
+
+import luis
+import insights
+
+entities_dict = luis.entities_dict
+relevant_entities = luis.relevant_entities
+unavailable_text = luis.unavailable_text
+
+#Configuring logger
+
+logger = insights.configure_logger()
+
+
+Slot = namedtuple("Slot", ["name", "prompt", "confirmation"])
+
+#Slots asked one by one when the booking requests did not fill them, in this order
+slots = [
+    Slot('dst_city', "Please tell me with your destination city", "Your destination is {}"),
+    Slot('or_city', "Please tell me your departure city", "Your departure city is {}"),
+    Slot('str_date', "Please tell me your desired departure date", "Your departure date is {}"),
+    Slot('end_date', "Please tell me your desired return date", "Your return date is {}"),
+    Slot('budget', "Please tell me your maximum budget", "Your maximum budget is {}"),
+]
+
+rating_choices = ["1", "2", "3", "4", "5"]
+
+
+def next_missing_slot(values):
+    for slot in slots:
+        if getattr(values, slot.name) is None:
+            return slot
+    return None
+
+
+def prediction_properties(values):
+    #Log properties of the last prediction, whose entities are the predicted slots
+    entities = {ent: getattr(values, ent) for ent in values.predicted}
+    return {'custom_dimensions': {**{'query': values.query}, **entities}}
+
+
+class BookingSlotsDialog(Dialog):
+    """
+      Booking flow of the SlotFillingDialog, whose state is a BookingValues record. Each answer only
+      runs the step waiting for it, which prompts for what is needed next given the filled slots,
+      so that no step runs only to be skipped.
+    """
+
+    def __init__(self, user_profile_accessor: StatePropertyAccessor):
+        super(BookingSlotsDialog, self).__init__(BookingSlotsDialog.__name__)
+
+        self.user_profile_accessor = user_profile_accessor
+
+        #Every step is timed, the durations are recorded by step name
+        self.steps = {step.__name__: insights.timed_step(step) for step in [
+            self.initial_step,
+            self.confirm_step,
+            self.correction_step,
+            self.clear_step,
+            self.slot_step,
+            self.rating_step,
+            self.final_step,
+        ]}
+
+    async def begin_dialog(self, dialog_context: DialogContext, options: object = None) -> DialogTurnResult:
+        dialog_context.active_dialog.state['values'] = BookingValues()
+        return await self.run_step(dialog_context, 'initial_step')
+
+    async def resume_dialog(self, dialog_context: DialogContext, reason: DialogReason,
+        result: object) -> DialogTurnResult:
+        #The answer of a prompt goes to the step waiting for it
+        return await self.run_step(dialog_context, dialog_context.active_dialog.state['values'].step, result)
+
+    async def run_step(self, dialog_context: DialogContext, step: str, result: object = None) -> DialogTurnResult:
+        return await self.steps[step](dialog_context, dialog_context.active_dialog.state['values'], result)
+
+    async def prompt(self, dialog_context: DialogContext, step: str, dialog_id: str,
+        options: PromptOptions) -> DialogTurnResult:
+        #step receives the answer, on the next turn
+        dialog_context.active_dialog.state['values'].step = step
+        return await dialog_context.prompt(dialog_id, options)
+
+    async def initial_step(self, dialog_context: DialogContext, values: BookingValues, result: object) -> DialogTurnResult:
+        #Incrementing our n_dialog metric
+        insights.save_turn_metrics(dialog=True)
+
+        values.requests = 1
+        if luis.breaker.is_open():
+            #Booking requests cannot be understood, the slots are asked right away
+            await dialog_context.context.send_activity(MessageFactory.text("Welcome to FlyBot!"))
+            return await self.prompt_manual(dialog_context, values)
+
+        return await self.prompt(dialog_context, 'confirm_step', TextPrompt.__name__, PromptOptions(
+            prompt=MessageFactory.text(
+                "Welcome to FlyBot! Please tell me where you want to fly, your departure location, starting and return dates and budget")))
+
+    async def confirm_step(self, dialog_context: DialogContext, values: BookingValues, query: str) -> DialogTurnResult:
+        try:
+            resp = await luis.get_entities(query)
+        except luis.LuisUnavailable as error:
+            logger.warning("LUIS Unavailable", extra={'custom_dimensions': {'query': query, 'reason': error.reason}})
+            return await self.prompt_manual(dialog_context, values)
+        entities = luis.extract_entities(resp)
+        for ent, value in entities.items():
+            setattr(values, ent, value)
+
+        if len(entities) == 0:
+            if values.requests == 1:
+                text = "No booking information detected, please try again."
+            else:
+                text = "No booking information detected, switching to manual input."
+            await dialog_context.context.send_activity(MessageFactory.text(text))
+            error_properties = {'custom_dimensions': {'query': resp['query']}}
+            logger.error("No Prediction", extra = error_properties)
+
+            insights.save_turn_metrics(success=False, entity_errors=1)
+            return await self.prompt_missing(dialog_context, values)
+
+        values.query = resp['query']
+        values.predicted = list(entities)
+
+        #Logging request results
+        properties = {'custom_dimensions': {**{'query': resp['query']}, **entities}}
+        logger.info("Predicted Information", extra= properties )
+
+        #Building confirmation message
+        return_msg = "Here is the retrieved information: \r\n"
+        for ent, value in entities.items():
+            return_msg += entities_dict[ent] + " : " + value + " \r\n"
+        await dialog_context.context.send_activity(MessageFactory.text(return_msg))
+
+        return await self.prompt(dialog_context, 'correction_step', ConfirmPrompt.__name__, PromptOptions(
+            prompt=MessageFactory.text("Do you confirm the information above?")))
+
+    async def correction_step(self, dialog_context: DialogContext, values: BookingValues,
+        confirmed: bool) -> DialogTurnResult:
+        n_entities = len(values.predicted)
+        properties = prediction_properties(values)
+
+        if confirmed:
+            logger.info("Good Prediction", extra= properties )
+            #Saving the request result and the number of successfully detected entities
+            insights.save_turn_metrics(success=True, detected=n_entities, entity_errors=0)
+            return await self.prompt_missing(dialog_context, values)
+
+        logger.info("Wrong Prediction", extra= properties )
+        #No List Prompt is available, so we have to suppose that only 1 entity was wrongly detected
+        insights.save_turn_metrics(success=False, detected=n_entities-1, entity_errors=1)
+
+        choices = [Choice(entities_dict[ent]) for ent in relevant_entities if getattr(values, ent) is not None]
+        choices.append(Choice("Multiple Fields"))
+        return await self.prompt(dialog_context, 'clear_step', ChoicePrompt.__name__, PromptOptions(
+            prompt=MessageFactory.text("Please select wrongly detected information:"),
+            choices=choices))
+
+    async def clear_step(self, dialog_context: DialogContext, values: BookingValues, choice) -> DialogTurnResult:
+        #If several fields are wrong, we clean all saved information
+        if choice.value == "Multiple Fields":
+            #Saving a log with 0% accuracy
+            insights.save_turn_metrics(entity_errors=1)
+
+            logger.warning("Several Wrong Info", extra= prediction_properties(values) )
+
+            for ent in relevant_entities:
+                setattr(values, ent, None)
+            await dialog_context.context.send_activity(MessageFactory.text(
+                "Thank you for your help! Clearing the detected information."))
+        else:
+            for ent, label in entities_dict.items():
+                if label == choice.value:
+                    setattr(values, ent, None)
+                    break
+            await dialog_context.context.send_activity(MessageFactory.text(
+                "Thank you for your help! Clearing wrong information."))
+
+        return await self.prompt_missing(dialog_context, values)
+
+    async def prompt_missing(self, dialog_context: DialogContext, values: BookingValues) -> DialogTurnResult:
+        #A booking request was handled, the prediction is not needed anymore
+        values.query = None
+        values.predicted = None
+
+        if next_missing_slot(values) is None:
+            return await self.prompt_booking(dialog_context, values)
+
+        if values.requests == 1 and not luis.breaker.is_open():
+            #Second request listing the missing information
+            values.requests = 2
+            text = "Please provide me with the information below so I can complete your flight booking: \r \n"
+            for ent in relevant_entities:
+                if getattr(values, ent) is None:
+                    text += entities_dict[ent] + "\r \n"
+            return await self.prompt(dialog_context, 'confirm_step', TextPrompt.__name__, PromptOptions(
+                prompt=MessageFactory.text(text)))
+
+        await dialog_context.context.send_activity(MessageFactory.text(
+            "Unable to retrieve all necessary information."))
+        return await self.prompt_slot(dialog_context, values)
+
+    async def prompt_manual(self, dialog_context: DialogContext, values: BookingValues) -> DialogTurnResult:
+        #LUIS is unavailable, the missing slots are asked one by one
+        await dialog_context.context.send_activity(MessageFactory.text(unavailable_text))
+        return await self.prompt_slot(dialog_context, values)
+
+    async def prompt_slot(self, dialog_context: DialogContext, values: BookingValues) -> DialogTurnResult:
+        #Asks for the first missing slot of the table, or for the booking once they are all filled
+        slot = next_missing_slot(values)
+        if slot is None:
+            return await self.prompt_booking(dialog_context, values)
+
+        return await self.prompt(dialog_context, 'slot_step', TextPrompt.__name__, PromptOptions(
+            prompt=MessageFactory.text(slot.prompt)))
+
+    async def slot_step(self, dialog_context: DialogContext, values: BookingValues, value: str) -> DialogTurnResult:
+        #value answers the prompt of the first missing slot
+        slot = next_missing_slot(values)
+        await dialog_context.context.send_activity(MessageFactory.text(slot.confirmation.format(value)))
+        setattr(values, slot.name, value)
+
+        return await self.prompt_slot(dialog_context, values)
+
+    async def prompt_booking(self, dialog_context: DialogContext, values: BookingValues) -> DialogTurnResult:
+        # Get the current profile object from user state.  Changes to it
+        # will saved during Bot.on_turn.
+        user_profile = await self.user_profile_accessor.get(dialog_context.context, UserProfile)
+        for ent in relevant_entities:
+            setattr(user_profile, ent, getattr(values, ent))
+
+        return_msg = "Please find below the information for this booking : \r \n"
+        for ent in relevant_entities:
+            return_msg += entities_dict[ent] + " : " + getattr(values, ent) + " \r\n"
+        await dialog_context.context.send_activity(MessageFactory.text(return_msg))
+
+        return await self.prompt(dialog_context, 'rating_step', ConfirmPrompt.__name__, PromptOptions(
+            prompt=MessageFactory.text("Do you want me to book a flight for you?")))
+
+    async def rating_step(self, dialog_context: DialogContext, values: BookingValues, booked: bool) -> DialogTurnResult:
+        if booked:
+            await dialog_context.context.send_activity(MessageFactory.text(
+                "Thank you for using Flybot. \r \n Your flight details will be send to you by mail shortly"))
+            text = "Please rate this bot :"
+        else:
+            text = "No problem, I hope this bot was useful. Please provide us a rating"
+
+        return await self.prompt(dialog_context, 'final_step', ChoicePrompt.__name__, PromptOptions(
+            prompt=MessageFactory.text(text),
+            choices=[Choice(choice) for choice in rating_choices]))
+
+    async def final_step(self, dialog_context: DialogContext, values: BookingValues, choice) -> DialogTurnResult:
+        insights.save_turn_metrics(score=int(choice.value))
+
+        await dialog_context.context.send_activity(MessageFactory.text(
+            "The FlyBot team really appreciates your help in improving this bot! Have a wonderful day!"))
+        await dialog_context.context.send_activity(MessageFactory.text(
+            "Feel free to send a message to this Bot to book another flight!"))
+        return await dialog_context.end_dialog()
+
+
+class SlotFillingDialog(ComponentDialog):
+    """
+      Same conversation as the UserProfileDialog, driven by the slot table rather than a waterfall
+      threading sentinel values through every step.
+    """
+
+    def __init__(self, user_state: UserState):
+        super(SlotFillingDialog, self).__init__(SlotFillingDialog.__name__)
+
+        self.add_dialog(BookingSlotsDialog(user_state.create_property("UserProfile")))
+        self.add_dialog(TextPrompt(TextPrompt.__name__))
+        self.add_dialog(ChoicePrompt(ChoicePrompt.__name__))
+        self.add_dialog(ConfirmPrompt(ConfirmPrompt.__name__))
+
+        self.initial_dialog_id = BookingSlotsDialog.__name__
@@ -23,11 +23,11 @@ from data_models import UserProfile
 
 import os
 import luis
-import pandas as pd
 import insights
 
 entities_dict = luis.entities_dict
 relevant_entities = luis.relevant_entities
+unavailable_text = luis.unavailable_text
 
 #Configuring logger
 
@@ -52,10 +52,11 @@ class UserProfileDialog(ComponentDialog):
 
         self.user_profile_accessor = user_state.create_property("UserProfile")
 
+        #Every step is timed, the durations are recorded by step name
         self.add_dialog(
             WaterfallDialog(
                 WaterfallDialog.__name__,
-                [
+                [insights.timed_step(step) for step in [
                     self.initial_step,
                     self.confirm_step,
                     self.correction_step,
@@ -70,7 +71,7 @@ class UserProfileDialog(ComponentDialog):
                     self.summary_step,
                     self.rating_step,
                     self.final_step
-                ],
+                ]],
             )
         )
         self.add_dialog(TextPrompt(TextPrompt.__name__))
@@ -92,7 +93,13 @@ class UserProfileDialog(ComponentDialog):
             step_context.values[ent] = None
 
         #Incrementing our n_dialog metric
-        insights.save_n_dialog()
+        insights.save_turn_metrics(dialog=True)
+
+        #Booking requests cannot be understood while LUIS is unavailable, -7 goes straight to manual input
+        if luis.breaker.is_open():
+            await step_context.context.send_activity(MessageFactory.text("Welcome to FlyBot!"))
+            await step_context.context.send_activity(MessageFactory.text(unavailable_text))
+            return await step_context.next(-7)
 
         #Displaying user prompt
         return await step_context.prompt(
@@ -103,17 +110,25 @@ class UserProfileDialog(ComponentDialog):
         )
     async def confirm_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
 
-        resp = luis.get_entities(step_context.result)
+        if step_context.result == -7:
+            return await step_context.next(-7)
+
+        try:
+            resp = await luis.get_entities(step_context.result)
+        except luis.LuisUnavailable as error:
+            properties = {'custom_dimensions': {'query': step_context.result, 'reason': error.reason}}
+            logger.warning("LUIS Unavailable", extra= properties )
+            await step_context.context.send_activity(MessageFactory.text(unavailable_text))
+            return await step_context.next(-7)
         entities = luis.update_entities(step_context, resp)
         n_entities = len(entities)
 
         step_context.values['n_entities'] = n_entities
-        step_context.values['entities'] = entities.to_dict()['entities']
+        step_context.values['entities'] = entities
         step_context.values['query'] = resp['query']
 
         #Generating pre generated entities to prevent repetitive API requests
-        # entities = pd.DataFrame([{'entities': 'Toronto'}, {'entities': 'Budapest'},
-        #     {'entities': 'November 11th'}], index=['or_city','dst_city','str_date'])
+        # entities = {'or_city': 'Toronto', 'dst_city': 'Budapest', 'str_date': 'November 11th'}
         # step_context.values['or_city'] = 'Toronto'
         # step_context.values['dst_city'] = 'Budapest'
         # step_context.values['str_date'] = 'November 11th'
@@ -129,13 +144,13 @@ class UserProfileDialog(ComponentDialog):
 
         else:
             #Logging request results
-            properties = {'custom_dimensions': {**{'query': resp['query']}, **entities.to_dict()['entities']}}
+            properties = {'custom_dimensions': {**{'query': resp['query']}, **entities}}
             logger.info("Predicted Information", extra= properties )
             
             #Building confirmation message
             return_msg = "Here is the retrieved information: \r\n"
-            for index, row in entities.iterrows():
-                return_msg += entities_dict[index] + " : " + row['entities'] + " \r\n"
+            for ent, value in entities.items():
+                return_msg += entities_dict[ent] + " : " + value + " \r\n"
 
 
             #Sending detected entities
@@ -152,18 +167,17 @@ class UserProfileDialog(ComponentDialog):
     async def correction_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
 
        if step_context.result == -99:
-        insights.save_request_data(success=False)
-        insights.save_entity_accuracy(1,0)
+        insights.save_turn_metrics(success=False, entity_errors=1)
         return await step_context.next(-1) 
+
+       elif step_context.result == -7:
+        return await step_context.next(-7)
       
        elif step_context.result:
         properties = {'custom_dimensions': {**{'query': step_context.values['query']}, **step_context.values['entities']}}
         logger.info("Good Prediction", extra= properties )
-        insights.save_request_data(success=True)
-
-        #Saving the number of successfully detected entities
-        insights.save_entities_detected(step_context.values['n_entities'])
-        insights.save_entity_accuracy(0,step_context.values['n_entities'])
+        #Saving the request result and the number of successfully detected entities
+        insights.save_turn_metrics(success=True, detected=step_context.values['n_entities'], entity_errors=0)
         step_context.values['n_entities'] = 0
 
         return await step_context.next(-1)
@@ -171,12 +185,10 @@ class UserProfileDialog(ComponentDialog):
        else:
             properties = {'custom_dimensions': {**{'query': step_context.values['query']}, **step_context.values['entities']}}
             logger.info("Wrong Prediction", extra= properties )
-            insights.save_request_data(success=False)
-            #Saving the number of successfully detected entities
+            #Saving the request result and the number of successfully detected entities
 
             #No List Prompt is available, so we have to suppose that only 1 entity was wrongly detected
-            insights.save_entities_detected(step_context.values['n_entities']-1)
-            insights.save_entity_accuracy(1,step_context.values['n_entities']-1)
+            insights.save_turn_metrics(success=False, detected=step_context.values['n_entities']-1, entity_errors=1)
             step_context.values['n_entities'] = 0
             choices = []
             for ent in relevant_entities:
@@ -192,12 +204,15 @@ class UserProfileDialog(ComponentDialog):
             ),)
 
     async def second_request_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
-        
+
+        if step_context.result == -7:
+            return await step_context.next(-7)
+
         if step_context.result != -1:
             #If several fields are wrong, we clean all saved information
             if step_context.result.value == "Multiple Fields":
                 #Saving a log with 0% accuracy
-                insights.save_entity_accuracy(1,0)
+                insights.save_turn_metrics(entity_errors=1)
 
                 #Logging the detected fields :
                 properties = {'custom_dimensions': {**{'query': step_context.values['query']},
@@ -218,6 +233,10 @@ class UserProfileDialog(ComponentDialog):
         if is_information_complete(step_context):
             return await step_context.next(-5)
 
+        #No second request while LUIS is unavailable
+        elif luis.breaker.is_open():
+            return await step_context.next(-1)
+
         #Second prompt displaying missing entities
         else:
             text = "Please provide me with the information below so I can complete your flight booking: \r \n"
@@ -232,22 +251,28 @@ class UserProfileDialog(ComponentDialog):
             )
     async def second_confirm_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
 
-        if step_context.result == -5:
-            return await step_context.next(-5)
+        if step_context.result in (-5, -7, -1):
+            return await step_context.next(step_context.result)
         else:
 
-            resp = luis.get_entities(step_context.result)
+            try:
+                resp = await luis.get_entities(step_context.result)
+            except luis.LuisUnavailable as error:
+                properties = {'custom_dimensions': {'query': step_context.result, 'reason': error.reason}}
+                logger.warning("LUIS Unavailable", extra= properties )
+                await step_context.context.send_activity(MessageFactory.text(unavailable_text))
+                return await step_context.next(-7)
             entities = luis.update_entities(step_context, resp)
 
             n_entities = len(entities)
 
             step_context.values['n_entities'] = n_entities
-            step_context.values['entities'] = entities.to_dict()['entities']
+            step_context.values['entities'] = entities
             step_context.values['query'] = resp['query']
 
 
             #Generating pre generated entities to prevent repetitive API requests
-            # entities = pd.DataFrame([{'entities': '2500$'}], index=['budget'])
+            # entities = {'budget': '2500$'}
             # step_context.values['budget'] = '2500$'
 
             if len(entities) == 0 :
@@ -262,12 +287,12 @@ class UserProfileDialog(ComponentDialog):
 
             else:
                 #Logging request results
-                properties = {'custom_dimensions': {**{'query': resp['query']}, **entities.to_dict()['entities']}}
+                properties = {'custom_dimensions': {**{'query': resp['query']}, **entities}}
                 logger.info("Predicted Information", extra= properties )
 
                 return_msg = "Here is the retrieved information: \r\n"
-                for index, row in entities.iterrows():
-                    return_msg += entities_dict[index] + " : " + row['entities'] + " \r\n"
+                for ent, value in entities.items():
+                    return_msg += entities_dict[ent] + " : " + value + " \r\n"
 
                 await step_context.context.send_activity(MessageFactory.text(return_msg))
 
@@ -282,28 +307,23 @@ class UserProfileDialog(ComponentDialog):
 
     async def second_correction_step(self, step_context: WaterfallStepContext) -> DialogTurnResult:
        # step_context.values["transport"] = step_context.result
-       if step_context.result == -5:
-            return await step_context.next(-5)
+       if step_context.result in (-5, -7, -1):
+            return await step_context.next(step_context.result)
         
        elif step_context.result == -99:
-            insights.save_request_data(success=False)
-            insights.save_entity_accuracy(1,0)
+            insights.save_turn_metrics(success=False, entity_errors=1)
             return await step_context.next(-1)
 
        elif step_context.result:
-        #Saving the number of successfully detected entities
-        insights.save_entities_detected(step_context.values['n_entities'])
-        insights.save_entity_accuracy(0,step_context.values['n_entities'])
+        #Saving the request result and the number of successfully detected entities
+        insights.save_turn_metrics(success=True, detected=step_context.values['n_entities'], entity_errors=0)
         step_context.values['n_entities'] = 0
-        insights.save_request_data(success=True)
         return await step_context.next(-1)
 
        else:
-            insights.save_request_data(success=False)
-            #Saving the number of successfully detected entities
+            #Saving the request result and the number of successfully detected entities
             #We have to suppose that only one was poorly detected because there is no option for ListPrompt
-            insights.save_entities_detected(step_context.values['n_entities']-1)
-            insights.save_entity_accuracy(1,step_context.values['n_entities']-1)
+            insights.save_turn_metrics(success=False, detected=step_context.values['n_entities']-1, entity_errors=1)
             step_context.values['n_entities'] = 0
             choices = []
             for ent in relevant_entities:
@@ -324,11 +344,11 @@ class UserProfileDialog(ComponentDialog):
         if step_context.result == -5 :
             return await step_context.next(-5)
 
-        elif step_context.result != -1:
+        elif step_context.result not in (-1, -7):
 
             if step_context.result.value == "Multiple Fields":
                 #Saving a log with 0% accuracy
-                insights.save_entity_accuracy(1,0)
+                insights.save_turn_metrics(entity_errors=1)
 
                 #Logging the detected fields :
                 properties = {'custom_dimensions': {**{'query': step_context.values['query']},
@@ -351,8 +371,10 @@ class UserProfileDialog(ComponentDialog):
             return await step_context.next(-5)
         else:
 
-            await step_context.context.send_activity(MessageFactory.text(
-                "Unable to retrieve all necessary information."))
+            #The manual input was already announced if LUIS is unavailable
+            if step_context.result != -7:
+                await step_context.context.send_activity(MessageFactory.text(
+                    "Unable to retrieve all necessary information."))
 
 
             if step_context.values['dst_city'] != None:
@@ -518,7 +540,7 @@ class UserProfileDialog(ComponentDialog):
         
         score = int(step_context.result.value)
 
-        insights.save_user_score(score)
+        insights.save_turn_metrics(score=score)
 
         await step_context.context.send_activity(MessageFactory.text(
                 "The FlyBot team really appreciates your help in improving this bot! Have a wonderful day!"))
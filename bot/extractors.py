@@ -0,0 +1,77 @@
+import luis
+
+
+#Every backend is a coroutine taking an utterance and returning a LUIS v3 prediction response
+
+async def luis_backend(query):
+    return await luis.get_prediction(query, use_cache=False)
+
+
+async def cached_backend(query):
+    return await luis.get_prediction(query, use_cache=True)
+
+
+async def local_backend(query):
+    import local_model
+    return await local_model.get_entities(query)
+
+
+async def gazetteer_backend(query):
+    #Fast path only, no entities for the queries it leaves to the remote model
+    import gazetteer
+    return await gazetteer.get_entities(query)
+
+
+backends = {
+    'luis': luis_backend,
+    'cached': cached_backend,
+    'local': local_backend,
+    'gazetteer': gazetteer_backend,
+}
+
+
+def get_backend(name):
+    if name not in backends:
+        raise ValueError(f"Unknown extractor backend '{name}', expected one of {', '.join(backends)}")
+    return backends[name]
+
+
+def build_response(query, spans):
+    #Builds a LUIS v3 prediction response from (entity, start, end, score) spans
+    entities = {}
+    instances = {}
+    for ent, start, end, score in spans:
+        entities.setdefault(ent, []).append(query[start:end])
+        instances.setdefault(ent, []).append({'type': ent, 'text': query[start:end],
+            'startIndex': start, 'length': end - start, 'score': score,
+            'modelTypeId': 1, 'modelType': 'Entity Extractor', 'recognitionSources': ['model']})
+
+    if entities:
+        entities['$instance'] = instances
+    top_intent = 'BookFlight' if entities else 'None'
+
+    return {'query': query, 'prediction': {'topIntent': top_intent,
+        'intents': {top_intent: {'score': 1.0}}, 'entities': entities}}
+
+
+def get_spans(resp):
+    #Predicted (entity, start, end) spans, end being exclusive
+    entities = resp.get('prediction', {}).get('entities', {})
+    spans = set()
+
+    for ent, instances in entities.get('$instance', {}).items():
+        for instance in instances:
+            spans.add((ent, instance['startIndex'], instance['startIndex'] + instance['length']))
+
+    #Non verbose responses only carry the entity text, locating it in the query instead
+    if not spans:
+        query = resp.get('query', '')
+        for ent, values in entities.items():
+            if ent == '$instance':
+                continue
+            for value in values:
+                start = query.find(value) if isinstance(value, str) else -1
+                if start >= 0:
+                    spans.add((ent, start, start + len(value)))
+
+    return spans
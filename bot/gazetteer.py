@@ -0,0 +1,263 @@
+"""
+  Fast path of the entity extraction, ahead of the LUIS prediction endpoint: an Aho-Corasick automaton of
+  the city names labelled in the training data, and regular expressions of budget amounts.
+
+  An utterance is only answered when it is fully explained: every city is given its role by the word
+  before it ("from", "to"... the words preceding a single role in the training data), at most one budget
+  and one city of each role are found, and every other word is a filler word, seen in the training data
+  outside of the entity spans rather than inside them. Amounts without a currency are only budgets next to
+  a budget word ("3200 max"), and never when they could be a year. Dates, unknown cities, negations and
+  any unusual word are left to the remote model.
+
+  python gazetteer.py "dublin to osaka for 3200 max"
+"""
+import argparse
+import json
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+import dataset
+import extractors
+
+
+city_entities = ('or_city', 'dst_city')
+
+#"boston to sl" makes boston the departure city, whatever the word before it
+route_separators = {'to', '-'}
+
+#Never filler words, as they change the meaning of the entities around them ("can't" is tokenized as
+#can and t, "cant" as a single word)
+negations = {'no', 'not', 'dont', 't', 'never', 'without', 'except', 'but', 'or', 'instead', 'rather', 'nor',
+    'neither', 'cant', 'cannot', 'doesnt', 'didnt', 'isnt', 'arent', 'wasnt', 'werent', 'havent', 'hasnt',
+    'wont', 'wouldnt', 'couldnt', 'shouldnt'}
+
+#Amounts in euros (dollars are rewritten by prepare_text) or in dollars, with a currency
+budget_pattern = re.compile(r"""(?<![\w.,€])(?:
+    €\s?\d{1,3}(?:,\d{3})+(?:\.\d\d)?|
+    €\s?\d+(?:\.\d\d)?|
+    (?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d\d)?\s?(?:€|dollars|usd|euros|eur|bucks)
+)(?![\w€]|[.,]\d)""", re.VERBOSE)
+
+#Amounts without a currency, only budgets after or before a budget word and unless they could be a year
+bare_amount_pattern = re.compile(r"(?<![\w.,€])(?:\d{1,3}(?:,\d{3})+|\d{3,6})(?![\w€]|[.,]\d)")
+year_pattern = re.compile(r"(?:19|20)\d\d")
+budget_cues = {'budget', 'max', 'maximum', 'under', 'have', 'got', 'spend', 'spending', 'afford', 'total',
+    'tops', 'most', 'for'}
+
+token_pattern = re.compile(r"\w+|€")
+
+
+def prepare_text(query):
+    #Same rewrite as the training data, only applied if character offsets are preserved
+    text = query.replace("$", "€").lower()
+    return text if len(text) == len(query) else query
+
+
+class AhoCorasick:
+    """
+      Aho-Corasick automaton finding every occurrence of a set of strings in a single pass over a text.
+      The states are dictionaries of transitions, with the failure transitions precomputed, and the
+      lengths of the strings ending in each state.
+    """
+
+    def __init__(self, patterns):
+        self.goto = [{}]
+        self.outputs = [()]
+        for pattern in patterns:
+            state = 0
+            for char in pattern:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.outputs.append(())
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            self.outputs[state] = (len(pattern),)
+
+        #Breadth first, so that the failure state of a state is complete before its children
+        fail = [0] * len(self.goto)
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = fail[fallback]
+                fail[child] = self.goto[fallback].get(char, 0) if self.goto[fallback].get(char) != child else 0
+                self.outputs[child] = self.outputs[child] + self.outputs[fail[child]]
+        self.fail = fail
+
+    def __len__(self):
+        return len(self.goto)
+
+    def find(self, text):
+        #(start, end) of every occurrence, end being exclusive
+        goto, fail, outputs = self.goto, self.fail, self.outputs
+        state = 0
+        matches = []
+        for end, char in enumerate(text, 1):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for length in outputs[state]:
+                matches.append((end - length, end))
+        return matches
+
+
+def is_word_boundary(text, start, end):
+    return (start == 0 or not text[start - 1].isalnum()) and (end == len(text) or not text[end].isalnum())
+
+
+class Gazetteer:
+    """
+      City names and filler words of the fast path, built from labelled utterances by build().
+    """
+
+    def __init__(self, cities, fillers, cues):
+        self.cities = sorted(cities)
+        self.fillers = frozenset(fillers)
+        #Role of the cities following each cue word
+        self.cues = dict(cues)
+        self.automaton = AhoCorasick(self.cities)
+
+    @classmethod
+    def build(cls, utterances, min_precision: float=0.8, min_filler_count: int=3, max_filler_rate: float=0.1,
+        min_cue_count: int=5, min_cue_share: float=0.9):
+        """
+          Keeps the city names labelled as cities in at least min_precision of their occurrences as words,
+          the filler words seen min_filler_count times at least, at most max_filler_rate of their occurrences
+          being within an entity span, and the cue words preceding min_cue_count cities at least, of the
+          same role for min_cue_share of them.
+        """
+        utterances = list(utterances)
+        candidates = {text[start:end] for text, _, spans in utterances for ent, start, end in spans
+            if ent in city_entities and end - start > 1}
+
+        labelled = Counter()
+        found = Counter()
+        outside = Counter()
+        inside = Counter()
+        roles = Counter()
+        automaton = AhoCorasick(candidates)
+        for text, _, spans in utterances:
+            city_spans = {(start, end) for ent, start, end in spans if ent in city_entities}
+            for start, end in automaton.find(text):
+                if is_word_boundary(text, start, end):
+                    found[text[start:end]] += 1
+                    labelled[text[start:end]] += (start, end) in city_spans
+
+            tokens = [(m.group(), m.start()) for m in token_pattern.finditer(text)]
+            for word, position in tokens:
+                within = any(start <= position < end for _, start, end in spans)
+                (inside if within else outside)[word] += 1
+            for ent, start, end in spans:
+                before = [word for word, position in tokens if position < start][-1:]
+                if ent in city_entities and before:
+                    roles[before[0], ent] += 1
+
+        cities = {city for city in candidates if labelled[city] >= min_precision * found[city]}
+        fillers = {word for word, count in outside.items() if count >= min_filler_count
+            and inside[word] <= max_filler_rate * (count + inside[word])
+            and not any(c.isdigit() for c in word) and word not in negations}
+        cues = {}
+        for word in {word for word, _ in roles}:
+            counts = {ent: roles[word, ent] for ent in city_entities}
+            role = max(counts, key=counts.get)
+            if sum(counts.values()) >= min_cue_count and counts[role] >= min_cue_share * sum(counts.values()):
+                cues[word] = role
+        return cls(cities, fillers, cues)
+
+    def find_cities(self, text):
+        #Longest leftmost city names, at word boundaries and not overlapping
+        matches = sorted((m for m in self.automaton.find(text) if is_word_boundary(text, *m)),
+            key=lambda m: (m[0], -m[1]))
+        cities = []
+        for start, end in matches:
+            if not cities or start >= cities[-1][1]:
+                cities.append((start, end))
+        return cities
+
+    def predict_spans(self, text):
+        """
+          Returns the (entity, start, end, score) spans of an already prepared text, or None unless the
+          spans explain the whole text.
+        """
+        spans = []
+        for match in budget_pattern.finditer(text):
+            spans.append(('budget', match.start(), match.end()))
+
+        tokens = [(m.group(), m.start(), m.end()) for m in token_pattern.finditer(text)]
+        for match in bare_amount_pattern.finditer(text):
+            if any(s < match.end() and match.start() < e for _, s, e in spans) or year_pattern.fullmatch(match.group()):
+                continue
+            #"budget is 3200", "3200 max"
+            before = [word for word, _, word_end in tokens if word_end <= match.start()][-2:]
+            after = [word for word, word_start, _ in tokens if word_start >= match.end()][:1]
+            if budget_cues.intersection(before + after):
+                spans.append(('budget', match.start(), match.end()))
+
+        cities = [(start, end) for start, end in self.find_cities(text)
+            if not any(s < end and start < e for _, s, e in spans)]
+        for i, (start, end) in enumerate(cities):
+            before = [word for word, _, word_end in tokens if word_end <= start][-1:]
+            after = [word for word, word_start, _ in tokens if word_start >= end][:1]
+            following = text[end:].lstrip()
+            if (after and after[0] in route_separators or following.startswith("-")) and i + 1 < len(cities):
+                role = 'or_city'
+            elif before and before[0] in self.cues:
+                role = self.cues[before[0]]
+            else:
+                return None
+            spans.append((role, start, end))
+
+        entities = Counter(ent for ent, _, _ in spans)
+        if not spans or any(count > 1 for count in entities.values()):
+            return None
+
+        #Every word outside of the spans must be a filler word
+        for word, start, end in tokens:
+            if not any(s <= start < e for _, s, e in spans) and word not in self.fillers:
+                return None
+
+        return [(ent, start, end, 1.0) for ent, start, end in sorted(spans, key=lambda s: s[1])]
+
+    def predict(self, query):
+        #LUIS v3 prediction response, or None when the query is left to the remote model
+        spans = self.predict_spans(prepare_text(query))
+        return extractors.build_response(query, spans) if spans is not None else None
+
+
+_gazetteer = None
+
+
+def get_gazetteer():
+    #Built from the training data on first use, in about 0.1 s
+    global _gazetteer
+    if _gazetteer is None:
+        _gazetteer = Gazetteer.build(dataset.load_utterances(dataset.train_path))
+    return _gazetteer
+
+
+def predict(query):
+    return get_gazetteer().predict(query)
+
+
+async def get_entities(query, timeout=None, use_cache=True):
+    #Same interface as luis.get_entities, an empty prediction when the query is not recognized
+    resp = predict(query)
+    return resp if resp is not None else extractors.build_response(query, [])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("queries", nargs="+")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    gazetteer = get_gazetteer()
+    print(f"Built {len(gazetteer.cities)} cities and {len(gazetteer.fillers)} filler words in "
+        f"{time.perf_counter() - start:.3f} s", file=sys.stderr)
+    for query in args.queries:
+        print(json.dumps(gazetteer.predict(query)))
@@ -0,0 +1,26 @@
+# Gunicorn settings to serve the bot with several worker processes:
+#   gunicorn --config gunicorn.conf.py app:init_app
+# kill -HUP <master pid> restarts the workers gracefully, in-flight turns are completed first.
+
+import os
+
+bind = os.environ.get("BIND", "0.0.0.0:" + os.environ.get("PORT", "3978"))
+# A single worker unless WEB_CONCURRENCY is set, several workers need a shared BOT_STORAGE_PATH (see below)
+workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+worker_class = "aiohttp.GunicornWebWorker"
+
+# The app is imported by each worker after the fork, so that every worker has its own adapter,
+# bot, LUIS session and telemetry threads (threads do not survive a fork)
+preload_app = False
+reuse_port = True
+
+timeout = 600
+graceful_timeout = 30
+keepalive = 75
+
+# Any worker can serve any turn, so the conversation state must be shared by all of them. The database
+# is not cleaned up by the bot, it is set explicitly so that it lives where it can be looked after, on a
+# local disk: SQLite locking is not reliable on network file systems such as the /home share of App Service.
+if workers > 1 and not os.path.isabs(os.environ.get("BOT_STORAGE_PATH", "")):
+    raise RuntimeError(f"{workers} workers share the conversation state through a SQLite database, set its "
+        "absolute path in BOT_STORAGE_PATH (or WEB_CONCURRENCY=1)")
@@ -1,15 +1,22 @@
+import functools
 import logging
+import threading
 import time
 import random
 from datetime import datetime
-from opencensus.ext.azure.log_exporter import AzureLogHandler
-from opencensus.ext.azure import metrics_exporter
 from opencensus.stats import aggregation as aggregation_module
+from opencensus.stats import aggregation_data as aggregation_data_module
 from opencensus.stats import measure as measure_module
 from opencensus.stats import stats as stats_module
 from opencensus.stats import view as view_module
+from opencensus.tags import tag_key as tag_key_module
 from opencensus.tags import tag_map as tag_map_module
+from opencensus.tags import tag_value as tag_value_module
 import os
+from log_queue import LogQueue
+from accuracy_tracker import AccuracyTracker
+from latency_summary import LatencySummaries
+import prometheus
 
 
 try :
@@ -21,18 +28,41 @@ except ImportError:
     #We load the API key from git secrets
     insights_string = os.environ.get("INSIGHTS_CONNECTION_STRING")
 
+#Log queue settings: overflow policy is drop_oldest or sample
+log_queue_capacity = int(os.environ.get("LOG_QUEUE_CAPACITY", 10000))
+log_overflow = os.environ.get("LOG_OVERFLOW", "drop_oldest")
+log_sample_rate = float(os.environ.get("LOG_SAMPLE_RATE", 0.1))
+log_batch_size = int(os.environ.get("LOG_BATCH_SIZE", 100))
+log_flush_interval = float(os.environ.get("LOG_FLUSH_INTERVAL", 1.0))
+
+log_queue = None
+
 def configure_logger():
+	global log_queue
 	logger = logging.getLogger(__name__)
 
-	logger.addHandler(AzureLogHandler(
-	    connection_string=insights_string)
-	)
-	#Setting logger level to information
-	logger.setLevel('INFO')
+	#The Azure handler is fed by a bounded queue so that logging never waits on the exporter,
+	#the logger is shared by the modules calling this function and only configured once.
+	#The handler itself is created by the queue listener thread, off the start-up path
+	if log_queue is None:
+		log_queue = LogQueue(azure_log_handlers,
+			capacity=log_queue_capacity, overflow=log_overflow, sample_rate=log_sample_rate,
+			batch_size=log_batch_size, flush_interval=log_flush_interval).start()
+		logger.addHandler(log_queue)
+		#Setting logger level to information
+		logger.setLevel('INFO')
 
 	return logger
 
 
+def azure_log_handlers():
+	#Records are only exported to Azure when it is one of the telemetry exporters and a key is set
+	if 'azure' not in exporter_names or not insights_string:
+		return []
+	from opencensus.ext.azure.log_exporter import AzureLogHandler
+	return [AzureLogHandler(connection_string=insights_string)]
+
+
 stats = stats_module.stats
 view_manager = stats.view_manager
 stats_recorder = stats.stats_recorder
@@ -64,6 +94,58 @@ entity_accuracy_measure = measure_module.MeasureInt("entity_accuracy",
                                            "Accuracy taking into account the number of entities detected",
                                            "%")
 
+rolling_accuracy_measure = measure_module.MeasureInt("rolling_accuracy",
+                                           "Bot Accuracy over a rolling window",
+                                           "%")
+
+rolling_entity_accuracy_measure = measure_module.MeasureInt("rolling_entity_accuracy",
+                                           "Entity accuracy over a rolling window",
+                                           "%")
+
+luis_latency_measure = measure_module.MeasureFloat("luis_latency",
+                                           "Round trip time of the entity extraction of a query",
+                                           "ms")
+
+step_latency_measure = measure_module.MeasureFloat("dialog_step_latency",
+                                           "Time spent in a waterfall step of the dialog",
+                                           "ms")
+
+turn_latency_measure = measure_module.MeasureFloat("turn_latency",
+                                           "Time spent handling a turn, state saves included",
+                                           "ms")
+
+save_latency_measure = measure_module.MeasureFloat("state_save_latency",
+                                           "Time spent saving the changes of a bot state",
+                                           "ms")
+
+cache_hits_measure = measure_module.MeasureInt("cache_hits",
+                                           "Number of LUIS predictions served from the cache",
+                                           "requests")
+
+cache_misses_measure = measure_module.MeasureInt("cache_misses",
+                                           "Number of LUIS predictions not found in the cache",
+                                           "requests")
+
+luis_requests_measure = measure_module.MeasureInt("luis_requests",
+                                           "Number of LUIS prediction requests, by scheduling outcome",
+                                           "requests")
+
+luis_queue_depth_measure = measure_module.MeasureInt("luis_queue_depth",
+                                           "Number of LUIS prediction requests waiting for a slot",
+                                           "requests")
+
+luis_queue_wait_measure = measure_module.MeasureFloat("luis_queue_wait",
+                                           "Time a LUIS prediction request waited for a slot",
+                                           "ms")
+
+luis_errors_measure = measure_module.MeasureInt("luis_errors",
+                                           "Number of failed LUIS prediction attempts, by reason",
+                                           "requests")
+
+luis_breaker_measure = measure_module.MeasureInt("luis_breaker_state",
+                                           "State of the LUIS circuit breaker: 0 closed, 1 half open, 2 open",
+                                           "state")
+
 
 errors_view = view_module.View("number_errors",
                                "Count of the number of wrongly detected information",
@@ -77,11 +159,12 @@ success_view = view_module.View("number_success",
                                success_measure,
                                aggregation_module.CountAggregation())
 
+#Summed so that the entities of a turn are recorded as a single measurement
 detection_view = view_module.View("number_detection",
-                               "Count of the number of entities correctly detected by the LUIS algorithm",
+                               "Number of entities correctly detected by the LUIS algorithm",
                                [],
                                detected_measure,
-                               aggregation_module.CountAggregation())
+                               aggregation_module.SumAggregation())
 
 dialog_view = view_module.View("number_dialogs",
                                "Count of the number of dialogs entered by users",
@@ -108,102 +191,369 @@ entity_accuracy_view = view_module.View("entity_accuracy",
                                entity_accuracy_measure,
                                aggregation_module.LastValueAggregation())
 
+window_key = tag_key_module.TagKey("window")
 
+rolling_accuracy_view = view_module.View("rolling_accuracy",
+                               "Bot Accuracy over the last minute, 5 minutes and hour",
+                               [window_key],
+                               rolling_accuracy_measure,
+                               aggregation_module.LastValueAggregation())
 
-view_manager.register_view(errors_view)
-view_manager.register_view(success_view)
-view_manager.register_view(detection_view)
-view_manager.register_view(dialog_view)
-view_manager.register_view(score_view)
-view_manager.register_view(accuracy_view)
-view_manager.register_view(entity_accuracy_view)
-
-#mmap = stats_recorder.new_measurement_map()
-
-#tmap = tag_map_module.TagMap()
-
-exporter = metrics_exporter.new_metrics_exporter(
-	enable_standard_metrics = False,
-    connection_string=insights_string)
-
-
-view_manager.register_exporter(exporter)
-
-
-def save_success_or_failure(success=True):
-
-	mmap = stats_recorder.new_measurement_map()
-	tmap = tag_map_module.TagMap()
-
-	if not success:
-
-		mmap.measure_int_put(errors_measure, 1)
-		mmap.record(tmap)
-
-	else:
-		mmap.measure_int_put(success_measure, 1)
-		mmap.record(tmap)
-
-	metrics = list(mmap.measure_to_view_map.get_metrics(datetime.utcnow()))
-	if len(metrics) > 1:
-		errors = metrics[0].time_series[0].points[0].value.value
-		successes = metrics[1].time_series[0].points[0].value.value
-		return errors, successes
-	else:
-		#Not enough information, return 1/1 for baseline 50% accuracy
-		return 1,1
+rolling_entity_accuracy_view = view_module.View("rolling_entity_accuracy",
+                               "Entity accuracy over the last minute, 5 minutes and hour",
+                               [window_key],
+                               rolling_entity_accuracy_measure,
+                               aggregation_module.LastValueAggregation())
 
+#Latency histogram boundaries in milliseconds, LATENCY_BUCKETS_MS is a comma separated list
+latency_buckets = [float(bound) for bound in
+	os.environ.get("LATENCY_BUCKETS_MS", "5,10,25,50,100,250,500,1000,2500,5000,10000").split(",")]
 
+backend_key = tag_key_module.TagKey("backend")
+step_key = tag_key_module.TagKey("step")
+scope_key = tag_key_module.TagKey("scope")
 
-def save_accuracy(err, succ):
+luis_latency_view = view_module.View("luis_latency",
+                               "Distribution of the entity extraction round trip times, by backend",
+                               [backend_key],
+                               luis_latency_measure,
+                               aggregation_module.DistributionAggregation(latency_buckets))
 
-	mmap_acc = stats_recorder.new_measurement_map()
-	tmap_acc = tag_map_module.TagMap()
+step_latency_view = view_module.View("dialog_step_latency",
+                               "Distribution of the time spent in each waterfall step",
+                               [step_key],
+                               step_latency_measure,
+                               aggregation_module.DistributionAggregation(latency_buckets))
 
-	accuracy = int(100*succ / (err+succ))
+turn_latency_view = view_module.View("turn_latency",
+                               "Distribution of the time spent handling a turn",
+                               [],
+                               turn_latency_measure,
+                               aggregation_module.DistributionAggregation(latency_buckets))
 
-	mmap_acc.measure_int_put(accuracy_measure, accuracy)
-	mmap_acc.record(tmap_acc)
+save_latency_view = view_module.View("state_save_latency",
+                               "Distribution of the time spent saving the bot states, by scope",
+                               [scope_key],
+                               save_latency_measure,
+                               aggregation_module.DistributionAggregation(latency_buckets))
 
-def save_entity_accuracy(err, n_entities):
+cache_hits_view = view_module.View("cache_hits",
+                               "Count of the number of LUIS predictions served from the cache",
+                               [],
+                               cache_hits_measure,
+                               aggregation_module.CountAggregation())
 
-	mmap_acc_ent = stats_recorder.new_measurement_map()
-	tmap_acc_ent = tag_map_module.TagMap()
+cache_misses_view = view_module.View("cache_misses",
+                               "Count of the number of LUIS predictions not found in the cache",
+                               [],
+                               cache_misses_measure,
+                               aggregation_module.CountAggregation())
 
-	accuracy = int(100*n_entities / (err+n_entities))
+outcome_key = tag_key_module.TagKey("outcome")
 
-	mmap_acc_ent.measure_int_put(entity_accuracy_measure, accuracy)
-	mmap_acc_ent.record(tmap_acc_ent)
+luis_requests_view = view_module.View("luis_requests",
+                               "Count of the LUIS prediction requests sent, coalesced, rejected or timed out",
+                               [outcome_key],
+                               luis_requests_measure,
+                               aggregation_module.CountAggregation())
 
+luis_queue_depth_view = view_module.View("luis_queue_depth",
+                               "Number of LUIS prediction requests waiting for a slot",
+                               [],
+                               luis_queue_depth_measure,
+                               aggregation_module.LastValueAggregation())
 
-def save_request_data(success=True):
-	err, succ = save_success_or_failure(success)
-	save_accuracy(err,succ)
+luis_queue_wait_view = view_module.View("luis_queue_wait",
+                               "Distribution of the time LUIS prediction requests waited for a slot",
+                               [],
+                               luis_queue_wait_measure,
+                               aggregation_module.DistributionAggregation(latency_buckets))
 
-def save_user_score(score):
-	mmap_score = stats_recorder.new_measurement_map()
-	tmap_score = tag_map_module.TagMap()
+reason_key = tag_key_module.TagKey("reason")
 
-	mmap_score.measure_int_put(score_measure, score)
-	mmap_score.record(tmap_score)
+luis_errors_view = view_module.View("luis_errors",
+                               "Count of the failed LUIS prediction attempts, by reason",
+                               [reason_key],
+                               luis_errors_measure,
+                               aggregation_module.CountAggregation())
 
-def save_entities_detected(n_entities: int):
-	mmap_entities = stats_recorder.new_measurement_map()
-	tmap_entities = tag_map_module.TagMap()
+luis_breaker_view = view_module.View("luis_breaker_state",
+                               "State of the LUIS circuit breaker: 0 closed, 1 half open, 2 open",
+                               [],
+                               luis_breaker_measure,
+                               aggregation_module.LastValueAggregation())
 
-	#Saving n successes, n being the number of entities detected
-	for i in range(n_entities):
-		mmap_entities.measure_int_put(detected_measure, 1)
-		mmap_entities.record(tmap_entities)
 
+#mmap = stats_recorder.new_measurement_map()
 
-def save_n_dialog():
-	mmap_dialog = stats_recorder.new_measurement_map()
-	tmap_dialog = tag_map_module.TagMap()
+#tmap = tag_map_module.TagMap()
 
-	mmap_dialog.measure_int_put(dialog_measure, 1)
-	mmap_dialog.record(tmap_dialog)
+#Application Insights drops the distributions, it gets the mean and quantiles of the latencies instead
+latency_summaries = LatencySummaries(view_manager, [luis_latency_view, step_latency_view, turn_latency_view,
+	save_latency_view, luis_queue_wait_view])
 
+def azure_exporter():
+	from opencensus.ext.azure import metrics_exporter
+	from opencensus.metrics import transport
+	exporter = metrics_exporter.new_metrics_exporter(
+		enable_standard_metrics = False,
+	    connection_string=insights_string)
+	exporter.summary_thread = transport.get_exporter_thread([latency_summaries], exporter,
+		interval=exporter.options.export_interval)
+	return exporter
+
+def prometheus_exporter():
+	return prometheus.PrometheusExporter(collectors=[prometheus.process_metrics, log_queue_metrics])
+
+def log_queue_metrics():
+	if log_queue is None:
+		return ""
+	return prometheus.render_family("flybot_log_records_total", "counter", "Log records by outcome in the log queue",
+		[("", [("outcome", key)], value) for key, value in log_queue.stats.items() if key != 'batches'])
+
+#Metrics exporters, TELEMETRY_EXPORTERS is a comma separated list of their names. The prometheus one serves
+#/metrics without authentication, it is only enabled on request, for hosts where the port is not public
+exporter_factories = {'azure': azure_exporter, 'prometheus': prometheus_exporter}
+exporter_names = [name.strip() for name in os.environ.get("TELEMETRY_EXPORTERS", "azure").split(",")
+	if name.strip()]
+exporters = {}
+
+def register_exporters(names):
+	for name in names:
+		if name not in exporter_factories:
+			raise ValueError(f"Unknown telemetry exporter '{name}', expected one of {sorted(exporter_factories)}")
+		if name == 'azure' and not insights_string:
+			#The Azure exporter cannot be built without a connection string, the others still are
+			logging.getLogger(__name__).warning("No Application Insights connection string is set, "
+				"the azure telemetry exporter is disabled")
+			continue
+		if name not in exporters:
+			exporters[name] = exporter_factories[name]()
+			view_manager.register_exporter(exporters[name])
+	return exporters
+
+
+views = [errors_view, success_view, detection_view, dialog_view, score_view, accuracy_view, entity_accuracy_view,
+	rolling_accuracy_view, rolling_entity_accuracy_view, luis_latency_view, step_latency_view, turn_latency_view,
+	save_latency_view, cache_hits_view, cache_misses_view, luis_requests_view, luis_queue_depth_view,
+	luis_queue_wait_view, luis_errors_view, luis_breaker_view]
+
+telemetry_lock = threading.Lock()
+telemetry_started = False
+
+def init_telemetry():
+	#Registers the views and starts the exporters, once: when the app is started (see app.py), so that
+	#importing this module stays cheap, or on the first recording
+	global telemetry_started
+	if telemetry_started:
+		return
+	with telemetry_lock:
+		if not telemetry_started:
+			for view in views:
+				view_manager.register_view(view)
+			register_exporters(exporter_names)
+			telemetry_started = True
+
+def recording(function):
+	#Telemetry errors are logged, once per helper, and never raised to the dialog turn recording the metric
+	failures = []
+
+	@functools.wraps(function)
+	def record(*args, **kwargs):
+		try:
+			return function(*args, **kwargs)
+		except Exception:
+			if not failures:
+				logging.getLogger(__name__).exception("Recording %s failed", function.__name__)
+			failures.append(function.__name__)
+
+	return record
+
+def new_measurement_map():
+	init_telemetry()
+	return stats_recorder.new_measurement_map()
+
+async def handle_metrics(request):
+	init_telemetry()
+	return await exporters['prometheus'].handle(request)
+
+
+#Tag maps are built once and shared by every recording
+empty_tags = tag_map_module.TagMap()
+tag_maps = {}
+
+def get_tag_map(key, value):
+	tmap = tag_maps.get((key, value))
+	if tmap is None:
+		tmap = tag_map_module.TagMap()
+		tmap.insert(key, tag_value_module.TagValue(value))
+		tag_maps[(key, value)] = tmap
+	return tmap
+
+#Accuracy counters and rolling windows, the rolling accuracies are published at most once per interval:
+#the calls made within the interval of the last publication are published together at its end
+tracker = AccuracyTracker()
+accuracy_publish_interval = float(os.environ.get("ACCURACY_PUBLISH_INTERVAL", 1.0))
+window_tags = {window: get_tag_map(window_key, window) for window in tracker.requests}
+accuracy_publish_lock = threading.Lock()
+last_accuracy_publish = None
+accuracy_publish_timer = None
+
+
+def get_count(view):
+	#Aggregated value of a view without tag keys, 0 if nothing has been recorded yet
+	init_telemetry()
+	data = view_manager.get_view(view.name).tag_value_aggregation_data_map.get(())
+	if data is None:
+		return 0
+	if isinstance(data, aggregation_data_module.CountAggregationData):
+		return data.count_data
+	return data.sum_data
+
+
+@recording
+def save_turn_metrics(success=None, detected=0, entity_errors=None, score=None, dialog=False):
+	"""
+	  Records every metric of a turn in a single measurement map operation:
+	  success: outcome of the confirmation prompt, also updating the overall accuracy (None if not asked)
+	  detected: correctly detected entities
+	  entity_errors: wrongly detected entities, the entity accuracy is only recorded if set
+	  score: user score, dialog: a dialog was opened
+	"""
+	mmap = new_measurement_map()
+
+	if success is not None:
+		tracker.record_request(success)
+		mmap.measure_int_put(success_measure if success else errors_measure, 1)
+		mmap.measure_int_put(accuracy_measure, int(100*tracker.accuracy()))
+
+	if detected > 0:
+		mmap.measure_int_put(detected_measure, detected)
+
+	if entity_errors is not None and detected + entity_errors > 0:
+		tracker.record_entities(detected, entity_errors)
+		mmap.measure_int_put(entity_accuracy_measure, int(100*detected / (entity_errors+detected)))
+
+	if score is not None:
+		mmap.measure_int_put(score_measure, score)
+
+	if dialog:
+		mmap.measure_int_put(dialog_measure, 1)
+
+	mmap.record(empty_tags)
+
+	if success is not None or entity_errors is not None:
+		save_accuracy()
+
+
+@recording
+def save_accuracy(force=False):
+	global accuracy_publish_timer
+	with accuracy_publish_lock:
+		wait = 0.0
+		if not force and last_accuracy_publish is not None:
+			wait = last_accuracy_publish + accuracy_publish_interval - tracker.clock()
+		if wait > 0:
+			if accuracy_publish_timer is None:
+				accuracy_publish_timer = threading.Timer(wait, publish_accuracy)
+				accuracy_publish_timer.daemon = True
+				accuracy_publish_timer.start()
+			return
+	publish_accuracy()
+
+
+@recording
+def publish_accuracy():
+	#Publishing the rolling accuracies of the tracker, one recording per window
+	global last_accuracy_publish, accuracy_publish_timer
+	with accuracy_publish_lock:
+		last_accuracy_publish = tracker.clock()
+		accuracy_publish_timer = None
+
+	for window, tags in window_tags.items():
+		accuracy = tracker.accuracy(window)
+		entity_accuracy = tracker.entity_accuracy(window)
+		if accuracy is None and entity_accuracy is None:
+			continue
+		mmap_acc = new_measurement_map()
+		if accuracy is not None:
+			mmap_acc.measure_int_put(rolling_accuracy_measure, int(100*accuracy))
+		if entity_accuracy is not None:
+			mmap_acc.measure_int_put(rolling_entity_accuracy_measure, int(100*entity_accuracy))
+		mmap_acc.record(tags)
+
+
+@recording
+def save_latency(measure, seconds, tags=empty_tags):
+	mmap_latency = new_measurement_map()
+	mmap_latency.measure_float_put(measure, 1000*seconds)
+	mmap_latency.record(tags)
+
+@recording
+def save_luis_latency(seconds, backend):
+	save_latency(luis_latency_measure, seconds, get_tag_map(backend_key, backend))
+
+@recording
+def save_step_latency(step, seconds):
+	save_latency(step_latency_measure, seconds, get_tag_map(step_key, step))
+
+@recording
+def save_turn_latency(seconds, save_timings=None):
+	#save_timings are the durations of the state saves of the turn, by scope
+	save_latency(turn_latency_measure, seconds)
+	for scope, save_seconds in (save_timings or {}).items():
+		save_latency(save_latency_measure, save_seconds, get_tag_map(scope_key, scope))
+
+
+def timed_step(step):
+	#Wraps a dialog step to record its duration, tagged by the step name
+	name = step.__name__
+
+	@functools.wraps(step)
+	async def timed(*args):
+		start = time.perf_counter()
+		try:
+			return await step(*args)
+		finally:
+			save_step_latency(name, time.perf_counter() - start)
+
+	return timed
+
+
+@recording
+def save_cache_lookup(hit=True):
+	mmap_cache = new_measurement_map()
+
+	if hit:
+		mmap_cache.measure_int_put(cache_hits_measure, 1)
+	else:
+		mmap_cache.measure_int_put(cache_misses_measure, 1)
+	mmap_cache.record(empty_tags)
+
+@recording
+def save_luis_schedule(outcome, wait, depth):
+	#Observer of the LUIS request scheduler, called for every prediction request
+	mmap_schedule = new_measurement_map()
+	mmap_schedule.measure_int_put(luis_requests_measure, 1)
+	mmap_schedule.measure_int_put(luis_queue_depth_measure, depth)
+	#Coalesced requests do not wait for a slot of their own
+	if outcome != 'coalesced':
+		mmap_schedule.measure_float_put(luis_queue_wait_measure, 1000*wait)
+	mmap_schedule.record(get_tag_map(outcome_key, outcome))
+
+@recording
+def save_luis_error(reason):
+	#reason is 'timeout', 'connection', 'status', 'invalid', 'rejected' or 'short_circuited'
+	mmap_error = new_measurement_map()
+	mmap_error.measure_int_put(luis_errors_measure, 1)
+	mmap_error.record(get_tag_map(reason_key, reason))
+
+@recording
+def save_luis_breaker(state):
+	#Observer of the LUIS circuit breaker, called on every state change
+	mmap_breaker = new_measurement_map()
+	mmap_breaker.measure_int_put(luis_breaker_measure, ("closed", "half_open", "open").index(state))
+	mmap_breaker.record(empty_tags)
 
 
 #The code below has been used to test the different functions in this file
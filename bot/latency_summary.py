@@ -0,0 +1,83 @@
+"""
+  Mean and quantiles of the latency distributions, as gauges for the exporters which do not take
+  distributions: the Azure metrics exporter drops them, so Application Insights gets these instead.
+
+  The gauges are computed when the exporter reads them, from the difference of the histogram buckets with
+  the previous reading: each reading covers the recordings of the last export interval, and the quantiles
+  are interpolated within their bucket. A single exporter must read them.
+"""
+import threading
+from datetime import datetime
+
+from opencensus.metrics import label_key, label_value
+from opencensus.metrics.export import metric, metric_descriptor, metric_producer, point, time_series, value
+
+
+def quantile(bounds, counts, q):
+    #Linear interpolation within the bucket holding the q quantile, the last bucket has no upper bound
+    rank = q * sum(counts)
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            lower = bounds[i - 1] if i > 0 else 0.0
+            if i == len(bounds):
+                return lower
+            return lower + (bounds[i] - lower) * (rank - seen) / count
+        seen += count
+    return bounds[-1] if bounds else 0.0
+
+
+class LatencySummaries(metric_producer.MetricProducer):
+    """
+      Metric producer of the <view>_mean and <view>_p<quantile> gauges of distribution views, by the tags of
+      the view, over the interval since the previous reading. Series without recordings in the interval
+      are left out.
+    """
+
+    def __init__(self, view_manager, views, quantiles=(0.5, 0.95, 0.99)):
+        self.view_manager = view_manager
+        self.views = list(views)
+        self.quantiles = quantiles
+        self._previous = {}
+        self._lock = threading.Lock()
+
+    def read(self, view):
+        #{tag values: {gauge suffix: value}} of the recordings since the previous reading
+        view_data = self.view_manager.get_view(view.name)
+        if view_data is None:
+            return {}
+        summaries = {}
+        with self._lock:
+            for tag_values, data in list(view_data.tag_value_aggregation_data_map.items()):
+                counts, total = list(data.counts_per_bucket), data.sum
+                previous_counts, previous_total = self._previous.get((view.name, tag_values), ([0] * len(counts), 0.0))
+                self._previous[view.name, tag_values] = (counts, total)
+
+                delta = [count - previous for count, previous in zip(counts, previous_counts)]
+                n = sum(delta)
+                if n <= 0:
+                    continue
+                summary = {'mean': (total - previous_total) / n}
+                for q in self.quantiles:
+                    summary[f"p{round(100 * q)}"] = quantile(data.bounds, delta, q)
+                summaries[tag_values] = summary
+        return summaries
+
+    def get_metrics(self):
+        now = datetime.utcnow()
+        metrics = []
+        for view in self.views:
+            series = {}
+            for tag_values, summary in self.read(view).items():
+                labels = [label_value.LabelValue(tag) for tag in tag_values]
+                for suffix, gauge in summary.items():
+                    series.setdefault(suffix, []).append(
+                        time_series.TimeSeries(labels, [point.Point(value.ValueDouble(gauge), now)], None))
+
+            keys = [label_key.LabelKey(key, key) for key in view.columns]
+            for suffix, gauge_series in series.items():
+                descriptor = metric_descriptor.MetricDescriptor(f"{view.name}_{suffix}",
+                    f"{suffix} of the last interval: {view.description}", view.measure.unit,
+                    metric_descriptor.MetricDescriptorType.GAUGE_DOUBLE, keys)
+                metrics.append(metric.Metric(descriptor, gauge_series))
+        return metrics
@@ -0,0 +1,215 @@
+import argparse
+import asyncio
+import logging
+import os
+import re
+import threading
+import time
+import zlib
+
+import numpy as np
+
+import dataset
+import extractors
+#update_entities is re-exported so this module can stand in for luis
+from luis import relevant_entities, update_entities
+
+
+#Model file, built by running this module from a checkout of the repository (the training data is not
+#deployed with the bot) and deployed along with it when ENTITY_BACKEND=local. If missing, the model is
+#trained in memory on first use, in about 8 s, and not saved.
+model_path = os.environ.get("LOCAL_MODEL_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "local_model.npz"))
+
+token_pattern = re.compile(r"\w+|[^\w\s]")
+
+labels = ['O'] + [prefix + ent for ent in relevant_entities for prefix in ('B-', 'I-')]
+
+#Number of hashed feature buckets
+n_buckets = 1 << 18
+
+
+def tokenize(text):
+    return [(m.group(), m.start(), m.end()) for m in token_pattern.finditer(text)]
+
+
+def prepare_text(query):
+    #Same rewrite as the training data, only applied if character offsets are preserved
+    text = query.replace("$", "€").lower()
+    return text if len(text) == len(query) else query
+
+
+def word_shape(word):
+    return re.sub('[a-z]+', 'a', re.sub('[0-9]+', '0', word))
+
+
+def token_features(words):
+    #Window of two words on each side, plus word shapes and bigrams
+    padded = ['<s2>', '<s>'] + words + ['</s>', '</s2>']
+    features = []
+    for i, word in enumerate(words):
+        p2, p1, n1, n2 = padded[i], padded[i + 1], padded[i + 3], padded[i + 4]
+        shape = word_shape(word)
+        features.append(('b', 'w=' + word, 'p3=' + word[:3], 's3=' + word[-3:], 's2=' + word[-2:],
+            'sh=' + shape, 'p1=' + p1, 'p2=' + p2, 'n1=' + n1, 'n2=' + n2,
+            'p1w=' + p1 + '|' + word, 'wn1=' + word + '|' + n1, 'p2p1=' + p2 + '|' + p1,
+            'n1n2=' + n1 + '|' + n2, 'p1sh=' + p1 + '|' + shape, 'shn1=' + shape + '|' + n1))
+    return features
+
+n_features = 16
+
+
+def featurize(words):
+    #Stable hashing (crc32) so that features do not depend on the process hash seed
+    return np.fromiter((zlib.crc32(f.encode()) & (n_buckets - 1) for row in token_features(words) for f in row),
+        dtype=np.int32, count=len(words) * n_features).reshape(len(words), n_features)
+
+
+def encode_labels(tokens, spans):
+    y = np.zeros(len(tokens), dtype=np.int64)
+    for ent, start, end in spans:
+        if ent not in relevant_entities:
+            continue
+        first = True
+        for i, (_, tok_start, tok_end) in enumerate(tokens):
+            if tok_start >= start and tok_end <= end:
+                y[i] = labels.index(('B-' if first else 'I-') + ent)
+                first = False
+    return y
+
+
+class EntityModel:
+    """
+      Hashed-feature softmax token classifier (BIO tags) for the five booking entities.
+    """
+
+    def __init__(self, weights: np.ndarray=None):
+        self.weights = weights if weights is not None else np.zeros((n_buckets, len(labels)), dtype=np.float32)
+
+    def train(self, utterances, epochs: int=8, batch_size: int=256, learning_rate: float=0.5,
+        l2: float=1e-6, seed: int=0):
+        #Featurizing the whole corpus once, one row per token
+        x, y = [], []
+        for text, _, spans in utterances:
+            tokens = tokenize(text)
+            if tokens:
+                x.append(featurize([t[0] for t in tokens]))
+                y.append(encode_labels(tokens, spans))
+        x = np.concatenate(x)
+        y = np.concatenate(y)
+
+        #Minibatch AdaGrad on the softmax cross entropy, only touching the active rows
+        rng = np.random.RandomState(seed)
+        squared = np.zeros_like(self.weights)
+        for epoch in range(epochs):
+            order = rng.permutation(len(x))
+            for b in range(0, len(order), batch_size):
+                idx = order[b:b + batch_size]
+                xb, yb = x[idx], y[idx]
+                probs = self.probabilities(xb)
+                probs[np.arange(len(yb)), yb] -= 1
+
+                rows, inverse = np.unique(xb.ravel(), return_inverse=True)
+                grad = np.zeros((len(rows), len(labels)), dtype=np.float32)
+                np.add.at(grad, inverse, np.repeat(probs, n_features, axis=0))
+                grad += l2 * self.weights[rows]
+
+                squared[rows] += grad * grad
+                self.weights[rows] -= learning_rate * grad / np.sqrt(squared[rows] + 1e-8)
+
+        return self
+
+    def probabilities(self, x):
+        scores = self.weights[x].sum(axis=1)
+        scores -= scores.max(axis=1, keepdims=True)
+        np.exp(scores, out=scores)
+        scores /= scores.sum(axis=1, keepdims=True)
+        return scores
+
+    def predict_spans(self, text):
+        #Returns (entity, start, end, score) spans for an already prepared text
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+
+        probs = self.probabilities(featurize([t[0] for t in tokens]))
+        predicted = probs.argmax(axis=1)
+
+        #Merging B/I tags into spans, an I tag without a matching B starts a new span
+        spans = []
+        current = None
+        for (_, start, end), label, p in zip(tokens, predicted, probs.max(axis=1)):
+            if label == 0:
+                current = None
+                continue
+            tag, ent = labels[label][:2], labels[label][2:]
+            if tag == 'I-' and current is not None and current[0] == ent:
+                current[2] = end
+                current[3] = min(current[3], p)
+            else:
+                current = [ent, start, end, p]
+                spans.append(current)
+
+        return [(ent, start, end, float(score)) for ent, start, end, score in spans]
+
+    def predict(self, query):
+        return extractors.build_response(query, self.predict_spans(prepare_text(query)))
+
+    def save(self, path):
+        #Only the rows touched during training are stored, as half precision floats
+        rows = np.flatnonzero(np.any(self.weights != 0, axis=1)).astype(np.int32)
+        np.savez_compressed(path, rows=rows, weights=self.weights[rows].astype(np.float16),
+            labels=np.array(labels), n_buckets=n_buckets)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if int(data['n_buckets']) != n_buckets or list(data['labels']) != labels:
+                raise ValueError(f"Incompatible local model file: {path}")
+            weights = np.zeros((n_buckets, len(labels)), dtype=np.float32)
+            weights[data['rows']] = data['weights']
+        return cls(weights)
+
+
+_model = None
+#The warm-up thread and the first turns may ask for the model at the same time, it is only loaded once
+_model_lock = threading.Lock()
+
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                if os.path.exists(model_path):
+                    _model = EntityModel.load(model_path)
+                else:
+                    logging.getLogger(__name__).warning("No local model at %s, training it in memory (run "
+                        "python local_model.py to build it)", model_path)
+                    _model = EntityModel().train(dataset.load_utterances(dataset.train_path))
+    return _model
+
+
+def predict(query):
+    return get_model().predict(query)
+
+
+async def get_entities(query, timeout=None, use_cache=True):
+    #Same interface as luis.get_entities, without any network call. The model is loaded off the event loop.
+    if _model is None:
+        await asyncio.get_running_loop().run_in_executor(None, get_model)
+    return predict(query)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train the local entity extraction model")
+    parser.add_argument("--data", default=dataset.train_path, help="Utterance file used for training")
+    parser.add_argument("--out", default=model_path, help="Path of the serialized model")
+    parser.add_argument("--epochs", type=int, default=8)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    model = EntityModel().train(dataset.load_utterances(args.data), epochs=args.epochs)
+    model.save(args.out)
+    print(f"Model trained in {time.perf_counter() - start:.1f}s, saved to {args.out} "
+        f"({os.path.getsize(args.out) / 1024:.0f} KB)")
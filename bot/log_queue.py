@@ -0,0 +1,132 @@
+import logging
+import random
+import threading
+import traceback
+from collections import deque
+
+
+class LogQueue(logging.Handler):
+    """
+      Bounded in-memory queue in front of slow logging handlers (e.g. the AzureLogHandler).
+      Logging a record only appends it to the queue, a listener thread hands the records to the
+      handlers in batches, so that a slow or unreachable exporter never delays the caller.
+
+      handlers may also be a function returning them, called by the listener thread so that
+      creating the handlers does not delay the start-up.
+
+      When the queue is full, the overflow policy decides what is lost:
+      drop_oldest: the oldest queued record is dropped for the new one
+      sample: once the queue is half full only a sample_rate share of the new records is kept,
+      and new records are dropped when it is full
+    """
+
+    policies = ("drop_oldest", "sample")
+
+    def __init__(self, handlers, capacity: int=10000, overflow: str="drop_oldest", sample_rate: float=0.1,
+        batch_size: int=100, flush_interval: float=1.0, seed=None):
+        super(LogQueue, self).__init__()
+        if overflow not in self.policies:
+            raise ValueError(f"Unknown overflow policy '{overflow}', expected one of {self.policies}")
+        if capacity < 1:
+            raise ValueError("The queue capacity must be positive")
+        self.handlers = handlers if callable(handlers) else list(handlers)
+        self.capacity = capacity
+        self.overflow = overflow
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats = {'queued': 0, 'dropped': 0, 'sampled_out': 0, 'handled': 0, 'batches': 0, 'handler_errors': 0}
+
+        self._records = deque()
+        self._condition = threading.Condition()
+        self._rng = random.Random(seed)
+        self._stopping = False
+        self._thread = None
+
+    def handle(self, record):
+        #emit synchronizes on the queue condition only, the handler lock is left to the other methods
+        rv = self.filter(record)
+        if isinstance(rv, logging.LogRecord):
+            record = rv
+        if rv:
+            self.emit(record)
+        return rv
+
+    def start(self):
+        if self._thread is None:
+            self._stopping = False
+            self._thread = threading.Thread(target=self._listen, name="LogQueue listener", daemon=True)
+            self._thread.start()
+        return self
+
+    def emit(self, record):
+        with self._condition:
+            size = len(self._records)
+            if size >= self.capacity:
+                self.stats['dropped'] += 1
+                if self.overflow == "sample":
+                    return
+                self._records.popleft()
+                size -= 1
+            elif self.overflow == "sample" and size >= self.capacity // 2 and self._rng.random() >= self.sample_rate:
+                self.stats['sampled_out'] += 1
+                return
+
+            self._records.append(record)
+            self.stats['queued'] += 1
+            #The listener is woken up for full batches only, smaller ones wait for the flush interval
+            if size + 1 >= self.batch_size:
+                self._condition.notify()
+
+    def _next_batch(self):
+        with self._condition:
+            if len(self._records) < self.batch_size and not self._stopping:
+                self._condition.wait(self.flush_interval)
+            count = min(len(self._records), self.batch_size)
+            return [self._records.popleft() for _ in range(count)]
+
+    def _listen(self):
+        if callable(self.handlers):
+            try:
+                self.handlers = list(self.handlers())
+            except Exception:
+                #Records are still counted, but cannot be exported
+                traceback.print_exc()
+                self.handlers = []
+                self.stats['handler_errors'] += 1
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._handle(batch)
+            elif self._stopping:
+                return
+
+    def _handle(self, batch):
+        for record in batch:
+            for handler in self.handlers:
+                if record.levelno < handler.level:
+                    continue
+                try:
+                    handler.handle(record)
+                except Exception:
+                    self.stats['handler_errors'] += 1
+        self.stats['handled'] += len(batch)
+        self.stats['batches'] += 1
+
+    def pending(self):
+        return len(self._records)
+
+    def stop(self, timeout: float=None):
+        #Hands the queued records to the handlers before returning
+        if self._thread is None:
+            return
+        with self._condition:
+            self._stopping = True
+            self._condition.notify()
+        self._thread.join(timeout)
+        self._thread = None
+
+    def close(self):
+        #Called by logging.shutdown before the handlers created earlier, like the exporter ones
+        self.stop()
+        super(LogQueue, self).close()
@@ -1,7 +1,12 @@
-import requests
-import pandas as pd
-import numpy as np
+import asyncio
+import aiohttp
 import os
+import random
+import time
+import insights
+from circuit_breaker import CircuitBreaker
+from prediction_cache import PredictionCache
+from request_scheduler import RequestScheduler
 
 
 try :
@@ -23,7 +28,139 @@ relevant_entities = ['budget','dst_city','or_city','str_date','end_date']
 entities_dict = {'budget': 'Budget', 'dst_city': 'Destination City', 'or_city': 'Departure City','str_date': 'Start Date',
 'end_date': 'Return Date'}
 
-def get_entities(query):
+#Entity extraction backend: 'luis' for the prediction endpoint, 'local' for the offline model
+backend = os.environ.get("ENTITY_BACKEND", "luis")
+
+#With LUIS_FAST_PATH=1, plain utterances such as "dublin to osaka" or "3200 max" are answered by the
+#gazetteer of cities and budget patterns (see gazetteer.py) without a prediction request
+fast_path = os.environ.get("LUIS_FAST_PATH", "0") == "1"
+
+#Prediction slot the app is published to
+slot = os.environ.get("LUIS_SLOT", "staging")
+
+#Connection pool settings for the prediction endpoint
+connection_limit = int(os.environ.get("LUIS_CONNECTION_LIMIT", 100))
+keepalive_timeout = float(os.environ.get("LUIS_KEEPALIVE_TIMEOUT", 30))
+request_timeout = float(os.environ.get("LUIS_TIMEOUT", 5))
+
+#Prediction cache, keyed on the exact utterances and scoped to the app id and slot
+cache = PredictionCache(maxsize=int(os.environ.get("LUIS_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("LUIS_CACHE_TTL", 3600)))
+
+#A prediction, retries included, must complete within LUIS_DEADLINE seconds. Timeouts, connection errors,
+#throttling and server errors are retried up to LUIS_RETRIES times, after a random delay of up to
+#LUIS_RETRY_BACKOFF seconds doubling on every retry (or the Retry-After delay of the endpoint)
+deadline = float(os.environ.get("LUIS_DEADLINE", 3))
+retries = int(os.environ.get("LUIS_RETRIES", 2))
+retry_backoff = float(os.environ.get("LUIS_RETRY_BACKOFF", 0.1))
+
+#Scheduling of the prediction requests, identical utterances in flight sharing one request:
+#LUIS_MAX_CONCURRENCY: requests running at once (20)
+#LUIS_RATE_LIMIT: requests started per second, 0 for no limit (50)
+#LUIS_RATE_BURST: requests started at once when the rate allows it, 1 stays within a per second quota (1)
+#LUIS_MAX_QUEUE: requests waiting for their turn, the next ones are rejected right away (200)
+#LUIS_MAX_WAIT: seconds a request waits for its turn (LUIS_DEADLINE, so that the deadline alone ends the wait)
+scheduler = RequestScheduler(max_concurrency=int(os.environ.get("LUIS_MAX_CONCURRENCY", 20)),
+    rate=float(os.environ.get("LUIS_RATE_LIMIT", 50)),
+    burst=float(os.environ.get("LUIS_RATE_BURST", 1)),
+    max_queue=int(os.environ.get("LUIS_MAX_QUEUE", 200)),
+    max_wait=float(os.environ.get("LUIS_MAX_WAIT", deadline)),
+    observer=insights.save_luis_schedule)
+
+#The breaker opens when half of the last 20 requests failed or took more than LUIS_BREAKER_SLOW_CALL
+#seconds, predictions are then refused right away (and the dialogs switch to manual input) for
+#LUIS_BREAKER_RESET seconds before a trial request
+breaker = CircuitBreaker(window=int(os.environ.get("LUIS_BREAKER_WINDOW", 20)),
+    min_calls=int(os.environ.get("LUIS_BREAKER_MIN_CALLS", 10)),
+    failure_rate=float(os.environ.get("LUIS_BREAKER_FAILURE_RATE", 0.5)),
+    slow_call=float(os.environ.get("LUIS_BREAKER_SLOW_CALL", 2)),
+    slow_rate=float(os.environ.get("LUIS_BREAKER_SLOW_RATE", 0.5)),
+    reset_timeout=float(os.environ.get("LUIS_BREAKER_RESET", 30)),
+    observer=insights.save_luis_breaker)
+
+
+class LuisUnavailable(Exception):
+    """
+      Raised when no prediction could be obtained before the deadline, or right away while the circuit
+      breaker is open. reason is the cause of the last failure ('timeout', 'connection', 'status', 'invalid',
+      'rejected' or 'short_circuited') and status the HTTP status of an error response.
+    """
+
+    def __init__(self, message, reason, status=None, retry_after=None):
+        super().__init__(message)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.reason in ('timeout', 'connection') or self.status == 429 or (self.status or 0) >= 500
+
+#Sent by the dialogs when LuisUnavailable is raised, before asking for the entities one by one
+unavailable_text = "Booking information cannot be detected at the moment, switching to manual input."
+
+#Shared session, created lazily on the running event loop
+_session = None
+_session_loop = None
+
+
+def get_session():
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(limit=connection_limit, keepalive_timeout=keepalive_timeout)
+        _session = aiohttp.ClientSession(connector=connector,
+            timeout=aiohttp.ClientTimeout(total=request_timeout))
+        _session_loop = loop
+
+    return _session
+
+
+async def close_session(app=None):
+    #Can be registered as an aiohttp on_cleanup callback
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+    _session_loop = None
+
+
+def warm_up():
+    #Loads the local model and the gazetteer ahead of the first query, called in the background at start-up
+    #(see app.py)
+    if fast_path:
+        import gazetteer
+        gazetteer.get_gazetteer()
+    if backend == 'local':
+        import local_model
+        local_model.get_model()
+
+
+async def get_entities(query, timeout=None, use_cache=True):
+
+    start = time.perf_counter()
+    source = backend
+    try:
+        if fast_path:
+            #The remote call is skipped when the gazetteer explains the whole query
+            import gazetteer
+            resp = gazetteer.predict(query)
+            if resp is not None:
+                source = 'gazetteer'
+                return resp
+
+        if backend == 'local':
+            #Imported lazily to keep numpy out of the import graph of the LUIS backend
+            import local_model
+            return await local_model.get_entities(query)
+
+        return await get_prediction(query, timeout=timeout, use_cache=use_cache)
+    finally:
+        insights.save_luis_latency(time.perf_counter() - start, source)
+
+
+async def get_prediction(query, timeout=None, use_cache=True):
 
         # YOUR-APP-ID: The App ID GUID found on the www.luis.ai Application Settings page.
     appId = app_id
@@ -39,9 +176,12 @@ def get_entities(query):
     utterance = query
     ##########
 
-    # The headers to use in this REST call.
-    headers = {
-    }
+    if use_cache:
+        cached = cache.get(utterance, scope=(appId, slot))
+        insights.save_cache_lookup(hit=cached is not None)
+        if cached is not None:
+            #A copy, like the responses of the requests, so that callers cannot change the cached one
+            return {**cached, 'query': utterance}
 
     # The URL parameters to use in this REST call.
     params ={
@@ -50,31 +190,91 @@ def get_entities(query):
         'verbose': 'true',
         'show-all-intents': 'true',
         'spellCheck': 'false',
-        'staging': 'true',
-        'subscription-key': prediction_key
+        'staging': str(slot == 'staging').lower(),
+        'subscription-key': prediction_key or ''
     }
 
+    #Identical utterances in flight share the request
+    key = (appId, slot, utterance)
+    end = time.monotonic() + (timeout if timeout is not None else deadline)
+
+    # Make the REST call on the pooled session.
+    async def request(attempt_timeout):
+        try:
+            session = get_session()
+            async with session.get(f'{prediction_endpoint}luis/prediction/v3.0/apps/{appId}/slots/{slot}/predict',
+                params=params, timeout=attempt_timeout) as response:
+                if response.status != 200:
+                    retry_after = response.headers.get('Retry-After', '')
+                    raise LuisUnavailable(f"LUIS answered with status {response.status}", 'status',
+                        status=response.status, retry_after=float(retry_after) if retry_after.isdigit() else None)
+                resp = await response.json(content_type=None)
+        except asyncio.TimeoutError as error:
+            raise LuisUnavailable("LUIS did not answer in time", 'timeout') from error
+        except aiohttp.ClientError as error:
+            raise LuisUnavailable(f"LUIS could not be reached: {error}", 'connection') from error
+        except ValueError as error:
+            raise LuisUnavailable("LUIS answered with invalid JSON", 'invalid') from error
 
-    # Make the REST call.
-    response = requests.get(f'{prediction_endpoint}luis/prediction/v3.0/apps/{appId}/slots/staging/predict', headers=headers, params=params)
-    
-    return response.json()
+        if 'prediction' not in resp:
+            raise LuisUnavailable("LUIS answered without a prediction", 'invalid')
+        return resp
+
+    async def predict():
+        if not breaker.allow():
+            raise LuisUnavailable("The LUIS circuit breaker is open", 'short_circuited')
+
+        #Each attempt is bounded by the deadline of the request which made it
+        start = time.monotonic()
+        try:
+            resp = await request(aiohttp.ClientTimeout(total=max(0.0, min(request_timeout, end - start))))
+        except LuisUnavailable:
+            breaker.record(False, time.monotonic() - start)
+            raise
+        breaker.record(True, time.monotonic() - start)
+        return resp
+
+    for attempt in range(retries + 1):
+        try:
+            resp = await asyncio.wait_for(scheduler.run(key, predict), max(0.0, end - time.monotonic()))
+            break
+        except asyncio.TimeoutError as error:
+            #Still waiting for a slot, or for the shared request, at the deadline
+            failure = LuisUnavailable("LUIS did not answer before the deadline", 'timeout')
+            failure.__cause__ = error
+        except asyncio.QueueFull as error:
+            failure = LuisUnavailable("Too many LUIS requests are waiting", 'rejected')
+            failure.__cause__ = error
+        except LuisUnavailable as error:
+            failure = error
+        insights.save_luis_error(failure.reason)
+
+        #Full jitter backoff, retrying only if the deadline leaves time for it
+        delay = random.uniform(0, retry_backoff * 2 ** attempt)
+        if failure.retry_after is not None:
+            delay = max(delay, failure.retry_after)
+        if not failure.retryable or attempt == retries or time.monotonic() + delay >= end:
+            raise failure
+        await asyncio.sleep(delay)
+
+    if use_cache:
+        cache.put(utterance, resp, scope=(appId, slot))
+
+    return {**resp, 'query': utterance}
 
 
 def get_first(entity):
     return entity[0]
 
-def update_entities(step_context, resp):
-    entity_resp = pd.DataFrame.from_dict(resp['prediction'])[['entities']]
-
-    entity_resp = entity_resp.loc[np.isin(entity_resp.index, relevant_entities)]
+def extract_entities(resp):
+    #Keeping only the first prediction of each relevant entity
+    return {ent: get_first(values) for ent, values in resp['prediction']['entities'].items()
+        if ent in relevant_entities}
 
-    entity_resp['entities'] = entity_resp['entities'].apply(get_first)
+def update_entities(step_context, resp):
+    entity_resp = extract_entities(resp)
 
     #Assigning entities to context
-    for index, row in entity_resp.iterrows():
-        step_context.values[index] = row['entities']
-
+    step_context.values.update(entity_resp)
 
-    
-    return entity_resp
\ No newline at end of file
+    return entity_resp
@@ -0,0 +1,234 @@
+"""
+  Local stand-in for the LUIS v3 prediction endpoint, answering from the labelled utterance files.
+
+  python luis_standin.py --port 8181 --latency lognormal:60:0.5 --error-rate 0.01 --throttle-rate 0.02
+  PRED_ENDPOINT=http://localhost:8181/ python app.py
+
+  It also serves the example upload, training and publishing routes of the authoring API: training takes
+  --train-time seconds, and the examples of a published version are then answered by the prediction route.
+
+  LUIS_AUTHORING_ENDPOINT=http://localhost:8181/ python authoring.py ../train_luis_utterances.json
+"""
+import argparse
+import asyncio
+import random
+import time
+from datetime import datetime, timezone
+from http import HTTPStatus
+
+from aiohttp import web
+
+import dataset
+import extractors
+
+
+def normalize(text):
+    #Labels are given on the lowercase, dollar free text used for training
+    return text.replace("$", "€").lower()
+
+
+def parse_latency(spec):
+    """
+      Parses a latency distribution, values in milliseconds:
+      fixed:<ms>, uniform:<low>:<high>, normal:<mean>:<std>, lognormal:<median>:<sigma>
+    """
+    kind, *args = spec.split(":")
+    args = [float(a) for a in args]
+
+    if kind == "fixed":
+        return lambda rng: args[0] / 1000
+    if kind == "uniform":
+        return lambda rng: rng.uniform(args[0], args[1]) / 1000
+    if kind == "normal":
+        return lambda rng: max(0.0, rng.gauss(args[0], args[1])) / 1000
+    if kind == "lognormal":
+        return lambda rng: args[0] * rng.lognormvariate(0, args[1]) / 1000
+    raise ValueError(f"Unknown latency distribution '{spec}'")
+
+
+def load_labels(paths):
+    labels = {}
+    for path in paths:
+        for text, _, spans in dataset.load_utterances(path):
+            labels.setdefault(normalize(text), spans)
+    return labels
+
+
+def get_fallback(name):
+    if name == "empty":
+        return lambda text: []
+    if name == "local":
+        import local_model
+        model = local_model.get_model()
+        return model.predict_spans
+    raise ValueError(f"Unknown fallback '{name}'")
+
+
+def create_app(data=(dataset.train_path, dataset.test_path, dataset.test_red_path), fallback="local",
+    latency="fixed:0", error_rate=0.0, throttle_rate=0.0, rate_limit=None, key=None, seed=0, train_time=5.0):
+
+    labels = load_labels(data)
+    fallback_spans = get_fallback(fallback)
+    sample_latency = parse_latency(latency)
+    rng = random.Random(seed)
+    stats = {'requests': 0, 'labelled': 0, 'fallback': 0, 'errors': 0, 'throttled': 0, 'authoring': 0}
+    #Requests accepted in the current second, for the transactions per second quota
+    window = [0, 0]
+    #Authoring state of each (app id, version): examples by text, training start and trained examples
+    versions = {}
+
+    async def simulate(request_key):
+        #Error response of a request, or None once its latency elapsed
+        if key is not None and request_key != key:
+            return web.json_response({'error': {'code': '401', 'message': 'Access denied due to invalid subscription key.'}},
+                status=HTTPStatus.UNAUTHORIZED)
+
+        #Quota and random throttling are answered immediately, like the real endpoint
+        second = int(time.monotonic())
+        if window[0] != second:
+            window[:] = [second, 0]
+        window[1] += 1
+        if (rate_limit is not None and window[1] > rate_limit) or rng.random() < throttle_rate:
+            stats['throttled'] += 1
+            return web.json_response({'error': {'code': '429', 'message': 'Rate limit is exceeded.'}},
+                status=HTTPStatus.TOO_MANY_REQUESTS, headers={'Retry-After': '1'})
+
+        await asyncio.sleep(sample_latency(rng))
+
+        if rng.random() < error_rate:
+            stats['errors'] += 1
+            return web.json_response({'error': {'code': '500', 'message': 'Internal server error.'}},
+                status=HTTPStatus.INTERNAL_SERVER_ERROR)
+        return None
+
+    async def predict(request: web.Request) -> web.Response:
+        stats['requests'] += 1
+        error = await simulate(request.query.get('subscription-key'))
+        if error is not None:
+            return error
+
+        query = request.query.get('query', '')
+        text = normalize(query)
+        #Offsets are only valid if the rewrite preserved the length of the query
+        if len(text) != len(query):
+            text = query
+
+        spans = labels.get(text)
+        if spans is not None:
+            stats['labelled'] += 1
+            spans = [(ent, start, end, 1.0) for ent, start, end in spans]
+        else:
+            stats['fallback'] += 1
+            spans = fallback_spans(text)
+
+        return web.json_response(extractors.build_response(query, spans))
+
+    def bad_argument(message):
+        return web.json_response({'error': {'code': 'BadArgument', 'message': message}}, status=HTTPStatus.BAD_REQUEST)
+
+    def get_version(request):
+        return versions.setdefault((request.match_info['app_id'], request.match_info['version']),
+            {'examples': {}, 'trained_at': None, 'trained': {}})
+
+    def training_status(version):
+        #Queued for the first fifth of the training time, then in progress
+        elapsed = time.monotonic() - version['trained_at']
+        if elapsed < train_time / 5:
+            return 'Queued'
+        return 'InProgress' if elapsed < train_time else 'Success'
+
+    def authoring(handler):
+        #Authoring requests authenticate with a header, and are throttled and delayed like predictions
+        async def handle(request: web.Request) -> web.Response:
+            stats['authoring'] += 1
+            error = await simulate(request.headers.get('Ocp-Apim-Subscription-Key'))
+            return error if error is not None else await handler(request)
+        return handle
+
+    async def add_examples(request: web.Request) -> web.Response:
+        try:
+            examples = await request.json()
+        except ValueError:
+            return bad_argument("The request body is not valid JSON.")
+        if not isinstance(examples, list) or not 1 <= len(examples) <= 100:
+            return bad_argument("A batch holds between 1 and 100 examples.")
+
+        version = get_version(request)
+        results = []
+        for example in examples:
+            text = example.get('text') or ''
+            spans = [(e.get('entityName'), e.get('startCharIndex', -1), e.get('endCharIndex', -1))
+                for e in example.get('entityLabels') or []]
+            if not text.strip() or not all(0 <= start < end <= len(text) for _, start, end in spans):
+                results.append({'value': None, 'hasError': True,
+                    'error': {'code': 'FAILED', 'message': f"Invalid example '{text}'."}})
+                continue
+            version['examples'][normalize(text)] = spans
+            results.append({'value': {'ExampleId': len(version['examples']), 'UtteranceText': text}, 'hasError': False})
+        return web.json_response(results, status=HTTPStatus.CREATED)
+
+    async def train(request: web.Request) -> web.Response:
+        version = get_version(request)
+        version['trained_at'] = time.monotonic()
+        version['trained'] = dict(version['examples'])
+        return web.json_response({'statusId': 9, 'status': 'Queued'}, status=HTTPStatus.ACCEPTED)
+
+    async def get_training(request: web.Request) -> web.Response:
+        version = get_version(request)
+        entities = sorted({ent for spans in version['trained'].values() for ent, _, _ in spans})
+        status = training_status(version) if version['trained_at'] is not None else 'Fail'
+        details = {'statusId': ['Success', 'Fail', 'UpToDate', 'InProgress', 'Queued'].index(status),
+            'status': status, 'exampleCount': len(version['trained'])}
+        if status == 'Fail':
+            details['failureReason'] = 'NotTrained'
+        return web.json_response([{'modelId': name, 'details': details} for name in ['BookFlight', 'None'] + entities])
+
+    async def publish(request: web.Request) -> web.Response:
+        try:
+            body = await request.json()
+        except ValueError:
+            return bad_argument("The request body is not valid JSON.")
+        version = versions.get((request.match_info['app_id'], body.get('versionId')))
+        if version is None or version['trained_at'] is None or training_status(version) != 'Success':
+            return bad_argument("The application version is not trained.")
+
+        #The published examples are answered verbatim from now on
+        labels.update(version['trained'])
+        return web.json_response({'versionId': body['versionId'], 'isStaging': bool(body.get('isStaging')),
+            'endpointUrl': f"{request.url.origin()}/luis/prediction/v3.0/apps/{request.match_info['app_id']}",
+            'region': 'local', 'endpointRegion': 'local', 'failedRegions': None,
+            'publishedDateTime': datetime.now(timezone.utc).isoformat()}, status=HTTPStatus.CREATED)
+
+    async def get_stats(request: web.Request) -> web.Response:
+        return web.json_response(stats)
+
+    authoring_path = "/luis/authoring/v3.0-preview/apps/{app_id}"
+    app = web.Application()
+    app.router.add_get("/luis/prediction/v3.0/apps/{app_id}/slots/{slot}/predict", predict)
+    app.router.add_post(authoring_path + "/versions/{version}/examples", authoring(add_examples))
+    app.router.add_post(authoring_path + "/versions/{version}/train", authoring(train))
+    app.router.add_get(authoring_path + "/versions/{version}/train", authoring(get_training))
+    app.router.add_post(authoring_path + "/publish", authoring(publish))
+    app.router.add_get("/stats", get_stats)
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=8181)
+    parser.add_argument("--data", nargs="+", default=[dataset.train_path, dataset.test_path, dataset.test_red_path],
+        help="Labelled utterance files answered verbatim")
+    parser.add_argument("--fallback", default="local", choices=["local", "empty"],
+        help="Answer for unknown text: the offline model or no entities")
+    parser.add_argument("--latency", default="fixed:0", help="Latency distribution, e.g. lognormal:60:0.5")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Transactions per second before answering 429")
+    parser.add_argument("--key", default=None, help="Expected subscription key, any key is accepted if not set")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--train-time", type=float, default=5.0, help="Seconds taken by the training of a version")
+    args = parser.parse_args()
+
+    web.run_app(create_app(args.data, args.fallback, args.latency, args.error_rate, args.throttle_rate,
+        args.rate_limit, args.key, args.seed, args.train_time), host=args.host, port=args.port)
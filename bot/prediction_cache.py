@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+class PredictionCache:
+    """
+      Bounded LRU cache with a time to live for LUIS prediction responses.
+      Entries are keyed on the exact utterance, as the entity offsets and texts of a response only hold for
+      the utterance it was predicted for, and scoped to a LUIS app id and slot, changing either one clears
+      the cache.
+    """
+
+    def __init__(self, maxsize: int=1024, ttl: float=3600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.scope = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _check_scope(self, scope):
+        if scope != self.scope:
+            self._entries.clear()
+            self.scope = scope
+
+    def get(self, query, scope=None):
+        self._check_scope(scope)
+        entry = self._entries.get(query)
+
+        if entry is not None:
+            expires, value = entry
+            if expires > self.clock():
+                self._entries.move_to_end(query)
+                self.hits += 1
+                return value
+            del self._entries[query]
+
+        self.misses += 1
+        return None
+
+    def put(self, query, value, scope=None):
+        if self.maxsize <= 0:
+            return
+        self._check_scope(scope)
+        self._entries[query] = (self.clock() + self.ttl, value)
+        self._entries.move_to_end(query)
+
+        #Evicting the least recently used entries
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,143 @@
+"""
+  Exports the OpenCensus views in the Prometheus text format, served on /metrics by the bot.
+
+  The exporter is registered with the view manager, which hands it a copy of the view data of every
+  recording: the latest copy is kept per view and a view is only rendered again once it changed,
+  so that a scrape mostly joins cached text.
+"""
+import os
+import resource
+import threading
+import time
+
+from aiohttp import web
+from opencensus.stats import aggregation_data as aggregation_data_module
+
+
+content_type = "text/plain; version=0.0.4; charset=utf-8"
+
+process_start_time = time.time()
+
+
+def escape(value, quotes=True):
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quotes else value
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+
+def format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def render_family(name, kind, description, samples):
+    #samples are (suffix, labels, value) tuples, labels being (key, value) pairs
+    lines = [f"# HELP {name} {escape(description, quotes=False)}", f"# TYPE {name} {kind}"]
+    for suffix, labels, value in samples:
+        lines.append(f"{name}{suffix}{format_labels(labels)} {format_value(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def histogram_samples(labels, data):
+    #Prometheus buckets are cumulative, OpenCensus ones only count the values within their bounds
+    samples = []
+    count = 0
+    for bound, bucket_count in zip(data.bounds, data.counts_per_bucket):
+        count += bucket_count
+        samples.append(("_bucket", labels + [("le", format_value(float(bound)))], count))
+    samples.append(("_bucket", labels + [("le", "+Inf")], data.count_data))
+    samples.append(("_sum", labels, data.sum))
+    samples.append(("_count", labels, data.count_data))
+    return samples
+
+
+def render_view(view_data, prefix):
+    view = view_data.view
+    name = prefix + view.name
+    samples = []
+    kind = None
+
+    for tag_values, data in sorted(view_data.tag_value_aggregation_data_map.items(), key=lambda item: str(item[0])):
+        labels = [(key, value) for key, value in zip(view.columns, tag_values) if value is not None]
+        if isinstance(data, aggregation_data_module.CountAggregationData):
+            kind = "counter"
+            samples.append(("", labels, data.count_data))
+        elif isinstance(data, aggregation_data_module.SumAggregationData):
+            kind = "counter"
+            samples.append(("", labels, data.sum_data))
+        elif isinstance(data, aggregation_data_module.LastValueAggregationData):
+            kind = "gauge"
+            samples.append(("", labels, data.value))
+        elif isinstance(data, aggregation_data_module.DistributionAggregationData):
+            kind = "histogram"
+            samples.extend(histogram_samples(labels, data))
+
+    if kind is None:
+        return ""
+    if kind == "counter":
+        name += "_total"
+    return render_family(name, kind, view.description, samples)
+
+
+def process_metrics():
+    #Standard process collector metrics, from the standard library only
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    families = [
+        ("process_cpu_seconds_total", "counter", "Total user and system CPU time spent in seconds.",
+            usage.ru_utime + usage.ru_stime),
+        ("process_start_time_seconds", "gauge", "Start time of the process since unix epoch in seconds.",
+            process_start_time),
+        ("python_threads", "gauge", "Number of running Python threads.", threading.active_count()),
+    ]
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        families.append(("process_resident_memory_bytes", "gauge", "Resident memory size in bytes.",
+            pages * os.sysconf("SC_PAGE_SIZE")))
+        families.append(("process_open_fds", "gauge", "Number of open file descriptors.",
+            len(os.listdir("/proc/self/fd"))))
+    except OSError:
+        #ru_maxrss is the peak resident size, in kilobytes on Linux
+        families.append(("process_max_resident_memory_bytes", "gauge", "Maximum resident memory size in bytes.",
+            usage.ru_maxrss * 1024))
+
+    return "".join(render_family(name, kind, description, [("", [], value)])
+        for name, kind, description, value in families)
+
+
+class PrometheusExporter:
+    """
+      Stats exporter rendering the registered views, then the output of each collector
+      (functions returning text in the exposition format) on every scrape.
+    """
+
+    def __init__(self, prefix: str="flybot_", collectors=(process_metrics,)):
+        self.prefix = prefix
+        self.collectors = list(collectors)
+        self._latest = {}
+        self._rendered = {}
+        self._lock = threading.Lock()
+
+    def export(self, view_datas):
+        #Called by the view manager on every recording, only keeping a reference to the copies
+        with self._lock:
+            for view_data in view_datas:
+                self._latest[view_data.view.name] = view_data
+
+    def render(self):
+        with self._lock:
+            changed, self._latest = self._latest, {}
+        for name, view_data in changed.items():
+            self._rendered[name] = render_view(view_data, self.prefix)
+        return "".join(self._rendered.values()) + "".join(collector() for collector in self.collectors)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        response = web.Response(body=self.render().encode("utf-8"))
+        response.headers["Content-Type"] = content_type
+        return response
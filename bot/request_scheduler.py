@@ -0,0 +1,135 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+      Token bucket allowing rate requests per second on average, and bursts of up to burst requests:
+      at most rate + burst - 1 requests start in any second, to stay within a per second quota.
+    """
+
+    def __init__(self, rate: float, burst: float=1, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = self.burst
+        self.updated = clock()
+
+    def delay(self) -> float:
+        #Seconds until a token is available, 0 if there is one
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class RequestScheduler:
+    """
+      Schedules the calls to a rate limited service: identical requests in flight are coalesced into
+      one call, at most max_concurrency calls run at once and at most rate calls start per second.
+
+      Excess requests wait in a FIFO queue: asyncio.QueueFull is raised when max_queue requests are
+      already waiting, and asyncio.TimeoutError when a request waited more than max_wait seconds.
+
+      observer, if given, is called for every request with its outcome ('sent', 'coalesced',
+      'rejected' or 'timed_out'), the seconds it waited and the number of waiting requests.
+    """
+
+    def __init__(self, max_concurrency: int=20, rate: float=None, burst: float=1, max_queue: int=200,
+        max_wait: float=2.0, observer=None, clock=time.monotonic):
+        if max_concurrency < 1:
+            raise ValueError("The maximum concurrency must be positive")
+        self.max_concurrency = max_concurrency
+        self.bucket = TokenBucket(rate, burst, clock) if rate else None
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.observer = observer
+        self.clock = clock
+        self.waiting = 0
+        self.stats = {'sent': 0, 'coalesced': 0, 'rejected': 0, 'timed_out': 0}
+
+        #Primitives bound to the running event loop, created on first use
+        self._loop = None
+
+    def _bind(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+            self._rate_lock = asyncio.Lock()
+            self._in_flight = {}
+            self.waiting = 0
+
+    def _observe(self, outcome, wait=0.0):
+        self.stats[outcome] += 1
+        if self.observer is not None:
+            self.observer(outcome, wait, self.waiting)
+
+    async def run(self, key, call):
+        """
+          Returns the result of call(), a coroutine function, or the one of the call in flight for key.
+        """
+        self._bind()
+        task = self._in_flight.get(key)
+        if task is not None:
+            self._observe('coalesced')
+        else:
+            #Registered before waiting, so that identical requests also share the wait
+            task = asyncio.ensure_future(self._schedule(call))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._done(key, task))
+
+        #Shielded so that a cancelled caller does not cancel the call shared with the others
+        return await asyncio.shield(task)
+
+    def _done(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        #Retrieved in case every caller was cancelled, to avoid a never retrieved exception warning
+        if not task.cancelled():
+            task.exception()
+
+    async def _schedule(self, call):
+        await self._acquire()
+        try:
+            return await call()
+        finally:
+            self._slots.release()
+
+    async def _acquire(self):
+        if self.waiting >= self.max_queue:
+            self._observe('rejected')
+            raise asyncio.QueueFull(f"{self.waiting} requests are already waiting")
+
+        start = self.clock()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._wait_turn(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.waiting -= 1
+            self._observe('timed_out', self.clock() - start)
+            raise
+        except BaseException:
+            self.waiting -= 1
+            raise
+
+        self.waiting -= 1
+        self._observe('sent', self.clock() - start)
+
+    async def _wait_turn(self):
+        await self._slots.acquire()
+        try:
+            if self.bucket is not None:
+                #One request at a time waits for a token, in arrival order
+                async with self._rate_lock:
+                    delay = self.bucket.delay()
+                    while delay > 0:
+                        await asyncio.sleep(delay)
+                        delay = self.bucket.delay()
+                    self.bucket.take()
+        except BaseException:
+            self._slots.release()
+            raise
@@ -0,0 +1,4 @@
+from .sqlite_storage import SqliteStorage
+from . import compact_models
+
+__all__ = ["SqliteStorage", "compact_models"]
@@ -0,0 +1,92 @@
+"""
+  jsonpickle handler flattening the Bot Framework schema models (such as the activities kept in the
+  state of the prompts) with their non default attributes only: an activity created by
+  MessageFactory.text sets 3 of its 40 attributes, the others are restored by the model constructor.
+  String enum values (activity types, input hints...) are kept as the plain strings the models are
+  declared with.
+
+  Fixed-field records (classes flattened as the list of their values by __getstate__) are restored by
+  __setstate__, including the records stored as attribute dicts before their fields were fixed.
+
+  The handlers are registered by register(), called by the app when it creates a storage that flattens
+  the bot state. jsonpickle also flattens it for the change detection hash computed by the bot state on
+  every turn, which then gets the compact form as well.
+"""
+from enum import Enum
+
+from jsonpickle import handlers, tags
+from jsonpickle.unpickler import loadclass
+from msrest.serialization import Model
+
+
+_defaults = {}
+
+
+def new_model(cls):
+    try:
+        return cls()
+    except TypeError:
+        #Models with required arguments are restored from their attributes only
+        return cls.__new__(cls)
+
+
+def get_defaults(cls):
+    if cls not in _defaults:
+        _defaults[cls] = dict(vars(new_model(cls)))
+    return _defaults[cls]
+
+
+class ModelHandler(handlers.BaseHandler):
+
+    def flatten(self, obj, data):
+        defaults = get_defaults(type(obj))
+        for key, value in vars(obj).items():
+            if key not in defaults or value != defaults[key]:
+                if isinstance(value, str) and isinstance(value, Enum):
+                    value = value.value
+                data[key] = self.context.flatten(value, reset=False)
+        return data
+
+    def restore(self, data):
+        instance = new_model(loadclass(data[tags.OBJECT]))
+        for key, value in data.items():
+            if key != tags.OBJECT:
+                setattr(instance, key, self.context.restore(value, reset=False))
+        return instance
+
+
+class RecordHandler(handlers.BaseHandler):
+
+    def flatten(self, obj, data):
+        data[tags.STATE] = self.context.flatten(obj.__getstate__(), reset=False)
+        return data
+
+    def restore(self, data):
+        cls = loadclass(data[tags.OBJECT])
+        instance = cls.__new__(cls)
+        if tags.STATE in data:
+            state = self.context.restore(data[tags.STATE], reset=False)
+        else:
+            state = {key: self.context.restore(value, reset=False) for key, value in data.items() if key != tags.OBJECT}
+        instance.__setstate__(state)
+        return instance
+
+
+_records = []
+
+
+def register(*records):
+    #records: fixed-field record classes, their subclasses included
+    handlers.register(Model, ModelHandler, base=True)
+    for cls in records:
+        handlers.register(cls, RecordHandler, base=True)
+        if cls not in _records:
+            _records.append(cls)
+
+
+def unregister():
+    #Restores the default flattening of every attribute, for comparisons
+    handlers.unregister(Model)
+    for cls in _records:
+        handlers.unregister(cls)
+    _records.clear()
@@ -0,0 +1,182 @@
+import asyncio
+import json
+import sqlite3
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, List
+
+from botbuilder.core import Storage, StoreItem
+from jsonpickle.pickler import Pickler
+from jsonpickle.unpickler import Unpickler
+
+
+def get_e_tag(item):
+    if isinstance(item, dict):
+        return item.get("e_tag")
+    return getattr(item, "e_tag", None)
+
+
+def set_e_tag(item, e_tag):
+    if isinstance(item, dict):
+        item["e_tag"] = e_tag
+    elif item is not None:
+        item.e_tag = e_tag
+
+
+def serialize(item) -> str:
+    #Same flattening as the Cosmos DB storage, the e_tag is stored in its own column
+    data = Pickler().flatten(item)
+    if isinstance(data, dict):
+        data.pop("e_tag", None)
+    return json.dumps(data, separators=(",", ":"))
+
+
+def deserialize(data: str, e_tag: int):
+    item = Unpickler().restore(json.loads(data))
+    set_e_tag(item, str(e_tag))
+    return item
+
+
+class SqliteStorage(Storage):
+    """
+      Durable bot state storage on a SQLite database in WAL mode, shared by every process using the same file.
+      Writes from concurrent turns are committed together in a single transaction, and items carrying an
+      e_tag are only written if it still matches the stored one (optimistic concurrency).
+    """
+
+    def __init__(self, path: str, timeout: float=5.0, readers: int=2):
+        super(SqliteStorage, self).__init__()
+        self.path = path
+        self.timeout = timeout
+
+        #Writes are serialized on a single thread, WAL mode lets readers run alongside it
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-storage")
+        self._read_executor = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="sqlite-storage-read")
+        self._local = threading.local()
+        self._connections = []
+        self._pending = []
+        self._lock = threading.Lock()
+
+        #Creating the schema up front
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        #One connection per thread
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None,
+                check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS state "
+                "(key TEXT PRIMARY KEY, e_tag INTEGER NOT NULL, data TEXT NOT NULL)")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    async def _run(self, executor, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+
+    async def read(self, keys: List[str]):
+        if not keys:
+            return {}
+        return await self._run(self._read_executor, self._read, list(keys))
+
+    def _read(self, keys):
+        connection = self._connect()
+        placeholders = ",".join("?" * len(keys))
+        rows = connection.execute(f"SELECT key, e_tag, data FROM state WHERE key IN ({placeholders})", keys)
+        return {key: deserialize(data, e_tag) for key, e_tag, data in rows}
+
+    async def write(self, changes: Dict[str, StoreItem]):
+        if changes is None:
+            raise Exception("Changes are required when writing")
+        if not changes:
+            return
+
+        #Serializing right away so that later changes to the items are not persisted by this call
+        batch = []
+        for key, change in changes.items():
+            e_tag = get_e_tag(change)
+            if e_tag == "":
+                raise Exception("sqlite_storage.write(): etag missing")
+            batch.append((key, None if e_tag in (None, "*") else int(e_tag), serialize(change)))
+
+        future = Future()
+        with self._lock:
+            self._pending.append((batch, future))
+        self._executor.submit(self._flush)
+        e_tags = await asyncio.wrap_future(future)
+
+        #Keeping the items in sync with the stored version, so that they can be written again
+        for key, change in changes.items():
+            set_e_tag(change, str(e_tags[key]))
+
+    def _flush(self):
+        #Group commit: every batch queued since the last flush goes into one transaction
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+
+        results = []
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            for batch, future in pending:
+                connection.execute("SAVEPOINT batch")
+                try:
+                    results.append((future, self._write_batch(connection, batch), None))
+                    connection.execute("RELEASE batch")
+                except KeyError as error:
+                    connection.execute("ROLLBACK TO batch")
+                    connection.execute("RELEASE batch")
+                    results.append((future, None, error))
+            connection.execute("COMMIT")
+        except Exception as error:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            for _, future in pending:
+                future.set_exception(error)
+            return
+
+        for future, e_tags, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(e_tags)
+
+    def _write_batch(self, connection, batch):
+        #Plain statements rather than upserts or RETURNING (SQLite 3.24 and 3.35), the e_tags are computed
+        #here, which is safe inside the immediate transaction of the flush
+        e_tags = {}
+        for key, e_tag, data in batch:
+            row = connection.execute("SELECT e_tag FROM state WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                #Missing items are inserted whatever their e_tag, as the memory storage does (a deleted
+                #conversation can be written again)
+                new_e_tag = 1
+                connection.execute("INSERT INTO state (key, e_tag, data) VALUES (?, ?, ?)", (key, new_e_tag, data))
+            elif e_tag is not None and e_tag != row[0]:
+                raise KeyError(f"Etag conflict.\nOriginal: {e_tag}\r\nCurrent: {row[0]}")
+            else:
+                new_e_tag = row[0] + 1
+                connection.execute("UPDATE state SET data = ?, e_tag = ? WHERE key = ?", (data, new_e_tag, key))
+            e_tags[key] = new_e_tag
+        return e_tags
+
+    async def delete(self, keys: List[str]):
+        if keys:
+            await self._run(self._executor, self._delete, list(keys))
+
+    def _delete(self, keys):
+        connection = self._connect()
+        connection.executemany("DELETE FROM state WHERE key = ?", [(key,) for key in keys])
+
+    def close(self):
+        self._executor.shutdown()
+        self._read_executor.shutdown()
+        for connection in self._connections:
+            connection.close()
+        self._connections = []
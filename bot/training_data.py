@@ -0,0 +1,193 @@
+"""
+  Generation of the LUIS utterance files from the Frames corpus, as done by Notebook.ipynb: user turns of
+  the well rated and successful dialogues, labelled with the spans of their budget, city and date values,
+  split 80/20 with the seed of the notebook and written without duplicate texts.
+
+  python training_data.py ../Data/frames.json --output-dir .. --workers 4
+
+  writes train_luis_utterances.json, test_luis_utterances.json (LUIS REST API format) and
+  test_luis_utterances_red.json (luis.ai website format, first 999 test utterances).
+"""
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import os
+import re
+import sys
+
+import numpy as np
+
+import dataset
+
+
+#Same entities as luis.relevant_entities, without importing the bot
+relevant_entities = ['budget', 'dst_city', 'or_city', 'str_date', 'end_date']
+
+seed = 5420
+test_size = 0.2
+#The luis.ai website test file was limited to the first 999 test utterances
+web_test_limit = 999
+
+formats = {
+    'luis': ('intentName', 'entityLabels', 'entityName', 'startCharIndex', 'endCharIndex'),
+    'web': ('intent', 'entities', 'entity', 'startPos', 'endPos'),
+}
+
+
+def is_selected(dialogue):
+    labels = dialogue.get('labels') or {}
+    rating = labels.get('userSurveyRating')
+    return rating is not None and rating > 2 and labels.get('wizardSurveyTaskSuccessful') is True
+
+
+def select_dialogues(dialogues, positional=True):
+    """
+      Dialogues rated above 2 by the user and successful for the wizard. With positional, the notebook
+      selection: its merge of the selected ids with their normalized turns aligned them by position (the
+      pandas json_normalize of the time dropped the index of the turns), so the turns of the p-th selected
+      dialogue were kept only if p is also the index of a selected dialogue.
+    """
+    selected = set()
+    position = 0
+    for index, dialogue in enumerate(dialogues):
+        if is_selected(dialogue):
+            selected.add(index)
+            #p <= index, whether p is selected is already known
+            if not positional or position in selected:
+                yield dialogue
+            position += 1
+
+
+def user_turns(dialogues):
+    #(text, acts) of the user turns, acts being the labels without references of the turn
+    for dialogue in dialogues:
+        for turn in dialogue['turns']:
+            if turn.get('author') == 'user':
+                yield turn['text'], turn['labels']['acts_without_refs']
+
+
+def normalize(text):
+    #Dollars replaced with euros to prevent matching errors, in lowercase
+    return text.replace("$", "€").lower()
+
+
+@functools.lru_cache(maxsize=None)
+def value_pattern(value):
+    #The labelled values are searched as regular expressions, as in the notebook
+    try:
+        return re.compile(normalize(value))
+    except re.error:
+        return None
+
+
+def label_turn(text, acts):
+    """
+      Returns the normalized text, its (entity, start, end) spans and the number of values not found in
+      the text. Negated acts are ignored, as are the -1 values (flexible dates or budget).
+    """
+    text = normalize(text)
+    spans = []
+    unmatched = 0
+    for act in acts:
+        if not act['args'] or act['name'] == 'negate':
+            continue
+        for arg in act['args']:
+            value = arg.get('val')
+            if arg.get('key') not in relevant_entities or value is None or value == "-1":
+                continue
+            pattern = value_pattern(value)
+            match = pattern.search(text) if pattern is not None else None
+            if match:
+                spans.append((arg['key'], match.start(), match.end()))
+            else:
+                unmatched += 1
+    return text, spans, unmatched
+
+
+def label_turns(turns):
+    labelled = [label_turn(text, acts) for text, acts in turns]
+    return [(text, spans) for text, spans, _ in labelled], sum(unmatched for _, _, unmatched in labelled)
+
+
+def label_all(turns, workers=1, chunk_size=2000):
+    #Labels the turns in order, by chunks spread over worker processes if workers > 1
+    chunks = [turns[i:i + chunk_size] for i in range(0, len(turns), chunk_size)]
+    if workers > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(workers) as pool:
+            results = pool.map(label_turns, chunks)
+    else:
+        results = [label_turns(chunk) for chunk in chunks]
+
+    return [u for labelled, _ in results for u in labelled], sum(unmatched for _, unmatched in results)
+
+
+def split_indexes(n, size=test_size, random_state=seed):
+    #Same split as sklearn train_test_split(shuffle=True): the test rows come first in the permutation
+    n_test = math.ceil(size * n)
+    permutation = np.random.RandomState(random_state).permutation(n)
+    return permutation[n_test:], permutation[:n_test]
+
+
+def deduplicate(utterances):
+    #Keeps the first utterance of each text, duplicates are not allowed by LUIS
+    seen = set()
+    unique = []
+    for text, spans in utterances:
+        if text not in seen:
+            seen.add(text)
+            unique.append((text, spans))
+    return unique
+
+
+def to_records(utterances, file_format='luis'):
+    intent_key, entities_key, entity_key, start_key, end_key = formats[file_format]
+    return [{intent_key: 'BookFlight' if spans else 'None', 'text': text,
+        entities_key: [{entity_key: ent, start_key: start, end_key: end} for ent, start, end in spans]}
+        for text, spans in utterances]
+
+
+def dumps(records):
+    #Same text as pandas DataFrame.to_json(orient='records'), which also escapes slashes
+    return json.dumps(records, separators=(',', ':')).replace("/", "\\/")
+
+
+def generate(frames_path, output_dir, workers=1, positional=True):
+    dialogues = dataset.iter_records(frames_path)
+    turns = list(user_turns(select_dialogues(dialogues, positional)))
+    utterances, unmatched = label_all(turns, workers)
+
+    train_indexes, test_indexes = split_indexes(len(utterances))
+    train = deduplicate([utterances[i] for i in train_indexes])
+    test = [utterances[i] for i in test_indexes]
+
+    files = {
+        "train_luis_utterances.json": to_records(train),
+        "test_luis_utterances.json": to_records(deduplicate(test)),
+        "test_luis_utterances_red.json": to_records(deduplicate(test[:web_test_limit]), 'web'),
+    }
+    for name, records in files.items():
+        with open(os.path.join(output_dir, name), 'w', encoding='utf-8') as file:
+            file.write(dumps(records))
+
+    return {'user_turns': len(turns), 'unmatched_values': unmatched,
+        **{name: len(records) for name, records in files.items()}}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("frames", help="Frames corpus, a JSON array of dialogues")
+    parser.add_argument("--output-dir", default=dataset.data_dir)
+    parser.add_argument("--workers", type=int, default=1, help="Processes labelling the turns")
+    parser.add_argument("--all-selected", action="store_true",
+        help="Keep every selected dialogue rather than reproducing the positional selection of the notebook")
+    args = parser.parse_args(argv)
+
+    report = generate(args.frames, args.output_dir, args.workers, positional=not args.all_selected)
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())